@@ -2,24 +2,52 @@ import flask
 from flask import Flask, request, jsonify, send_from_directory, abort, send_file
 from flask_cors import CORS
 import os 
-from werkzeug.utils import secure_filename 
+from werkzeug.utils import secure_filename, safe_join 
 import urllib.parse
-import base64 
 import ssl
+import atexit
 
 # Importe toutes les fonctions nécessaires
-from gestion_db import ajouter_document, recuperer_documents_par_categorie, supprimer_document, initialiser_base_de_donnees, recuperer_4_derniers_documents, diagnostiquer_fichiers_locaux, recuperer_tous_documents, recuperer_document_par_id, marquer_document_signe 
+from gestion_db import ajouter_document, recuperer_documents_par_categorie, supprimer_document, initialiser_base_de_donnees, recuperer_4_derniers_documents, recuperer_tous_documents, recuperer_document_par_id, signer_documents, recuperer_page_documents, iterer_documents, supprimer_documents_en_masse, recuperer_document_par_nom, rechercher_documents, recuperer_documents_par_categories, TAILLE_PAGE_MAX
+from connexion_db import fermer_connexions
+import ramasse_miettes
+import stockage_blobs
+import livraison
+from livraison import servir_fichier
+import miniatures
+import extraction_texte
+import reconciliation
+import sessions_upload
+import export_zip
+import signatures
+import modifications
+import serveur_sse
+import statistiques
+import import_lot
+import metriques
+import journal
+import compression
+
+log = journal.obtenir(__name__)
 
 # 1. Configuration de l'application Flask
 app = Flask(__name__)
 CORS(app) 
+# Latence, statuts et octets par route ; GET /metrics (format Prometheus)
+metriques.instrumenter(app)
+# Identifiant de requête (X-Request-Id) et journal d'accès échantillonné
+journal.instrumenter(app)
+# Compression gzip/brotli négociée (après les métriques : octets mesurés compressés)
+compression.instrumenter(app)
 
 # --- DÉFINITION DU CHEMIN DU DOSSIER DE DONNÉES ---
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DATA_FOLDER_PATH = os.path.join(PROJECT_ROOT, 'data')
+DATA_FOLDER_PATH = os.environ.get("FORMULAMA_DATA_DIR", os.path.join(PROJECT_ROOT, 'data'))
 SIGNATURES_FOLDER_PATH = os.path.join(DATA_FOLDER_PATH, 'signatures')
 # Créer le dossier des signatures s'il n'existe pas
 os.makedirs(SIGNATURES_FOLDER_PATH, exist_ok=True)
+# Base des chemins X-Accel-Redirect (FORMULAMA_LIVRAISON=x-accel-redirect)
+livraison.configurer(DATA_FOLDER_PATH)
 # ----------------------------------------------------
 
 # --- FONCTION UTILITAIRE POUR LE MIME TYPE ---
@@ -33,26 +61,84 @@ def get_mimetype(filename):
         return 'application/octet-stream'
 
 
-# --- FONCTION POUR SAUVEGARDER LA SIGNATURE ---
-def save_signature(doc_id, signature_base64):
-    """Sauvegarde la signature (base64 PNG) sur le disque."""
+# --- EMPLACEMENT PHYSIQUE D'UN DOCUMENT ---
+def emplacement_fichier(document, filename):
+    """
+    Retourne (chemin, sha256) du fichier à servir pour un document :
+    le blob adressé par contenu s'il en a un, sinon data/<filename> (anciens uploads, sha256=None).
+    """
+    if document and document.get('sha256'):
+        return stockage_blobs.chemin_absolu_blob(DATA_FOLDER_PATH, document['sha256']), document['sha256']
+    return safe_join(DATA_FOLDER_PATH, filename), None
+
+
+# --- PAGINATION ET STREAMING DES LISTES DE DOCUMENTS ---
+# Taille visée des morceaux envoyés en mode streaming
+TAILLE_MORCEAU_STREAMING = 64 * 1024
+
+def reponse_liste_documents(categorie, dictionnaire, recuperer_tout, cle_cache):
+    """
+    Construit la réponse d'une liste de documents selon les paramètres de la requête :
+    - sans paramètre : liste complète (comportement historique, via `recuperer_tout`),
+      corps encodé mis en cache sous `cle_cache` (voir compression.reponse_json) ;
+    - ?limit=N[&after=curseur] : une page {"documents": [...], "next": curseur|null} ;
+    - ?stream=1 : la liste complète encodée et envoyée au fil de la lecture en base.
+    """
+    if request.args.get('stream') in ('1', 'true'):
+        return reponse_json_streaming(iterer_documents(categorie, dictionnaire))
+
+    limite = request.args.get('limit')
+    apres = request.args.get('after')
+    if limite is None and apres is None:
+        return compression.reponse_json(cle_cache, recuperer_tout)
+
     try:
-        # Supprimer le préfixe data:image/png;base64, si présent
-        if 'base64,' in signature_base64:
-            signature_base64 = signature_base64.split('base64,')[1]
-        
-        # Décoder et sauvegarder
-        signature_binary = base64.b64decode(signature_base64)
-        signature_path = os.path.join(SIGNATURES_FOLDER_PATH, f'{doc_id}.png')
-        
-        with open(signature_path, 'wb') as f:
-            f.write(signature_binary)
-        
-        print(f"Signature sauvegardée: {signature_path}")
-        return True
-    except Exception as e:
-        print(f"Erreur lors de la sauvegarde de la signature: {e}")
-        return False
+        documents, suivant = recuperer_page_documents(categorie, int(limite or 50), apres, dictionnaire)
+    except ValueError:
+        return jsonify({"error": "Paramètres de pagination invalides (limit, after)."}), 400
+    return jsonify({"documents": documents, "next": suivant}), 200
+
+def reponse_json_streaming(elements):
+    """Envoie un tableau JSON élément par élément, regroupés en morceaux d'environ 64 Ko."""
+    def generer():
+        morceau = ['[']
+        taille = 1
+        separateur = ''
+        for element in elements:
+            texte = separateur + flask.json.dumps(element)
+            separateur = ','
+            morceau.append(texte)
+            taille += len(texte)
+            if taille >= TAILLE_MORCEAU_STREAMING:
+                yield ''.join(morceau)
+                morceau = []
+                taille = 0
+        morceau.append(']')
+        yield ''.join(morceau)
+
+    return flask.Response(flask.stream_with_context(generer()), mimetype='application/json')
+
+
+# --- SIGNATURE DES DOCUMENTS (voir signatures) ---
+def signer(ids, source_signature):
+    """
+    Reçoit l'image de signature éventuelle (base64 ou flux PNG) puis signe les documents
+    `ids` en une seule transaction. Retourne (ids signés, None) ou (None, réponse d'erreur).
+    """
+    blob = None
+    if source_signature:
+        try:
+            blob = signatures.recevoir(source_signature, DATA_FOLDER_PATH)
+        except signatures.ErreurSignature as e:
+            return None, (jsonify({"error": str(e)}), 400)
+
+    signes = signer_documents(ids, blob)
+    if signes is False:
+        return None, (jsonify({"error": "Erreur lors de la signature en base de données"}), 500)
+    if blob:
+        # Image ou ancienne signature remplacée : effacée en arrière-plan si plus utilisée
+        ramasse_miettes.reveiller(DATA_FOLDER_PATH)
+    return signes, None
 
 
 # 2. Point d'accès de base
@@ -75,61 +161,306 @@ def api_ajouter_document():
     # Sécurisation du nom de fichier
     filename = secure_filename(f.filename)
 
-    # 1. Sauvegarde physique du fichier dans le dossier /data
-    file_path = os.path.join(DATA_FOLDER_PATH, filename)
-    
+    # 1. Réception du fichier : empreinte SHA-256 calculée pendant l'écriture du fichier temporaire
     try:
-        if not os.path.exists(DATA_FOLDER_PATH):
-            os.makedirs(DATA_FOLDER_PATH) 
-            
-        f.save(file_path) 
-        print(f"✅ Fichier sauvegardé physiquement à: {file_path}")
+        blob = stockage_blobs.recevoir(f.stream, DATA_FOLDER_PATH)
         
     except Exception as e:
-        print(f"🛑 Erreur de sauvegarde du fichier: {e}")
+        log.exception("Erreur de sauvegarde du fichier: %s", e)
         return jsonify({"error": f"Échec de la sauvegarde physique du fichier sur le serveur: {e}"}), 500
 
-    # 2. Enregistrement dans la base de données
-    simulated_path = f"//localhost/data/{filename}" 
-    doc_id = ajouter_document(filename, simulated_path, categorie)
+    # 2. Enregistrement dans la base de données ; le fichier est publié sous son empreinte
+    # (data/blobs/...) dans la même transaction, ou supprimé si ce contenu existe déjà
+    simulated_path = f"//localhost/data/{stockage_blobs.chemin_relatif_blob(blob.sha256)}" 
+    doc_id = ajouter_document(filename, simulated_path, categorie, blob=blob)
     
     if doc_id:
+        apres_ajout_document(doc_id, blob, filename)
         return jsonify({"message": "Document et BDD mis à jour avec succès", "id": doc_id}), 201 
     else:
+        stockage_blobs.abandonner(blob)
         return jsonify({"error": "Erreur lors de l'insertion dans la base de données"}), 500
 
+# Import en lot (multipart) : 'categorie', fichiers 'files' (répétable) et/ou archives ZIP 'archives'
+# -> {"resultats": [{"nom", "id"} ou {"nom", "error"}, ...]} ; 207 si une partie seulement a été importée
+@app.route('/api/documents/ajouter-lot', methods=['POST'])
+def api_ajouter_documents_en_lot():
+    categorie = request.form.get('categorie')
+    if not categorie:
+        return jsonify({"error": "Catégorie manquante."}), 400
+    fichiers = request.files.getlist('files') + request.files.getlist('file')
+    archives = request.files.getlist('archives')
+    if not fichiers and not archives:
+        return jsonify({"error": "Aucun fichier n'a été envoyé."}), 400
+
+    try:
+        resultats, ajoutes = import_lot.importer(DATA_FOLDER_PATH, fichiers, archives, categorie)
+    except import_lot.ErreurLot as e:
+        return jsonify({"error": str(e)}), e.statut
+    except Exception as e:
+        log.exception("Erreur lors de l'import en lot: %s", e)
+        return jsonify({"error": "Erreur interne du serveur lors de l'import"}), 500
+
+    for doc_id, blob, filename in ajoutes:
+        apres_ajout_document(doc_id, blob, filename)
+    if len(ajoutes) == len(resultats):
+        statut = 201
+    else:
+        statut = 207 if ajoutes else 400
+    return jsonify({"resultats": resultats, "ajoutes": len(ajoutes), "echecs": len(resultats) - len(ajoutes)}), statut
+
+def apres_ajout_document(doc_id, blob, filename):
+    """Traitements de fond d'un document qui vient d'être enregistré (upload simple ou par morceaux)."""
+    log.info("Fichier enregistré sous son empreinte: %s", blob.sha256, extra={"doc_id": doc_id, "taille": blob.taille})
+    # Miniature préparée en arrière-plan pour les listes (voir api_miniature_document)
+    miniatures.planifier(DATA_FOLDER_PATH, blob.chemin_final, get_mimetype(filename), blob.sha256)
+    # Texte indexé en arrière-plan pour /api/documents/search
+    extraction_texte.planifier(doc_id, blob.chemin_final, get_mimetype(filename))
+
+# --- UPLOAD REPRENABLE PAR MORCEAUX (voir sessions_upload) ---
+@app.route('/api/uploads', methods=['POST'])
+def api_creer_session_upload():
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('nom_fichier') or '')
+    categorie = data.get('categorie')
+    if not filename or not categorie:
+        return jsonify({"error": "'nom_fichier' et 'categorie' sont requis."}), 400
+    try:
+        session = sessions_upload.creer(DATA_FOLDER_PATH, filename, categorie, data.get('taille'), data.get('sha256'))
+    except sessions_upload.ErreurSession as e:
+        return jsonify({"error": str(e)}), e.statut
+    return jsonify(session), 201
+
+@app.route('/api/uploads/<session_id>', methods=['GET'])
+def api_etat_session_upload(session_id):
+    session = sessions_upload.etat(session_id)
+    if session is None:
+        return jsonify({"error": "Session d'upload inconnue ou expirée."}), 404
+    return jsonify(session), 200
+
+@app.route('/api/uploads/<session_id>', methods=['PUT'])
+def api_morceau_session_upload(session_id):
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({"error": "Paramètre 'offset' invalide."}), 400
+    if request.content_length is None:
+        return jsonify({"error": "En-tête Content-Length requis."}), 411
+    try:
+        # Corps lu directement depuis le flux de la requête, par blocs : jamais chargé en entier
+        session = sessions_upload.ecrire_morceau(DATA_FOLDER_PATH, session_id, offset, request.content_length,
+                                                 request.stream, request.headers.get('X-Chunk-Sha256'))
+    except sessions_upload.ErreurSession as e:
+        return jsonify({"error": str(e)}), e.statut
+    return jsonify(session), 200
+
+@app.route('/api/uploads/<session_id>/valider', methods=['POST'])
+def api_valider_session_upload(session_id):
+    try:
+        doc_id, blob, filename = sessions_upload.valider(DATA_FOLDER_PATH, session_id)
+    except sessions_upload.ErreurSession as e:
+        return jsonify({"error": str(e)}), e.statut
+    apres_ajout_document(doc_id, blob, filename)
+    return jsonify({"message": "Document et BDD mis à jour avec succès", "id": doc_id}), 201
+
+@app.route('/api/uploads/<session_id>', methods=['DELETE'])
+def api_abandonner_session_upload(session_id):
+    if not sessions_upload.abandonner(DATA_FOLDER_PATH, session_id):
+        return jsonify({"error": "Session d'upload inconnue ou en cours de validation."}), 404
+    return jsonify({"message": "Session d'upload abandonnée."}), 200
+
 # 4. Endpoint pour récupérer les documents par catégorie (Méthode GET)
 @app.route('/api/documents/<categorie>', methods=['GET'])
 def api_recuperer_documents(categorie):
-    documents = recuperer_documents_par_categorie(categorie)
-    return jsonify(documents), 200
+    return reponse_liste_documents(categorie, False, lambda: recuperer_documents_par_categorie(categorie),
+                                   ('categorie', categorie))
 
 # Endpoint pour récupérer TOUS les documents
 @app.route('/api/documents/all', methods=['GET'])
 def api_recuperer_tous_documents():
     try:
-        documents = recuperer_tous_documents()
-        return jsonify(documents), 200
+        return reponse_liste_documents(None, True, recuperer_tous_documents, ('tous',))
     except Exception as e:
-        print(f"Erreur lors de la récupération de tous les documents: {e}")
+        log.exception("Erreur lors de la récupération de tous les documents: %s", e)
         return jsonify({"error": "Erreur interne du serveur"}), 500
 
 # Endpoint pour récupérer les 4 documents récents
 @app.route('/api/documents/recents', methods=['GET'])
 def api_recuperer_documents_recents():
     try:
-        documents = recuperer_4_derniers_documents()
-        return jsonify(documents), 200
+        return compression.reponse_json(('recents',), recuperer_4_derniers_documents)
     except Exception as e:
-        print(f"Erreur lors de la récupération des documents récents: {e}")
+        log.exception("Erreur lors de la récupération des documents récents: %s", e)
         return jsonify({"error": "Erreur interne du serveur lors de la récupération des documents récents"}), 500
 
-# Endpoint de diagnostic
+# Endpoint groupé pour le Dashboard : plusieurs catégories en un seul aller-retour
+# ?categorie=A&categorie=B[&limit=10][&signe=0|1] -> {"categories": {"A": {"total": n, "documents": [...]}, ...}}
+NB_CATEGORIES_MAX = 50
+
+@app.route('/api/documents/categories', methods=['GET'])
+def api_recuperer_documents_par_categories():
+    categories = request.args.getlist('categorie')
+    if not categories:
+        return jsonify({"error": "Paramètre 'categorie' manquant."}), 400
+    if len(categories) > NB_CATEGORIES_MAX:
+        return jsonify({"error": f"Au plus {NB_CATEGORIES_MAX} catégories par requête."}), 400
+    try:
+        # limit=0 : uniquement les nombres de documents
+        limite = max(0, min(int(request.args.get('limit', 10)), 100))
+    except ValueError:
+        return jsonify({"error": "Paramètre 'limit' invalide."}), 400
+    signe = request.args.get('signe')
+    signe = None if signe is None else signe in ('1', 'true')
+    
+    try:
+        resultat = recuperer_documents_par_categories(categories, limite, signe)
+        return jsonify({"categories": resultat}), 200
+    except Exception as e:
+        log.exception("Erreur lors de la récupération groupée des catégories: %s", e)
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
+# Compteurs (total, signés, non signés) globaux et par catégorie, tenus à jour par triggers
+@app.route('/api/documents/stats', methods=['GET'])
+def api_statistiques_documents():
+    try:
+        return jsonify(statistiques.lire()), 200
+    except Exception as e:
+        log.exception("Erreur lors de la lecture des statistiques: %s", e)
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
+# Endpoint de recherche plein texte : ?q=...&limit=20&offset=0[&categorie=...][&signe=0|1]
+@app.route('/api/documents/search', methods=['GET'])
+def api_rechercher_documents():
+    recherche = request.args.get('q', '').strip()
+    if not recherche:
+        return jsonify({"error": "Paramètre 'q' manquant."}), 400
+    try:
+        limite = max(1, min(int(request.args.get('limit', 20)), 100))
+        decalage = max(0, int(request.args.get('offset', 0)))
+        signe = request.args.get('signe')
+        signe = None if signe is None else signe in ('1', 'true')
+    except ValueError:
+        return jsonify({"error": "Paramètres de pagination invalides (limit, offset)."}), 400
+    
+    try:
+        documents, total = rechercher_documents(recherche, limite, decalage, request.args.get('categorie'), signe)
+        suivant = decalage + limite if decalage + limite < total else None
+        return jsonify({"documents": documents, "total": total, "next": suivant}), 200
+    except Exception as e:
+        log.exception("Erreur lors de la recherche '%s': %s", recherche, e)
+        return jsonify({"error": "Erreur interne du serveur lors de la recherche"}), 500
+
+# Endpoint de diagnostic : compare le dossier de données et la base, sans rien modifier
+# (?complet=1 : relit la taille de tous les fichiers, voir reconciliation)
 @app.route('/api/documents/diagnostiquer-fichiers', methods=['GET'])
 def api_diagnostiquer_fichiers():
-    diagnostic_result = diagnostiquer_fichiers_locaux(DATA_FOLDER_PATH)
+    try:
+        diagnostic_result = reconciliation.reconcilier(DATA_FOLDER_PATH, rapide=request.args.get('complet') != '1')
+    except Exception as e:
+        log.exception("Erreur lors du diagnostic des fichiers : %s", e)
+        diagnostic_result = {"dossier_recherche": DATA_FOLDER_PATH, "statut": f"ERREUR INCONNUE: {str(e)}"}
     return jsonify(diagnostic_result), 200
 
+# Endpoint de réparation : {"supprimer_manquants": true} supprime aussi les documents sans fichier
+# ; {"complet": true} comme ?complet=1 ci-dessus
+@app.route('/api/documents/reconcilier', methods=['POST'])
+def api_reconcilier():
+    data = request.get_json(silent=True) or {}
+    try:
+        rapport = reconciliation.reconcilier(DATA_FOLDER_PATH, reparer=True,
+                                             supprimer_manquants=data.get('supprimer_manquants') is True,
+                                             rapide=data.get('complet') is not True)
+    except Exception as e:
+        log.exception("Erreur lors de la réconciliation : %s", e)
+        return jsonify({"error": "Erreur interne du serveur lors de la réconciliation"}), 500
+    if rapport.get("reparation"):
+        ramasse_miettes.reveiller(DATA_FOLDER_PATH)
+    return jsonify(rapport), 200 if rapport["statut"] == "SUCCÈS" else 500
+
+# Export ZIP : GET ?tous=1, ?categorie=... ou ?ids=1,2,3 (POST : mêmes clés en JSON, ids en liste)
+# ; signatures=1 ajoute les signatures. L'archive est construite pendant l'envoi.
+@app.route('/api/documents/export', methods=['GET', 'POST'])
+def api_exporter_documents():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        categorie = data.get('categorie')
+        tous = data.get('tous') is True
+        avec_signatures = data.get('signatures') is True
+    else:
+        try:
+            ids = [int(i) for i in request.args['ids'].split(',') if i.strip()] if 'ids' in request.args else None
+        except ValueError:
+            ids = 'invalide'
+        categorie = request.args.get('categorie')
+        tous = request.args.get('tous') in ('1', 'true')
+        avec_signatures = request.args.get('signatures') in ('1', 'true')
+
+    if not tous and categorie is None and not ids:
+        return jsonify({"error": "Précisez 'tous', 'categorie' ou 'ids'."}), 400
+    if ids is not None and (not isinstance(ids, list) or not all(isinstance(i, int) for i in ids)):
+        return jsonify({"error": "'ids' doit être une liste d'entiers."}), 400
+
+    nom_archive = f"documents-{secure_filename(categorie) or 'export'}.zip" if categorie else "documents.zip"
+    response = flask.Response(
+        flask.stream_with_context(export_zip.generer_archive(DATA_FOLDER_PATH, categorie, ids or None, avec_signatures)),
+        mimetype='application/zip',
+    )
+    response.headers.set('Content-Disposition', 'attachment', filename=nom_archive)
+    # Construite à la demande, reflète l'état de la base au moment de l'export
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Modifications depuis la séquence N : ?depuis=N[&limit=500]
+# -> {"modifications": [...], "dernier": seq, "suite": bool} ; sans depuis, seulement "dernier"
+@app.route('/api/documents/modifications', methods=['GET'])
+def api_modifications():
+    try:
+        if request.args.get('depuis') is None:
+            return jsonify({"modifications": [], "dernier": modifications.derniere_sequence(), "suite": False}), 200
+        try:
+            depuis = int(request.args['depuis'])
+            limite = max(1, min(int(request.args.get('limit', modifications.TAILLE_LOT)), TAILLE_PAGE_MAX))
+        except ValueError:
+            return jsonify({"error": "Paramètres invalides (depuis, limit)."}), 400
+
+        elements, derniere = modifications.lire(depuis, limite)
+        if elements is None:
+            # Journal purgé ou base recréée : le client relit les listes complètes
+            return jsonify({"error": "Modifications plus disponibles, relisez les listes.",
+                            "reinitialiser": True, "dernier": derniere}), 410
+        dernier = elements[-1]["seq"] if elements else depuis
+        return jsonify({"modifications": elements, "dernier": dernier, "suite": dernier < derniere}), 200
+    except Exception as e:
+        log.exception("Erreur lors de la lecture des modifications: %s", e)
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
+# Flux SSE des modifications (EventSource) ; reprise par Last-Event-ID ou ?depuis=N
+@app.route('/api/documents/modifications/flux', methods=['GET'])
+def api_flux_modifications():
+    depuis = request.headers.get('Last-Event-ID') or request.args.get('depuis')
+    try:
+        depuis = int(depuis) if depuis else None
+    except ValueError:
+        return jsonify({"error": "Paramètre 'depuis' invalide."}), 400
+    # En production, les flux sont servis par serveur_sse, sans occuper un thread de requête ;
+    # la position est passée dans l'URL (EventSource ne renvoie pas Last-Event-ID après une redirection)
+    url_sse = serveur_sse.url_redirection(request.scheme, request.host, depuis)
+    if url_sse:
+        return flask.redirect(url_sse, 307)
+    try:
+        modifications.reserver_abonnement()
+    except modifications.ErreurAbonnement as e:
+        # Le client peut se rabattre sur /api/documents/modifications
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "30"}
+
+    response = flask.Response(flask.stream_with_context(modifications.flux(depuis)), mimetype='text/event-stream')
+    response.call_on_close(modifications.liberer_abonnement)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Pas de mise en tampon par un proxy nginx
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 # --- ENDPOINT FINAL POUR CONSULTER LE FICHIER (CORRIGÉ POUR SÉCURITÉ) ---
 @app.route('/api/documents/ouvrir/<filename>', methods=['GET'])
 def api_ouvrir_document(filename):
@@ -140,36 +471,28 @@ def api_ouvrir_document(filename):
         # Décodage de l'URL pour gérer les espaces (%20)
         decoded_filename = urllib.parse.unquote(filename)
         
-        full_path = os.path.join(DATA_FOLDER_PATH, decoded_filename)
+        full_path, sha256 = emplacement_fichier(recuperer_document_par_nom(decoded_filename), decoded_filename)
         
-        print(f"\n--- DEBUG D'OUVERTURE ---")
-        print(f"Fichier demandé (décodé) : {decoded_filename}")
-        
-        if not os.path.exists(full_path):
-            print(f"ERREUR PHYSIQUE: Fichier introuvable à : {full_path}")
-            abort(404) 
+        if not full_path or not os.path.exists(full_path):
+            log.warning("Fichier introuvable à : %s", full_path, extra={"fichier": decoded_filename})
+            return jsonify({"error": "Fichier non trouvé"}), 404
 
-        print(f"Fichier trouvé : Tentative d'envoi.")
+        log.debug("Ouverture du document : %s", full_path, extra={"fichier": decoded_filename})
         
-        # Utilise send_from_directory pour servir le fichier
-        response = send_from_directory(
-            directory=DATA_FOLDER_PATH,
-            path=decoded_filename, # Utilise le nom décodé
-            as_attachment=False,
-            mimetype=get_mimetype(decoded_filename)
-        )
+        # Le nom peut désigner un autre contenu après un nouvel upload : pas de cache
+        # longue durée, mais revalidation par ETag (304) et plages d'octets
+        response = servir_fichier(full_path, get_mimetype(decoded_filename), sha256)
         
         # 🚨 CORRECTION CRITIQUE : Supprime les en-têtes de sécurité qui bloquent l'iFrame
-        # Les en-têtes sont ajoutés à l'objet 'response' retourné par send_from_directory
+        # Les en-têtes sont ajoutés à l'objet 'response' retourné par servir_fichier
         response.headers['X-Frame-Options'] = 'ALLOWALL'
         response.headers['Content-Security-Policy'] = "frame-ancestors 'self' http://localhost:* https://localhost:*;"
         
-        print(f"-------------------------\n")
         return response
     
     except Exception as e:
         # Gère les erreurs internes
-        print(f"Erreur générale lors de l'ouverture du document {filename}: {e}")
+        log.exception("Erreur générale lors de l'ouverture du document %s: %s", filename, e)
         return jsonify({"error": f"Erreur interne du serveur lors de l'ouverture: {e}"}), 500
 
 
@@ -177,38 +500,71 @@ def api_ouvrir_document(filename):
 @app.route('/api/documents/<int:doc_id>/sign', methods=['PUT'])
 def api_marquer_document_signe(doc_id):
     try:
-        data = request.get_json() or {}
-        signature_data = data.get('signatureData')
-        
-        # Marquer le document comme signé
-        if marquer_document_signe(doc_id):
-            # Sauvegarder la signature si fournie
-            if signature_data:
-                save_signature(doc_id, signature_data)
+        data = request.get_json(silent=True) or {}
+        signes, erreur = signer([doc_id], data.get('signatureData'))
+        if erreur:
+            return erreur
+        if signes:
             return jsonify({"message": f"Document ID {doc_id} marqué comme signé."}), 200
         else:
             return jsonify({"error": f"Impossible de mettre à jour le document ID {doc_id}."}), 404
     except Exception as e:
-        print(f"Erreur lors de la signature du document: {e}")
+        log.exception("Erreur lors de la signature du document: %s", e)
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
+# Signature en masse, une seule transaction : {"ids": [1, 2, ...], "signatureData": "data:image/png;base64,..."}
+# ou multipart (champ 'ids' = "1,2,3", fichier PNG 'signature') -> {"signes": [...], "introuvables": [...]}
+@app.route('/api/documents/signer', methods=['POST'])
+def api_signer_documents():
+    if request.mimetype == 'multipart/form-data':
+        try:
+            ids = [int(i) for valeur in request.form.getlist('ids') for i in valeur.split(',') if i.strip()]
+        except ValueError:
+            ids = None
+        source = request.files['signature'].stream if 'signature' in request.files else None
+    else:
+        data = request.get_json(silent=True) or {}
+        ids = data.get('ids')
+        source = data.get('signatureData')
+        if source is not None and not isinstance(source, str):
+            return jsonify({"error": "'signatureData' doit être une chaîne base64."}), 400
+
+    if not ids or not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        return jsonify({"error": "'ids' doit être une liste non vide d'entiers."}), 400
+
+    try:
+        signes, erreur = signer(ids, source)
+    except Exception as e:
+        log.exception("Erreur lors de la signature de %s document(s): %s", len(ids), e)
         return jsonify({"error": "Erreur interne du serveur"}), 500
+    if erreur:
+        return erreur
+    resultat = {"signes": signes, "introuvables": sorted(set(ids) - set(signes))}
+    return jsonify(resultat), 200 if signes else 404
 
 # Endpoint pour récupérer la signature d'un document
 @app.route('/api/documents/<int:doc_id>/signature', methods=['GET'])
 def api_get_signature(doc_id):
     try:
-        signature_path = os.path.join(SIGNATURES_FOLDER_PATH, f'{doc_id}.png')
-        if os.path.exists(signature_path):
-            return send_file(signature_path, mimetype='image/png')
-        else:
+        document = recuperer_document_par_id(doc_id)
+        chemin, sha256 = signatures.emplacement(DATA_FOLDER_PATH, doc_id, document.get('signature_sha256')) \
+            if document else (None, None)
+        if not chemin:
             return jsonify({"error": "Signature not found"}), 404
+        # Une nouvelle signature change le contenu de cette URL : revalidation par ETag
+        return servir_fichier(chemin, 'image/png', sha256)
+    except FileNotFoundError:
+        return jsonify({"error": "Signature not found"}), 404
     except Exception as e:
-        print(f"Erreur lors de la récupération de la signature: {e}")
+        log.exception("Erreur lors de la récupération de la signature: %s", e)
         return jsonify({"error": "Erreur interne du serveur"}), 500
 
 # 6. Endpoint pour supprimer un document (Méthode DELETE)
 @app.route('/api/documents/<int:doc_id>', methods=['DELETE'])
 def api_supprimer_document(doc_id):
     if supprimer_document(doc_id):
+        # Un blob qui n'est plus référencé est effacé en arrière-plan
+        ramasse_miettes.reveiller(DATA_FOLDER_PATH)
         return jsonify({"message": f"Document ID {doc_id} supprimé."}), 200
     else:
         return jsonify({"error": f"Impossible de supprimer le document ID {doc_id}. Introuvable ou erreur interne."}), 404
@@ -217,23 +573,37 @@ def api_supprimer_document(doc_id):
 @app.route('/api/documents', methods=['DELETE'])
 def api_supprimer_tous_documents():
     try:
-        # Récupérer tous les documents
-        from gestion_db import recuperer_tous_documents, supprimer_document
-        documents = recuperer_tous_documents()
-        
-        # Supprimer chaque fichier du dossier /data
-        for doc in documents:
-            file_path = os.path.join(DATA_FOLDER_PATH, doc.get('nom_fichier'))
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            # Supprimer de la base de données
-            supprimer_document(doc.get('id'))
+        # Une seule transaction ; les fichiers sont effacés en arrière-plan par le ramasse-miettes
+        nb_supprimes = supprimer_documents_en_masse(tous=True)
+        if nb_supprimes is False:
+            return jsonify({"error": "Erreur lors de la suppression en base de données"}), 500
         
-        return jsonify({"message": "Tous les documents ont été supprimés"}), 200
+        ramasse_miettes.reveiller(DATA_FOLDER_PATH)
+        return jsonify({"message": "Tous les documents ont été supprimés", "supprimes": nb_supprimes}), 200
     except Exception as e:
-        print(f"Erreur lors de la suppression de tous les documents: {e}")
+        log.exception("Erreur lors de la suppression de tous les documents: %s", e)
         return jsonify({"error": f"Erreur lors de la suppression: {e}"}), 500
 
+# Endpoint de suppression en masse : {"tous": true}, {"categorie": "..."} ou {"ids": [1, 2, ...]}
+@app.route('/api/documents/supprimer', methods=['POST'])
+def api_supprimer_documents_en_masse():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    categorie = data.get('categorie')
+    tous = data.get('tous') is True
+    
+    if not tous and categorie is None and not ids:
+        return jsonify({"error": "Précisez 'tous', 'categorie' ou 'ids'."}), 400
+    if ids is not None and (not isinstance(ids, list) or not all(isinstance(i, int) for i in ids)):
+        return jsonify({"error": "'ids' doit être une liste d'entiers."}), 400
+    
+    nb_supprimes = supprimer_documents_en_masse(ids=ids, categorie=categorie, tous=tous)
+    if nb_supprimes is False:
+        return jsonify({"error": "Erreur lors de la suppression en base de données"}), 500
+    
+    ramasse_miettes.reveiller(DATA_FOLDER_PATH)
+    return jsonify({"message": f"{nb_supprimes} document(s) supprimé(s).", "supprimes": nb_supprimes}), 200
+
 # 8. Endpoint pour prévisualiser un document
 @app.route('/api/documents/preview/<int:doc_id>')
 def api_preview_document(doc_id):
@@ -247,51 +617,110 @@ def api_preview_document(doc_id):
         if not document or not document.get('nom_fichier'):
             return jsonify({"error": "Document non trouvé"}), 404
         
-        # Utiliser le chemin absolu dans le dossier data
+        # Utiliser le chemin absolu dans le dossier data (blob ou ancien fichier nommé)
         filename = document.get('nom_fichier')
-        file_path = os.path.join(DATA_FOLDER_PATH, filename)
+        file_path, sha256 = emplacement_fichier(document, filename)
         
         # Vérifier que le fichier existe
-        if not os.path.exists(file_path):
-            print(f"Fichier non trouvé à: {file_path}")
+        if not file_path or not os.path.exists(file_path):
+            log.warning("Fichier non trouvé à: %s", file_path, extra={"doc_id": doc_id})
             return jsonify({"error": "Fichier non trouvé"}), 404
         
         # Déterminer le MIME type
         mimetype = get_mimetype(filename)
         
-        print(f"Servant le document: {file_path} (MIME: {mimetype})")
+        log.debug("Servant le document: %s (MIME: %s)", file_path, mimetype)
         
-        # Retourner le fichier avec les bons headers CORS
-        response = send_from_directory(
-            DATA_FOLDER_PATH, 
-            filename,
-            mimetype=mimetype
-        )
+        # Un document désigne toujours le même blob : mise en cache longue durée,
+        # réponses 206 sur Range et 304 sur If-None-Match
+        response = servir_fichier(file_path, mimetype, sha256, immuable=True)
         
         # Ajouter les headers CORS pour que react-pdf puisse charger
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range'
-        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range, If-None-Match, If-Range'
+        response.headers['Access-Control-Expose-Headers'] = 'Accept-Ranges, Content-Range, Content-Length, ETag'
         
         return response
     except Exception as e:
-        print(f"Erreur lors de la récupération du document: {e}")
+        log.exception("Erreur lors de la récupération du document: %s", e)
         return jsonify({"error": str(e)}), 500
 
+# Endpoint de miniature : première page d'un PDF ou image réduite, en JPEG
+@app.route('/api/documents/<int:doc_id>/miniature', methods=['GET'])
+def api_miniature_document(doc_id):
+    try:
+        document = recuperer_document_par_id(doc_id)
+        if not document:
+            return jsonify({"error": "Document non trouvé"}), 404
+        
+        filename = document.get('nom_fichier')
+        mimetype = get_mimetype(filename)
+        file_path, sha256 = emplacement_fichier(document, filename)
+        if not file_path or not os.path.exists(file_path) or not miniatures.est_disponible(mimetype):
+            return jsonify({"error": "Miniature indisponible pour ce document"}), 404
+        
+        cle = miniatures.cle_miniature(file_path, sha256)
+        chemin_miniature = miniatures.obtenir(DATA_FOLDER_PATH, cle)
+        if chemin_miniature is None:
+            # Pas encore en cache (upload récent, éviction) : génération en arrière-plan,
+            # le client réessaie sans qu'un thread de requête attende le rendu
+            futur = miniatures.planifier(DATA_FOLDER_PATH, file_path, mimetype, cle)
+            if futur is None or (futur.done() and futur.result() is None):
+                return jsonify({"error": "Miniature indisponible pour ce document"}), 404
+            if not futur.done():
+                return jsonify({"message": "Miniature en cours de génération"}), 202, {'Retry-After': '1'}
+            chemin_miniature = futur.result()
+        
+        # La miniature d'un blob ne change jamais : cache longue durée
+        return servir_fichier(chemin_miniature, 'image/jpeg', f"{cle}-{miniatures.TAILLE_MAX_PIXELS}", immuable=bool(sha256))
+    except Exception as e:
+        log.exception("Erreur lors de la récupération de la miniature: %s", e)
+        return jsonify({"error": "Erreur interne du serveur"}), 500
+
 # 9. Endpoint pour servir directement les fichiers du dossier data
 @app.route('/api/documents/file/<filename>')
 def serve_document_file(filename):
     """Sert les fichiers du dossier data"""
     try:
-        return send_from_directory(DATA_FOLDER_PATH, filename)
+        file_path, sha256 = emplacement_fichier(recuperer_document_par_nom(filename), filename)
+        if not file_path:
+            return jsonify({"error": "Fichier non trouvé"}), 404
+        return servir_fichier(file_path, get_mimetype(filename), sha256)
     except Exception as e:
-        print(f"Erreur lors de la lecture du fichier: {e}")
+        log.exception("Erreur lors de la lecture du fichier: %s", e)
         return jsonify({"error": "Fichier non trouvé"}), 404
 
-# 7. Lancement du serveur
+# 7. Services de fond et lancement du serveur
+def demarrer_services(rattrapage=True):
+    """
+    Démarre les threads de fond du processus courant. Avec un serveur à plusieurs
+    processus (voir gunicorn.conf.py), à appeler dans chaque worker après le fork ;
+    `rattrapage` n'est alors activé que dans un seul worker.
+    """
+    # Reprend les effacements de fichiers laissés en attente par un arrêt précédent
+    ramasse_miettes.demarrer(DATA_FOLDER_PATH)
+    if rattrapage:
+        # Indexe le texte des documents pas encore traités (uploads antérieurs, arrêt en cours d'extraction)
+        extraction_texte.demarrer_rattrapage(DATA_FOLDER_PATH, get_mimetype)
+
+def arreter_services():
+    """Arrête les threads et pools de fond puis ferme les connexions SQLite du processus."""
+    ramasse_miettes.arreter()
+    modifications.arreter()
+    import_lot.arreter()
+    miniatures.arreter()
+    extraction_texte.arreter()
+    fermer_connexions()
+
 if __name__ == '__main__':
+    # Serveur de développement (rechargement automatique, débogueur) ; en production,
+    # utiliser serveur_production.py
     initialiser_base_de_donnees()
-    print(f"\n[INFO] Dossier de documents configuré : {DATA_FOLDER_PATH}\n")
+    # Instantanés de métriques d'une exécution précédente (si FORMULAMA_METRIQUES_DOSSIER est défini)
+    metriques.reinitialiser_dossier()
+    demarrer_services()
+    atexit.register(arreter_services)
+    log.info("Dossier de documents configuré : %s", DATA_FOLDER_PATH)
     # Lancement du serveur Flask sur le port 5001
-    app.run(debug=True, host="0.0.0.0", port=5001)
\ No newline at end of file
+    app.run(debug=True, host="0.0.0.0", port=5001)
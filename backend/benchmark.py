@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+Banc de mesure de l'API documents, sans réseau : l'application Flask réelle est
+appelée par son client de test, sur un corpus synthétique généré dans un dossier
+de données temporaire (FORMULAMA_DATA_DIR).
+
+Le corpus (--lignes, de 1 000 à 1 000 000 de documents) référence un petit jeu
+de PDF et d'images générés, comme après des uploads. Chaque scénario enchaîne
+--requetes appels et le résultat (débit, latences p50/p95/p99) est écrit en JSON,
+pour comparer deux versions de gestion_db / app_server d'une exécution à l'autre.
+
+Utilisation :
+    python benchmark.py --lignes 100000 --requetes 500 --sortie resultats.json
+    python benchmark.py --scenarios recents,preview_plage --dossier /tmp/corpus --conserver
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+CATEGORIES = ['contrats', 'factures', 'devis', 'rh', 'juridique', 'comptabilite', 'archives', 'divers']
+NB_FICHIERS_EXEMPLES = 16
+TAILLE_LOT_INSERTION = 50000
+# Durée couverte par les dates d'ajout du corpus
+PERIODE_S = 365 * 24 * 3600
+
+
+# --- FICHIERS D'EXEMPLE ---
+
+def pdf_exemple(numero, taille):
+    """PDF valide d'une page, complété par un flux de remplissage jusqu'à `taille` octets environ."""
+    texte = f"BT /F1 24 Tf 72 720 Td (Document de test {numero}) Tj ET".encode('ascii')
+    remplissage = random.Random(numero).randbytes(max(0, taille - 700))
+    objets = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+        b"/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(texte), texte),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(remplissage), remplissage),
+    ]
+    contenu = bytearray(b"%PDF-1.4\n")
+    positions = []
+    for index, objet in enumerate(objets, start=1):
+        positions.append(len(contenu))
+        contenu += b"%d 0 obj\n%s\nendobj\n" % (index, objet)
+    debut_xref = len(contenu)
+    contenu += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objets) + 1)
+    contenu += b"".join(b"%010d 00000 n \n" % position for position in positions)
+    contenu += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objets) + 1, debut_xref)
+    return bytes(contenu)
+
+
+def png_exemple(numero, cote=256):
+    """Image PNG RVB (dégradé) générée sans dépendance."""
+    lignes = bytearray()
+    for y in range(cote):
+        lignes.append(0)
+        for x in range(cote):
+            lignes += bytes(((x + numero * 16) % 256, (y * 2) % 256, (x + y) % 256))
+
+    def bloc(type_bloc, donnees):
+        return (struct.pack(">I", len(donnees)) + type_bloc + donnees
+                + struct.pack(">I", zlib.crc32(type_bloc + donnees) & 0xffffffff))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + bloc(b"IHDR", struct.pack(">IIBBBBB", cote, cote, 8, 2, 0, 0, 0))
+            + bloc(b"IDAT", zlib.compress(bytes(lignes), 6))
+            + bloc(b"IEND", b""))
+
+
+# --- CORPUS ---
+
+def generer_corpus(nb_lignes, taille_pdf, graine):
+    """
+    Enregistre les fichiers d'exemple (comme des uploads) puis insère `nb_lignes`
+    documents qui les référencent, par lots d'une transaction. Retourne la durée.
+    """
+    import gestion_db
+    import stockage_blobs
+    from connexion_db import transaction
+
+    debut = time.perf_counter()
+    dossier = os.path.dirname(gestion_db.DB_NAME)
+    exemples = []
+    for numero in range(NB_FICHIERS_EXEMPLES):
+        if numero % 2 == 0:
+            nom, contenu = f"exemple-{numero}.pdf", pdf_exemple(numero, taille_pdf)
+        else:
+            nom, contenu = f"exemple-{numero}.png", png_exemple(numero)
+        blob = stockage_blobs.recevoir(io.BytesIO(contenu), dossier)
+        gestion_db.ajouter_document(nom, f"//localhost/data/{stockage_blobs.chemin_relatif_blob(blob.sha256)}",
+                                    CATEGORIES[numero % len(CATEGORIES)], blob=blob)
+        exemples.append((nom, blob.sha256))
+
+    rng = random.Random(graine)
+    maintenant = int(time.time())
+    restant = nb_lignes - len(exemples)
+    numero = 0
+    while restant > 0:
+        lot = []
+        for _ in range(min(TAILLE_LOT_INSERTION, restant)):
+            nom, sha256 = exemples[numero % len(exemples)]
+            extension = nom.rsplit('.', 1)[1]
+            lot.append((
+                f"document-{numero}.{extension}",
+                f"//localhost/data/{stockage_blobs.chemin_relatif_blob(sha256)}",
+                rng.choice(CATEGORIES),
+                maintenant - rng.randrange(PERIODE_S),
+                1 if rng.random() < 0.3 else 0,
+                sha256,
+            ))
+            numero += 1
+        with transaction(gestion_db.DB_NAME) as cursor:
+            # texte_extrait = 1 : pas de rattrapage de l'extraction pour le corpus
+            cursor.executemany("""
+                INSERT INTO documents (nom_fichier, chemin_local, categorie, date_ajout, is_signed, sha256, texte_extrait)
+                VALUES (?, ?, ?, ?, ?, ?, 1)
+            """, lot)
+        restant -= len(lot)
+    return time.perf_counter() - debut
+
+
+# --- SCÉNARIOS ---
+
+class Contexte:
+    """État partagé par les scénarios : client de test, identifiants existants, générateur aléatoire."""
+
+    def __init__(self, client, graine, taille_pdf):
+        import gestion_db
+        from connexion_db import lecture
+
+        self.client = client
+        self.rng = random.Random(graine)
+        self.taille_pdf = taille_pdf
+        self.numero_upload = 0
+        self.curseur = None
+        with lecture(gestion_db.DB_NAME) as cursor:
+            cursor.execute("SELECT id FROM documents")
+            self.ids = [ligne[0] for ligne in cursor]
+        with lecture(gestion_db.DB_NAME) as cursor:
+            cursor.execute("SELECT id FROM documents WHERE nom_fichier LIKE '%.pdf' LIMIT 10000")
+            self.ids_pdf = [ligne[0] for ligne in cursor]
+        self.signature = "data:image/png;base64," + base64.b64encode(png_exemple(0, 64)).decode('ascii')
+
+
+def upload(ctx):
+    ctx.numero_upload += 1
+    contenu = pdf_exemple(1000000 + ctx.numero_upload, ctx.taille_pdf)
+    return ctx.client.post('/api/documents/ajouter', content_type='multipart/form-data', data={
+        'file': (io.BytesIO(contenu), f"upload-{ctx.numero_upload}.pdf"),
+        'categorie': ctx.rng.choice(CATEGORIES),
+    })
+
+
+def liste_categorie(ctx):
+    return ctx.client.get(f"/api/documents/{ctx.rng.choice(CATEGORIES)}")
+
+
+def liste_paginee(ctx):
+    # Parcourt les pages de /all en suivant le curseur, puis recommence au début
+    url = "/api/documents/all?limit=50" + (f"&after={ctx.curseur}" if ctx.curseur else "")
+    reponse = ctx.client.get(url)
+    if reponse.status_code == 200:
+        ctx.curseur = (reponse.get_json() or {}).get('next')
+    return reponse
+
+
+def categories(ctx):
+    parametres = "&".join(f"categorie={categorie}" for categorie in CATEGORIES)
+    return ctx.client.get(f"/api/documents/categories?limit=10&{parametres}")
+
+
+def recents(ctx):
+    return ctx.client.get("/api/documents/recents")
+
+
+def recherche(ctx):
+    return ctx.client.get(f"/api/documents/search?q=document-{ctx.rng.randrange(1000)}")
+
+
+def preview_plage(ctx):
+    debut = ctx.rng.randrange(max(1, ctx.taille_pdf - 65536))
+    return ctx.client.get(f"/api/documents/preview/{ctx.rng.choice(ctx.ids_pdf)}",
+                          headers={'Range': f"bytes={debut}-{debut + 65535}"})
+
+
+def signature(ctx):
+    return ctx.client.put(f"/api/documents/{ctx.rng.choice(ctx.ids)}/sign",
+                          json={'signatureData': ctx.signature})
+
+
+def suppression_masse(ctx):
+    ids = [ctx.ids.pop(ctx.rng.randrange(len(ctx.ids))) for _ in range(min(10, len(ctx.ids)))]
+    return ctx.client.post('/api/documents/supprimer', json={'ids': ids})
+
+
+# Dans l'ordre d'exécution : les suppressions en dernier
+SCENARIOS = {
+    'upload': upload,
+    'liste_categorie': liste_categorie,
+    'liste_paginee': liste_paginee,
+    'categories': categories,
+    'recents': recents,
+    'recherche': recherche,
+    'preview_plage': preview_plage,
+    'signature': signature,
+    'suppression_masse': suppression_masse,
+}
+
+
+def centile(latences_triees, proportion):
+    """Centile par rang le plus proche, en millisecondes."""
+    if not latences_triees:
+        return None
+    rang = max(0, min(len(latences_triees) - 1, round(proportion * len(latences_triees)) - 1))
+    return round(latences_triees[rang] * 1000, 3)
+
+
+def executer(scenario, ctx, nb_requetes, echauffement):
+    for _ in range(echauffement):
+        scenario(ctx).close()
+    latences = []
+    erreurs = 0
+    debut = time.perf_counter()
+    for _ in range(nb_requetes):
+        t0 = time.perf_counter()
+        reponse = scenario(ctx)
+        # Le corps est lu en entier : les réponses en streaming sont mesurées jusqu'au bout
+        reponse.get_data()
+        latences.append(time.perf_counter() - t0)
+        if reponse.status_code >= 400:
+            erreurs += 1
+        reponse.close()
+    duree = time.perf_counter() - debut
+    latences.sort()
+    return {
+        "requetes": nb_requetes,
+        "erreurs": erreurs,
+        "duree_s": round(duree, 3),
+        "debit_req_s": round(nb_requetes / duree, 1) if duree else None,
+        "p50_ms": centile(latences, 0.50),
+        "p95_ms": centile(latences, 0.95),
+        "p99_ms": centile(latences, 0.99),
+        "max_ms": round(latences[-1] * 1000, 3) if latences else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de mesure de l'API documents (client de test Flask).")
+    parser.add_argument("--lignes", type=int, default=10000, help="documents du corpus (1 000 à 1 000 000)")
+    parser.add_argument("--requetes", type=int, default=200, help="appels mesurés par scénario")
+    parser.add_argument("--echauffement", type=int, default=10, help="appels non mesurés avant chaque scénario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="scénarios à exécuter, séparés par des virgules")
+    parser.add_argument("--taille-pdf", type=int, default=256 * 1024, help="taille des PDF d'exemple (octets)")
+    parser.add_argument("--graine", type=int, default=42, help="graine aléatoire (corpus et requêtes)")
+    parser.add_argument("--dossier", help="dossier de données à utiliser (réutilisé s'il contient déjà un corpus)")
+    parser.add_argument("--conserver", action="store_true", help="ne pas supprimer le dossier de données")
+    parser.add_argument("--sortie", help="fichier JSON de résultats (sinon sortie standard)")
+    args = parser.parse_args()
+
+    noms = [nom.strip() for nom in args.scenarios.split(",") if nom.strip()]
+    inconnus = [nom for nom in noms if nom not in SCENARIOS]
+    if inconnus:
+        parser.error(f"scénarios inconnus : {', '.join(inconnus)} (disponibles : {', '.join(SCENARIOS)})")
+
+    dossier = args.dossier or tempfile.mkdtemp(prefix="formulama-bench-")
+    os.makedirs(dossier, exist_ok=True)
+    # Avant tout import des modules du serveur : ils lisent ces variables au chargement
+    os.environ["FORMULAMA_DATA_DIR"] = dossier
+    os.environ.setdefault("FORMULAMA_LOG_NIVEAU", "WARNING")
+    os.environ.pop("FORMULAMA_METRIQUES_DOSSIER", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import app_server
+    import gestion_db
+    from connexion_db import lecture
+
+    try:
+        gestion_db.initialiser_base_de_donnees()
+        with lecture(gestion_db.DB_NAME) as cursor:
+            cursor.execute("SELECT COUNT(*) FROM documents")
+            existants = cursor.fetchone()[0]
+        duree_generation = None
+        if existants == 0:
+            duree_generation = round(generer_corpus(args.lignes, args.taille_pdf, args.graine), 3)
+            existants = args.lignes
+
+        ctx = Contexte(app_server.app.test_client(), args.graine, args.taille_pdf)
+        resultats = {}
+        for nom in SCENARIOS:
+            if nom in noms:
+                resultats[nom] = executer(SCENARIOS[nom], ctx, args.requetes, args.echauffement)
+                print(f"{nom:<18} {resultats[nom]['debit_req_s']:>9} req/s  "
+                      f"p50 {resultats[nom]['p50_ms']} ms  p99 {resultats[nom]['p99_ms']} ms", file=sys.stderr)
+
+        rapport = {
+            "parametres": {
+                "lignes": existants,
+                "requetes": args.requetes,
+                "echauffement": args.echauffement,
+                "taille_pdf": args.taille_pdf,
+                "graine": args.graine,
+            },
+            "environnement": {
+                "python": platform.python_version(),
+                "sqlite": __import__('sqlite3').sqlite_version,
+                "plateforme": platform.platform(),
+                "processeurs": os.cpu_count(),
+            },
+            "corpus": {"duree_generation_s": duree_generation, "dossier": dossier},
+            "scenarios": resultats,
+        }
+        texte = json.dumps(rapport, ensure_ascii=False, indent=2)
+        if args.sortie:
+            with open(args.sortie, 'w', encoding='utf-8') as fichier:
+                fichier.write(texte + "\n")
+        else:
+            print(texte)
+    finally:
+        app_server.arreter_services()
+        if not args.conserver and not args.dossier:
+            shutil.rmtree(dossier, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Cache en mémoire des requêtes de liste (récents, par catégorie, tous les documents).
+
+Chaque résultat est mémorisé avec la « génération » de la base au moment de la
+lecture. La génération est un compteur stocké en base (table generation_cache),
+incrémenté par triggers dans la transaction même de chaque écriture sur 'documents' :
+elle est donc commune à tous les processus. Pour ne pas la relire à chaque appel,
+on s'appuie sur PRAGMA data_version, qui ne change que lorsqu'une autre connexion
+a validé une écriture ; les écritures faites par ce processus appellent invalider().
+
+Les valeurs retournées sont partagées entre les appelants : ne pas les modifier.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from connexion_db import obtenir_connexion
+import metriques
+
+NB_ENTREES_MAX = int(os.environ.get("FORMULAMA_CACHE_ENTREES", "256"))
+
+_verrou = threading.Lock()
+_entrees = OrderedDict()
+_local = threading.local()
+# Incrémenté par invalider() : force la relecture de la génération dans tous les threads
+_generation_locale = 0
+_statistiques = {"succes": 0, "echecs": 0}
+
+
+def invalider():
+    """À appeler après une écriture sur 'documents' faite par ce processus."""
+    global _generation_locale
+    with _verrou:
+        _generation_locale += 1
+
+
+def generation_actuelle(chemin_db):
+    """Retourne la génération de la base, relue seulement si une écriture a pu avoir lieu."""
+    conn = obtenir_connexion(chemin_db)
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    etats = getattr(_local, "etats", None)
+    if etats is None:
+        etats = _local.etats = {}
+
+    etat = etats.get(chemin_db)
+    if etat is None or etat[0] != (id(conn), data_version, _generation_locale):
+        generation = conn.execute("SELECT valeur FROM generation_cache WHERE id = 1").fetchone()[0]
+        etat = ((id(conn), data_version, _generation_locale), generation)
+        etats[chemin_db] = etat
+    return etat[1]
+
+
+def obtenir(chemin_db, cle, calculer):
+    """
+    Retourne le résultat mémorisé pour `cle` s'il date de la génération actuelle,
+    sinon appelle `calculer()` et le mémorise. Une exception de `calculer` n'est pas mise en cache.
+    """
+    generation = generation_actuelle(chemin_db)
+    cle = (chemin_db,) + tuple(cle)
+    with _verrou:
+        entree = _entrees.get(cle)
+        trouve = entree is not None and entree[0] == generation
+        if trouve:
+            _entrees.move_to_end(cle)
+        _statistiques["succes" if trouve else "echecs"] += 1
+
+    metriques.incrementer("formulama_cache_total", cache="requetes", resultat="succes" if trouve else "echec")
+    if trouve:
+        return entree[1]
+
+    valeur = calculer()
+
+    with _verrou:
+        _entrees[cle] = (generation, valeur)
+        _entrees.move_to_end(cle)
+        while len(_entrees) > NB_ENTREES_MAX:
+            _entrees.popitem(last=False)
+    return valeur
+
+
+def statistiques():
+    """Nombre de lectures servies par le cache (succes) ou par la base (echecs)."""
+    with _verrou:
+        return dict(_statistiques, entrees=len(_entrees))
+
+
+def vider():
+    with _verrou:
+        _entrees.clear()
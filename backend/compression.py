@@ -0,0 +1,159 @@
+"""
+Compression des réponses négociée par Accept-Encoding (brotli, gzip).
+
+- Toute réponse d'un type compressible (JSON, texte, XML, SVG) d'au moins TAILLE_MIN
+  octets est compressée à la volée (après la route, voir instrumenter) ; les PDF, images
+  et archives, déjà compressés, ne le sont jamais, ni les réponses en flux (fichiers
+  envoyés par livraison, SSE, export ZIP, listes ?stream=1) ;
+- les listes complètes (tous, par catégorie, récents) sont sérialisées puis compressées
+  une seule fois par génération de la base : le corps encodé est gardé dans
+  cache_requetes avec son ETag, et une liste inchangée est renvoyée telle quelle, ou
+  en 304 sur If-None-Match.
+
+L'ETag d'une liste est l'empreinte de son JSON, suivie de l'encodage (« -br », « -gzip ») :
+il est identique dans tous les processus et ne change pas après une écriture qui ne
+modifie pas la liste.
+
+brotli (paquet Brotli) est optionnel : sans lui, seul gzip est proposé.
+FORMULAMA_COMPRESSION=0 désactive la compression (ex. déjà faite par le serveur frontal).
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+
+import flask
+from flask import request
+
+import gestion_db
+import cache_requetes
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ACTIVE = os.environ.get("FORMULAMA_COMPRESSION", "1") not in ("0", "false", "non")
+# En dessous, l'en-tête gzip et le temps de compression coûtent plus qu'ils ne font gagner
+TAILLE_MIN = int(os.environ.get("FORMULAMA_COMPRESSION_TAILLE_MIN", "1024"))
+TYPES_COMPRESSIBLES = ('text/', 'application/json', 'application/javascript',
+                       'application/xml', 'image/svg+xml')
+# Par ordre de préférence à qualité égale dans Accept-Encoding
+ENCODAGES = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Niveaux : rapides à la volée, plus élevés pour un corps compressé une fois puis mis en cache
+NIVEAUX_VOLEE = {'br': 4, 'gzip': 6}
+NIVEAUX_CACHE = {'br': 9, 'gzip': 9}
+
+
+def negocier():
+    """Encodage à utiliser pour la requête courante ('br', 'gzip'), ou None (identité)."""
+    if not ACTIVE:
+        return None
+    meilleur, qualite_meilleur = None, 0
+    for encodage in ENCODAGES:
+        qualite = request.accept_encodings[encodage]
+        if qualite > qualite_meilleur:
+            meilleur, qualite_meilleur = encodage, qualite
+    return meilleur
+
+
+def compresser(donnees, encodage, niveaux=NIVEAUX_VOLEE):
+    if encodage == 'br':
+        return brotli.compress(donnees, quality=niveaux['br'])
+    # mtime=0 : même entrée, même sortie (ETag stable)
+    return gzip.compress(donnees, compresslevel=niveaux['gzip'], mtime=0)
+
+
+def compressible(mimetype):
+    return bool(mimetype) and mimetype.startswith(TYPES_COMPRESSIBLES)
+
+
+def _ajouter_vary(response):
+    if 'accept-encoding' not in {v.lower() for v in response.vary}:
+        response.vary.add('Accept-Encoding')
+
+
+# --- CORPS DE LISTES PRÉ-ENCODÉS ---
+
+class _CorpsJson:
+    """
+    JSON d'une liste et ses versions compressées, calculées à la première demande.
+    Partagé entre les threads via cache_requetes : seules les versions encodées sont
+    ajoutées après coup, sous verrou.
+    """
+
+    def __init__(self, donnees):
+        self.identite = flask.json.dumps(donnees).encode('utf-8') + b"\n"
+        self.empreinte = hashlib.blake2b(self.identite, digest_size=16).hexdigest()
+        self._encodes = {}
+        self._verrou = threading.Lock()
+
+    def encode(self, encodage):
+        """Retourne (corps, etag) pour `encodage` (None = identité)."""
+        if encodage is None:
+            return self.identite, self.empreinte
+        with self._verrou:
+            corps = self._encodes.get(encodage)
+            if corps is None:
+                corps = self._encodes[encodage] = compresser(self.identite, encodage, NIVEAUX_CACHE)
+        return corps, f"{self.empreinte}-{encodage}"
+
+
+def reponse_json(cle, calculer):
+    """
+    Réponse JSON de `calculer()` (liste mise en cache par gestion_db), sérialisée et
+    compressée une seule fois par génération de la base ; 304 si le client a déjà ce corps.
+    `cle` identifie la liste dans cache_requetes.
+    """
+    corps_json = cache_requetes.obtenir(gestion_db.DB_NAME, ('json',) + tuple(cle),
+                                        lambda: _CorpsJson(calculer()))
+    encodage = negocier()
+    if encodage and len(corps_json.identite) < TAILLE_MIN:
+        encodage = None
+    corps, etag = corps_json.encode(encodage)
+
+    if request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(corps, mimetype='application/json')
+        if encodage:
+            response.headers['Content-Encoding'] = encodage
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    _ajouter_vary(response)
+    return response
+
+
+# --- COMPRESSION À LA VOLÉE ---
+
+def instrumenter(app):
+    """
+    Compresse les réponses compressibles de l'application Flask. À appeler après
+    metriques.instrumenter : les octets envoyés sont alors mesurés après compression.
+    """
+
+    @app.after_request
+    def _compresser_reponse(response):
+        if not compressible(response.mimetype):
+            return response
+        _ajouter_vary(response)
+        if (response.direct_passthrough or response.is_streamed
+                or response.status_code in (204, 206, 304) or response.status_code < 200
+                or 'Content-Encoding' in response.headers
+                or 'no-transform' in response.headers.get('Cache-Control', '')):
+            return response
+        encodage = negocier()
+        if encodage is None:
+            return response
+        donnees = response.get_data()
+        if len(donnees) < TAILLE_MIN:
+            return response
+
+        response.set_data(compresser(donnees, encodage))
+        response.headers['Content-Encoding'] = encodage
+        # Une autre représentation : un ETag fort doit différer de celui du corps non compressé
+        etag, faible = response.get_etag()
+        if etag and not faible:
+            response.set_etag(f"{etag}-{encodage}")
+        return response
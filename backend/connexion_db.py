@@ -0,0 +1,172 @@
+"""
+Gestion des connexions SQLite partagées par gestion_db.
+
+Chaque thread conserve une connexion ouverte par fichier de base de données
+(au lieu d'un connect/close à chaque appel), configurée en mode WAL pour que
+les lectures ne soient plus bloquées par les écritures.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# Réglages des connexions (surchargeables par variables d'environnement)
+BUSY_TIMEOUT_MS = int(os.environ.get("FORMULAMA_DB_BUSY_TIMEOUT_MS", "5000"))
+TAILLE_CACHE_REQUETES = int(os.environ.get("FORMULAMA_DB_CACHE_REQUETES", "256"))
+TAILLE_CACHE_PAGES_KO = int(os.environ.get("FORMULAMA_DB_CACHE_KO", "16000"))
+TAILLE_MMAP = int(os.environ.get("FORMULAMA_DB_MMAP", str(128 * 1024 * 1024)))
+NB_REESSAIS = int(os.environ.get("FORMULAMA_DB_REESSAIS", "5"))
+
+_local = threading.local()
+_verrou_registre = threading.Lock()
+# Toutes les connexions ouvertes, pour pouvoir les fermer à l'arrêt ; celles d'un
+# thread terminé en sont retirées (voir _ConnexionsThread)
+_connexions_ouvertes = set()
+# Incrémenté par fermer_connexions() pour invalider les connexions des autres threads
+_generation = 0
+
+
+def _configurer(conn):
+    """Applique les PRAGMA de performance à une nouvelle connexion."""
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute("PRAGMA journal_mode = WAL")
+    # NORMAL est sûr en mode WAL : seule la dernière transaction peut être perdue en cas de coupure
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute(f"PRAGMA cache_size = -{TAILLE_CACHE_PAGES_KO}")
+    conn.execute(f"PRAGMA mmap_size = {TAILLE_MMAP}")
+    conn.execute("PRAGMA foreign_keys = ON")
+
+
+def _ouvrir(chemin_db):
+    os.makedirs(os.path.dirname(chemin_db) or ".", exist_ok=True)
+    conn = sqlite3.connect(
+        chemin_db,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        # Les transactions sont gérées explicitement (voir transaction())
+        isolation_level=None,
+        # Cache des requêtes préparées, réutilisées d'un appel à l'autre
+        cached_statements=TAILLE_CACHE_REQUETES,
+        check_same_thread=False,
+    )
+    _configurer(conn)
+    with _verrou_registre:
+        _connexions_ouvertes.add(conn)
+    return conn
+
+
+def _fermer_connexions_thread(pid, connexions):
+    # Jamais dans un processus fils (fork) : fermer une connexion héritée libérerait
+    # les verrous SQLite du parent
+    if os.getpid() != pid:
+        return
+    with _verrou_registre:
+        for conn in connexions.values():
+            _connexions_ouvertes.discard(conn)
+    for conn in connexions.values():
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+class _ConnexionsThread:
+    """
+    Connexions d'un thread, par fichier de base. Conservé dans un threading.local :
+    libéré quand le thread se termine, ce qui ferme ses connexions (sans quoi chaque
+    thread de worker disparu en laisserait une ouverte jusqu'à l'arrêt du processus).
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.generation = _generation
+        self.connexions = {}
+        weakref.finalize(self, _fermer_connexions_thread, self.pid, self.connexions)
+
+
+def obtenir_connexion(chemin_db):
+    """
+    Retourne la connexion du thread courant pour `chemin_db`, en l'ouvrant au besoin.
+    Une connexion héritée d'un processus parent (fork) n'est jamais réutilisée.
+    """
+    etat = getattr(_local, "etat", None)
+    if etat is None or etat.pid != os.getpid() or etat.generation != _generation:
+        etat = _local.etat = _ConnexionsThread()
+
+    conn = etat.connexions.get(chemin_db)
+    if conn is None:
+        conn = _ouvrir(chemin_db)
+        etat.connexions[chemin_db] = conn
+    return conn
+
+
+def _est_occupee(erreur):
+    message = str(erreur).lower()
+    return "locked" in message or "busy" in message
+
+
+def _avec_reessai(operation):
+    """Réessaie `operation` avec un recul exponentiel tant que la base est verrouillée."""
+    for tentative in range(NB_REESSAIS):
+        try:
+            return operation()
+        except sqlite3.OperationalError as e:
+            if not _est_occupee(e) or tentative == NB_REESSAIS - 1:
+                raise
+            time.sleep(min(0.05 * (2 ** tentative), 1.0) * (0.5 + random.random()))
+
+
+@contextmanager
+def lecture(chemin_db, dictionnaire=False):
+    """
+    Fournit un curseur de lecture sur la connexion du thread.
+    `dictionnaire=True` retourne des lignes sqlite3.Row (accès par nom de colonne).
+    """
+    cursor = obtenir_connexion(chemin_db).cursor()
+    if dictionnaire:
+        cursor.row_factory = sqlite3.Row
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def transaction(chemin_db, dictionnaire=False):
+    """
+    Ouvre une transaction d'écriture (BEGIN IMMEDIATE) et fournit un curseur.
+    Le verrou d'écriture est pris dès le début, avec réessai si la base est occupée,
+    puis la transaction est validée à la sortie du bloc ou annulée en cas d'erreur.
+    """
+    conn = obtenir_connexion(chemin_db)
+    _avec_reessai(lambda: conn.execute("BEGIN IMMEDIATE"))
+    cursor = conn.cursor()
+    if dictionnaire:
+        cursor.row_factory = sqlite3.Row
+    try:
+        yield cursor
+        _avec_reessai(lambda: conn.execute("COMMIT"))
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+
+
+def fermer_connexions():
+    """Ferme toutes les connexions ouvertes (arrêt du serveur ou des tests)."""
+    global _generation
+    with _verrou_registre:
+        connexions = list(_connexions_ouvertes)
+        _connexions_ouvertes.clear()
+        _generation += 1
+    for conn in connexions:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
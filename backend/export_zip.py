@@ -0,0 +1,174 @@
+"""
+Export de documents en archive ZIP, construite et envoyée au fil de l'eau.
+
+Aucune archive temporaire : les documents sont lus en base par lots (par id croissant),
+chaque fichier est copié par morceaux de 64 Ko dans le flux ZIP et les octets produits
+sont envoyés aussitôt. La mémoire reste bornée quel que soit le nombre de documents
+(hormis l'index final de l'archive et les noms déjà utilisés, quelques dizaines
+d'octets par document).
+
+- La sortie n'étant pas « seekable », zipfile écrit tailles et CRC après chaque fichier
+  (descripteur de données) plutôt que de revenir sur l'en-tête ;
+- les formats déjà compressés (PDF, images, archives bureautiques) sont stockés tels
+  quels, le reste est compressé (deflate) ;
+- disposition : <categorie>/<nom>, un doublon de nom devient « nom (id).ext » ;
+  avec les signatures : <categorie>/<nom>.signature.png ;
+- un fichier absent du disque est omis et listé dans EXPORT-ERREURS.txt, à la fin
+  de l'archive.
+"""
+
+import os
+import time
+import zipfile
+
+from werkzeug.utils import safe_join
+
+from gestion_db import recuperer_lot_export
+import stockage_blobs
+import signatures
+import journal
+
+log = journal.obtenir(__name__)
+
+TAILLE_MORCEAU = 64 * 1024
+TAILLE_LOT = 500
+# Formats compressés en interne : les recompresser coûte du CPU pour presque rien
+EXTENSIONS_STOCKEES = {
+    '.pdf', '.png', '.jpg', '.jpeg', '.gif', '.webp',
+    '.zip', '.gz', '.bz2', '.xz', '.7z', '.rar',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp',
+    '.mp3', '.mp4', '.m4a', '.mov',
+}
+# Le format ZIP ne représente pas les dates antérieures à 1980
+DATE_MIN = (1980, 1, 1, 0, 0, 0)
+NOM_RAPPORT_ERREURS = 'EXPORT-ERREURS.txt'
+
+
+class _FluxSortie:
+    """
+    Destination de zipfile : accumule les octets écrits jusqu'au prochain vider().
+    Pas de tell()/seek() : zipfile passe en mode flux (descripteurs de données).
+    """
+
+    def __init__(self):
+        self._morceaux = []
+        self.taille = 0
+
+    def write(self, donnees):
+        self._morceaux.append(bytes(donnees))
+        self.taille += len(donnees)
+        return len(donnees)
+
+    def flush(self):
+        pass
+
+    def vider(self):
+        donnees = b''.join(self._morceaux)
+        self._morceaux = []
+        self.taille = 0
+        return donnees
+
+
+def _composant(nom):
+    """Un nom utilisable comme élément de chemin dans l'archive (ni '/', ni '..')."""
+    nom = (nom or '').replace('/', '_').replace('\\', '_').strip()
+    if nom in ('', '.', '..'):
+        return '_'
+    return nom
+
+
+def _nom_unique(chemin, doc_id, deja_utilises):
+    if chemin in deja_utilises:
+        base, extension = os.path.splitext(chemin)
+        chemin = f"{base} ({doc_id}){extension}"
+    deja_utilises.add(chemin)
+    return chemin
+
+
+def _info_entree(nom, date_epoch, taille):
+    date = max(tuple(time.localtime(date_epoch or 0)[:6]), DATE_MIN)
+    info = zipfile.ZipInfo(nom, date_time=date)
+    info.external_attr = 0o644 << 16
+    stocke = os.path.splitext(nom)[1].lower() in EXTENSIONS_STOCKEES
+    info.compress_type = zipfile.ZIP_STORED if stocke else zipfile.ZIP_DEFLATED
+    # Taille annoncée d'avance : zipfile choisit alors le format ZIP64 si nécessaire (> 4 Go)
+    info.file_size = taille
+    return info
+
+
+def _lots_documents(categorie, ids):
+    apres_id = 0
+    while True:
+        lot = recuperer_lot_export(apres_id, TAILLE_LOT, categorie, ids)
+        yield from lot
+        if len(lot) < TAILLE_LOT:
+            return
+        apres_id = lot[-1][0]
+
+
+def generer_archive(dossier_donnees, categorie=None, ids=None, avec_signatures=False):
+    """
+    Générateur des octets de l'archive ZIP des documents demandés
+    (tous, une catégorie et/ou une liste d'ids), avec l'image de signature des
+    documents signés si `avec_signatures`.
+    """
+    sortie = _FluxSortie()
+    deja_utilises = set()
+    erreurs = []
+    nb_fichiers = 0
+    debut = time.perf_counter()
+
+    def ajouter(archive, nom, chemin, date_epoch):
+        # Le fichier est ouvert avant d'écrire l'en-tête : un fichier absent n'est pas à moitié ajouté
+        with open(chemin, 'rb') as source:
+            info = _info_entree(nom, date_epoch, os.fstat(source.fileno()).st_size)
+            with archive.open(info, 'w') as destination:
+                while True:
+                    morceau = source.read(TAILLE_MORCEAU)
+                    if not morceau:
+                        break
+                    destination.write(morceau)
+                    if sortie.taille >= TAILLE_MORCEAU:
+                        yield sortie.vider()
+        yield sortie.vider()
+
+    try:
+        with zipfile.ZipFile(sortie, 'w') as archive:
+            for (doc_id, nom_fichier, doc_categorie, date_ajout, sha256,
+                 is_signed, signature_sha256) in _lots_documents(categorie, ids):
+                if sha256:
+                    chemin = stockage_blobs.chemin_absolu_blob(dossier_donnees, sha256)
+                else:
+                    chemin = safe_join(dossier_donnees, nom_fichier)
+                nom = _nom_unique(f"{_composant(doc_categorie)}/{_composant(nom_fichier)}", doc_id, deja_utilises)
+                try:
+                    yield from ajouter(archive, nom, chemin, date_ajout)
+                    nb_fichiers += 1
+                except (OSError, TypeError):
+                    # TypeError : safe_join a refusé le nom (None)
+                    log.warning("Export : fichier introuvable pour le document %s : %s", doc_id, chemin)
+                    erreurs.append(f"{nom} (document {doc_id}) : fichier introuvable")
+                    continue
+
+                if avec_signatures and is_signed:
+                    chemin_signature, _ = signatures.emplacement(dossier_donnees, doc_id, signature_sha256)
+                    if chemin_signature:
+                        nom_signature = _nom_unique(f"{nom}.signature.png", doc_id, deja_utilises)
+                        try:
+                            yield from ajouter(archive, nom_signature, chemin_signature, date_ajout)
+                        except OSError:
+                            erreurs.append(f"{nom_signature} (document {doc_id}) : signature illisible")
+
+            if erreurs:
+                archive.writestr(_info_entree(NOM_RAPPORT_ERREURS, time.time(), 0),
+                                 '\n'.join(erreurs) + '\n')
+        # Index central de l'archive, écrit à la fermeture
+        yield sortie.vider()
+    except Exception:
+        # Les en-têtes sont déjà partis : le client reçoit une archive tronquée
+        log.exception("Export ZIP interrompu après %s fichier(s)", nb_fichiers)
+        raise
+
+    log.info("Export ZIP : %s fichier(s), %s introuvable(s) en %.2f s",
+             nb_fichiers, len(erreurs), time.perf_counter() - debut,
+             extra={"categorie": categorie, "nb_ids": len(ids) if ids is not None else None})
@@ -0,0 +1,125 @@
+"""
+Extraction du texte des documents pour la recherche plein texte.
+
+Le texte des PDF est extrait en arrière-plan, sur un pool de threads, puis indexé
+dans documents_fts (voir gestion_db.enregistrer_texte_document). Les documents
+jamais traités (uploads antérieurs, arrêt du serveur pendant l'extraction) sont
+repris par rattraper() au démarrage.
+
+Dépendance optionnelle : PyMuPDF. Sans elle, seuls les noms de fichiers sont indexés.
+"""
+
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+import gestion_db
+import journal
+import stockage_blobs
+
+log = journal.obtenir(__name__)
+
+NB_THREADS = int(os.environ.get("FORMULAMA_EXTRACTION_THREADS", "2"))
+# Texte indexé par document, au-delà le reste est ignoré
+NB_CARACTERES_MAX = int(os.environ.get("FORMULAMA_EXTRACTION_CARACTERES", "200000"))
+
+_verrou = threading.Lock()
+_pool = None
+_pid = None
+
+
+def extraire_texte(chemin, mimetype):
+    """Retourne le texte du fichier (chaîne vide pour les types non pris en charge)."""
+    if mimetype != 'application/pdf' or fitz is None:
+        return ''
+    morceaux = []
+    longueur = 0
+    with fitz.open(chemin) as pdf:
+        for page in pdf:
+            texte = page.get_text()
+            morceaux.append(texte)
+            longueur += len(texte)
+            if longueur >= NB_CARACTERES_MAX:
+                break
+    return '\n'.join(morceaux)[:NB_CARACTERES_MAX]
+
+
+def _indexer(doc_id, chemin, mimetype):
+    texte = ''
+    try:
+        if chemin and os.path.exists(chemin):
+            texte = extraire_texte(chemin, mimetype)
+    except (RuntimeError, OSError) as e:
+        # RuntimeError : PDF illisible pour PyMuPDF ; le document reste indexé par son nom
+        # et n'est pas retenté à chaque démarrage
+        log.warning("Extraction du texte impossible pour le document %s : %s", doc_id, e)
+    try:
+        gestion_db.enregistrer_texte_document(doc_id, texte)
+    except sqlite3.Error as e:
+        log.error("Indexation du texte impossible pour le document %s : %s", doc_id, e)
+
+
+def _obtenir_pool():
+    global _pool, _pid
+    # Un pool hérité d'un fork n'a plus de threads : en recréer un
+    if _pool is None or _pid != os.getpid():
+        _pool = ThreadPoolExecutor(max_workers=NB_THREADS, thread_name_prefix="extraction")
+        _pid = os.getpid()
+    return _pool
+
+
+def planifier(doc_id, chemin, mimetype):
+    """Demande l'extraction et l'indexation du texte d'un document en arrière-plan."""
+    with _verrou:
+        return _obtenir_pool().submit(_indexer, doc_id, chemin, mimetype)
+
+
+def chemin_document(dossier_donnees, nom_fichier, sha256):
+    """Blob adressé par contenu, ou data/<nom_fichier> pour les anciens uploads."""
+    if sha256:
+        return stockage_blobs.chemin_absolu_blob(dossier_donnees, sha256)
+    return os.path.join(dossier_donnees, nom_fichier)
+
+
+def rattraper(dossier_donnees, obtenir_mimetype, taille_lot=100):
+    """
+    Extrait le texte de tous les documents pas encore traités, lot par lot (un lot
+    terminé avant de lire le suivant, pour ne pas remplir la file du pool).
+    Retourne le nombre de documents traités.
+    """
+    nombre = 0
+    dernier_id = 0
+    while True:
+        lot = gestion_db.recuperer_documents_sans_texte(taille_lot, dernier_id)
+        if not lot:
+            return nombre
+        futurs = [
+            planifier(doc_id, chemin_document(dossier_donnees, nom_fichier, sha256), obtenir_mimetype(nom_fichier))
+            for doc_id, nom_fichier, sha256 in lot
+        ]
+        for futur in futurs:
+            futur.result()
+        nombre += len(lot)
+        dernier_id = lot[-1][0]
+
+
+def demarrer_rattrapage(dossier_donnees, obtenir_mimetype):
+    """Lance rattraper() dans un thread de fond (au démarrage du serveur)."""
+    thread = threading.Thread(target=rattraper, args=(dossier_donnees, obtenir_mimetype),
+                              name="rattrapage-extraction", daemon=True)
+    thread.start()
+    return thread
+
+
+def arreter():
+    """Arrête le pool ; les documents non traités seront repris par rattraper()."""
+    global _pool
+    if _pool is not None and _pid == os.getpid():
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
@@ -1,280 +1,665 @@
 import sqlite3
-import datetime 
+import time
 import os
+import json
+import html
+
+from connexion_db import lecture, transaction
+from schema_db import appliquer_migrations
+import stockage_blobs
+import cache_requetes
+from metriques import mesurer_requete
+import journal
+
+log = journal.obtenir(__name__)
 
 # Chemin vers la base de données (chemin absolu pour éviter les problèmes relatifs)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
-DB_NAME = os.path.join(PROJECT_ROOT, 'data', 'documents.db') 
+# FORMULAMA_DATA_DIR : dossier de données hors du dépôt (production, benchmarks)
+DATA_DIR = os.environ.get("FORMULAMA_DATA_DIR", os.path.join(PROJECT_ROOT, 'data'))
+DB_NAME = os.path.join(DATA_DIR, 'documents.db') 
 
+# Colonnes renvoyées par les lectures. date_ajout est stockée en secondes epoch
+# (voir schema_db) et reformatée ici en "AAAA-MM-JJ HH:MM:SS", heure locale.
+# Les tris utilisent d.date_ajout (la colonne) et non l'alias formaté.
+COLONNES_DOCUMENT = """
+    d.id, d.nom_fichier, d.chemin_local, d.categorie,
+    strftime('%Y-%m-%d %H:%M:%S', d.date_ajout, 'unixepoch', 'localtime') AS date_ajout,
+    d.is_signed
+"""
+
+@mesurer_requete
 def supprimer_document(doc_id: int):
     """
     Supprime un enregistrement de document de la base de données par son ID.
     """
-    conn = None
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        # Requête DELETE : utilise l'ID pour identifier la ligne
-        suppression_query = "DELETE FROM documents WHERE id = ?"
-        
-        cursor.execute(suppression_query, (doc_id,))
-        conn.commit()
-        
-        # Vérifie si une ligne a été affectée (si l'ID existait)
-        return cursor.rowcount > 0 
+        with transaction(DB_NAME) as cursor:
+            # Requête DELETE : utilise l'ID pour identifier la ligne
+            suppression_query = "DELETE FROM documents WHERE id = ?"
+            
+            cursor.execute(suppression_query, (doc_id,))
+            
+            # Vérifie si une ligne a été affectée (si l'ID existait)
+            supprime = cursor.rowcount > 0 
+        cache_requetes.invalider()
+        return supprime
 
     except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de la suppression du document ID {doc_id} : {e}")
+        log.error("Erreur lors de la suppression du document ID %s : %s", doc_id, e)
         return False
-    finally:
-        if conn:
-            conn.close()
 
 def initialiser_base_de_donnees():
-    """Crée le fichier DB et la table 'documents' s'ils n'existent pas."""
-    conn = None
+    """Crée le fichier DB s'il n'existe pas et applique les migrations de schéma manquantes."""
     try:
         # Assurez-vous que le répertoire 'data' existe
         os.makedirs(os.path.dirname(DB_NAME), exist_ok=True)
         
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        creation_table_query = """
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nom_fichier TEXT NOT NULL,
-            chemin_local TEXT NOT NULL,
-            categorie TEXT NOT NULL,
-            date_ajout DATETIME,
-            is_signed BOOLEAN DEFAULT 0
-        );
-        """
-        cursor.execute(creation_table_query)
-        conn.commit()
-        
-        # Ajouter la colonne is_signed si elle n'existe pas
-        cursor.execute("PRAGMA table_info(documents)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'is_signed' not in columns:
-            cursor.execute("ALTER TABLE documents ADD COLUMN is_signed BOOLEAN DEFAULT 0")
-            conn.commit()
-            print("✅ Colonne 'is_signed' ajoutée à la table 'documents'.")
+        appliquer_migrations(DB_NAME)
         
-        print(f"✅ Base de données '{DB_NAME}' initialisée avec succès.")
+        log.info("Base de données '%s' initialisée avec succès.", DB_NAME)
 
     except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de l'initialisation de la base de données : {e}")
+        log.error("Erreur lors de l'initialisation de la base de données : %s", e)
     except Exception as e:
-        print(f"🛑 Erreur système lors de l'initialisation : {e}")
-    finally:
-        if conn:
-            conn.close()
+        log.exception("Erreur système lors de l'initialisation : %s", e)
 
-def marquer_document_signe(doc_id: int):
-    """Marque un document comme signé."""
-    conn = None
+@mesurer_requete
+def signer_documents(ids, blob=None):
+    """
+    Marque les documents `ids` comme signés, en une seule transaction.
+    `blob` (stockage_blobs.BlobRecu, voir signatures.recevoir) est l'image de signature :
+    stockée une seule fois et référencée par tous ces documents (signature_sha256).
+    Les anciennes signatures <id>.png qu'elle remplace sont confiées au ramasse-miettes.
+    Retourne la liste des ids signés (les ids inconnus sont ignorés), False en cas d'erreur.
+    """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
-        update_query = "UPDATE documents SET is_signed = 1 WHERE id = ?"
-        cursor.execute(update_query, (doc_id,))
-        conn.commit()
-        
-        return cursor.rowcount > 0
-    
-    except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de la mise à jour du document ID {doc_id} : {e}")
+        ids_json = json.dumps(ids)
+        with transaction(DB_NAME) as cursor:
+            if blob:
+                cursor.execute(
+                    "INSERT INTO blobs (sha256, taille) VALUES (?, ?) ON CONFLICT(sha256) DO NOTHING",
+                    (blob.sha256, blob.taille)
+                )
+                # Anciennes signatures stockées sous l'id du document
+                cursor.execute("""
+                    INSERT INTO fichiers_a_supprimer (chemin, date_ajout, sha256)
+                    SELECT 'signatures/' || d.id || '.png', ?, NULL
+                    FROM documents d
+                    WHERE d.id IN (SELECT value FROM json_each(?))
+                      AND d.is_signed = 1 AND d.signature_sha256 IS NULL
+                """, (int(time.time()), ids_json))
+                cursor.execute("""
+                    UPDATE documents SET is_signed = 1, signature_sha256 = ?
+                    WHERE id IN (SELECT value FROM json_each(?))
+                    RETURNING id
+                """, (blob.sha256, ids_json))
+            else:
+                cursor.execute("""
+                    UPDATE documents SET is_signed = 1
+                    WHERE id IN (SELECT value FROM json_each(?))
+                    RETURNING id
+                """, (ids_json,))
+            signes = sorted(ligne[0] for ligne in cursor.fetchall())
+
+            if blob:
+                # Aucun document signé : ne pas garder une image sans référence
+                cursor.execute("DELETE FROM blobs WHERE sha256 = ? AND nb_references = 0", (blob.sha256,))
+                if signes:
+                    # Sous le verrou d'écriture, comme pour ajouter_document
+                    stockage_blobs.publier(blob)
+        cache_requetes.invalider()
+        return signes
+
+    except (sqlite3.Error, OSError) as e:
+        log.error("Erreur lors de la signature de %s document(s) : %s", len(ids), e)
         return False
     finally:
-        if conn:
-            conn.close()
+        # Sans effet si le fichier a été publié
+        if blob:
+            stockage_blobs.abandonner(blob)
 
-def ajouter_document(nom, chemin, categorie):
-    """Ajoute un enregistrement de document."""
-    conn = None
+@mesurer_requete(lignes=lambda doc_id: 1 if doc_id else 0)
+def ajouter_document(nom, chemin, categorie, blob=None):
+    """
+    Ajoute un enregistrement de document.
+    `blob` (stockage_blobs.BlobRecu) rattache le document à un contenu stocké par empreinte :
+    la référence et la publication du fichier se font dans la même transaction.
+    """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        
         insertion_query = """
-        INSERT INTO documents (nom_fichier, chemin_local, categorie, date_ajout)
-        VALUES (?, ?, ?, ?)
+        INSERT INTO documents (nom_fichier, chemin_local, categorie, date_ajout, sha256)
+        VALUES (?, ?, ?, ?, ?)
         """
         data = (
             nom,
             chemin,
             categorie,
-            # Correction de la syntaxe de datetime
-            datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") 
+            # Secondes epoch (format trié par les index, voir schema_db)
+            int(time.time()),
+            blob.sha256 if blob else None
         )
 
-        # Exécute la requête
-        cursor.execute(insertion_query, data)
-        conn.commit()
-        
-        # Récupère l'ID du document inséré
-        doc_id = cursor.lastrowid
+        with transaction(DB_NAME) as cursor:
+            if blob:
+                cursor.execute(
+                    "INSERT INTO blobs (sha256, taille) VALUES (?, ?) ON CONFLICT(sha256) DO NOTHING",
+                    (blob.sha256, blob.taille)
+                )
+            # Exécute la requête
+            cursor.execute(insertion_query, data)
+            
+            # Récupère l'ID du document inséré
+            doc_id = cursor.lastrowid
+
+            # Le ramasse-miettes efface sous ce même verrou d'écriture : le fichier ne peut
+            # pas disparaître entre sa publication et la validation de la référence.
+            if blob:
+                stockage_blobs.publier(blob)
+        cache_requetes.invalider()
         return doc_id
 
-    except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de l'ajout du document '{nom}' : {e}")
+    except (sqlite3.Error, OSError) as e:
+        log.error("Erreur lors de l'ajout du document '%s' : %s", nom, e)
         return False
-    finally:
-        if conn:
-            conn.close()
 
+@mesurer_requete
+def ajouter_documents_en_lot(entrees):
+    """
+    Ajoute plusieurs documents en une seule transaction.
+    `entrees` : liste de (nom, chemin, categorie, blob), blob étant un stockage_blobs.BlobRecu.
+    Les blobs sont publiés dans la même transaction, comme pour ajouter_document ; si elle
+    échoue ensuite, les fichiers publiés sont inscrits dans fichiers_a_supprimer.
+    Retourne la liste des ids dans l'ordre des entrées, ou False en cas d'erreur (rien n'est ajouté).
+    """
+    if not entrees:
+        return []
+    date_ajout = int(time.time())
+    publies = []
+    try:
+        with transaction(DB_NAME) as cursor:
+            cursor.executemany(
+                "INSERT INTO blobs (sha256, taille) VALUES (?, ?) ON CONFLICT(sha256) DO NOTHING",
+                [(blob.sha256, blob.taille) for _, _, _, blob in entrees]
+            )
+            ids = []
+            for nom, chemin, categorie, blob in entrees:
+                cursor.execute("""
+                    INSERT INTO documents (nom_fichier, chemin_local, categorie, date_ajout, sha256)
+                    VALUES (?, ?, ?, ?, ?)
+                    RETURNING id
+                """, (nom, chemin, categorie, date_ajout, blob.sha256))
+                ids.append(cursor.fetchone()[0])
+
+            for _, _, _, blob in entrees:
+                # Inscrit avant : publier peut échouer après avoir déplacé le fichier
+                publies.append(blob)
+                stockage_blobs.publier(blob)
+        cache_requetes.invalider()
+        return ids
+
+    except (sqlite3.Error, OSError) as e:
+        log.error("Erreur lors de l'ajout d'un lot de %s document(s) : %s", len(entrees), e)
+        if publies:
+            _inscrire_blobs_a_supprimer(publies)
+        return False
+
+def _inscrire_blobs_a_supprimer(blobs):
+    """
+    Inscrit des fichiers publiés dans une transaction annulée : le ramasse-miettes ne les
+    efface que si aucun blob de même empreinte n'est enregistré (contenu déjà présent).
+    """
+    try:
+        with transaction(DB_NAME) as cursor:
+            cursor.executemany(
+                "INSERT INTO fichiers_a_supprimer (chemin, date_ajout, sha256) VALUES (?, ?, ?)",
+                [(stockage_blobs.chemin_relatif_blob(blob.sha256), int(time.time()), blob.sha256)
+                 for blob in blobs]
+            )
+    except sqlite3.Error as e:
+        # Fichiers sans référence : retrouvés par la réconciliation disque/base
+        log.error("Impossible d'inscrire %s fichier(s) à supprimer : %s", len(blobs), e)
+
+@mesurer_requete
 def recuperer_documents_par_categorie(categorie):
     """Récupère tous les documents pour une catégorie donnée."""
-    conn = None
     documents = []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-
-        select_query = """
-        SELECT id, nom_fichier, chemin_local, categorie, date_ajout, is_signed
-        FROM documents
-        WHERE categorie = ?
-        ORDER BY date_ajout DESC
+        select_query = f"""
+        SELECT {COLONNES_DOCUMENT}
+        FROM documents d
+        WHERE d.categorie = ?
+        ORDER BY d.date_ajout DESC, d.id DESC
         """
         
-        # Utilise la catégorie pour filtrer
-        cursor.execute(select_query, (categorie,))
-        documents = cursor.fetchall()
+        def lire():
+            with lecture(DB_NAME) as cursor:
+                # Utilise la catégorie pour filtrer
+                cursor.execute(select_query, (categorie,))
+                return cursor.fetchall()
+
+        # Résultat mémorisé jusqu'à la prochaine écriture (voir cache_requetes)
+        documents = cache_requetes.obtenir(DB_NAME, ('categorie', categorie), lire)
 
     except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de la récupération pour la catégorie '{categorie}' : {e}")
-        
-    finally:
-        if conn:
-            conn.close()
+        log.error("Erreur lors de la récupération pour la catégorie '%s' : %s", categorie, e)
             
     return documents
 
+@mesurer_requete
 def recuperer_document_par_id(doc_id):
-    """Récupère un document spécifique par son ID"""
-    conn = None
+    """
+    Récupère un document spécifique par son ID.
+    Inclut 'sha256' (None pour les fichiers stockés sous leur nom, avant les blobs)
+    et 'signature_sha256' (image de signature, voir signatures).
+    """
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        select_query = """
-        SELECT id, nom_fichier, chemin_local, categorie, date_ajout, is_signed
-        FROM documents
-        WHERE id = ?
+        select_query = f"""
+        SELECT {COLONNES_DOCUMENT}, d.sha256, d.signature_sha256
+        FROM documents d
+        WHERE d.id = ?
         """
         
-        cursor.execute(select_query, (doc_id,))
-        result = cursor.fetchone()
+        with lecture(DB_NAME, dictionnaire=True) as cursor:
+            cursor.execute(select_query, (doc_id,))
+            result = cursor.fetchone()
         
         if result:
             return dict(result)
         return None
 
     except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de la récupération du document {doc_id} : {e}")
+        log.error("Erreur lors de la récupération du document %s : %s", doc_id, e)
         return None
+
+@mesurer_requete
+def recuperer_document_par_nom(nom_fichier):
+    """Récupère le document le plus récent portant ce nom de fichier (même format que par ID)."""
+    try:
+        select_query = f"""
+        SELECT {COLONNES_DOCUMENT}, d.sha256
+        FROM documents d
+        WHERE d.nom_fichier = ?
+        ORDER BY d.id DESC
+        LIMIT 1
+        """
         
-    finally:
-        if conn:
-            conn.close()
+        with lecture(DB_NAME, dictionnaire=True) as cursor:
+            cursor.execute(select_query, (nom_fichier,))
+            result = cursor.fetchone()
+        
+        return dict(result) if result else None
+
+    except sqlite3.Error as e:
+        log.error("Erreur lors de la récupération du document '%s' : %s", nom_fichier, e)
+        return None
 
+@mesurer_requete
 def recuperer_tous_documents():
     """
     Récupère TOUS les documents de la base de données, peu importe la catégorie.
     """
-    conn = None
     documents = []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        select_query = """
-        SELECT id, nom_fichier, chemin_local, categorie, date_ajout, is_signed
-        FROM documents
-        ORDER BY date_ajout DESC
+        select_query = f"""
+        SELECT {COLONNES_DOCUMENT}
+        FROM documents d
+        ORDER BY d.date_ajout DESC, d.id DESC
         """
         
-        cursor.execute(select_query)
-        documents = [dict(row) for row in cursor.fetchall()]
+        def lire():
+            with lecture(DB_NAME, dictionnaire=True) as cursor:
+                cursor.execute(select_query)
+                return [dict(row) for row in cursor.fetchall()]
+
+        # Résultat mémorisé jusqu'à la prochaine écriture (voir cache_requetes)
+        documents = cache_requetes.obtenir(DB_NAME, ('tous',), lire)
 
         return documents
 
     except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de la récupération de tous les documents : {e}")
+        log.error("Erreur lors de la récupération de tous les documents : %s", e)
         return []
-    finally:
-        if conn:
-            conn.close()
-            
-    return documents
 
+@mesurer_requete
 def recuperer_4_derniers_documents():
     """
     Récupère les 4 documents les plus récemment ajoutés, quelle que soit leur catégorie.
     Ceci est utilisé pour l'aperçu sur la page d'accueil (Dashboard).
     """
-    conn = None
     documents = []
     try:
-        conn = sqlite3.connect(DB_NAME)
-        # Permet d'accéder aux colonnes par leur nom (comme un dictionnaire)
-        conn.row_factory = sqlite3.Row 
-        cursor = conn.cursor()
-
-        select_query = """
-        SELECT id, nom_fichier, chemin_local, categorie, date_ajout, is_signed
-        FROM documents
-        ORDER BY date_ajout DESC
+        select_query = f"""
+        SELECT {COLONNES_DOCUMENT}
+        FROM documents d
+        ORDER BY d.date_ajout DESC, d.id DESC
         LIMIT 4
         """
         
-        # Exécute la requête sans filtre spécifique
-        cursor.execute(select_query)
-        # Convertit les lignes (sqlite3.Row) en une liste de dictionnaires/objets
-        documents = [dict(row) for row in cursor.fetchall()]
+        def lire():
+            # Permet d'accéder aux colonnes par leur nom (comme un dictionnaire)
+            with lecture(DB_NAME, dictionnaire=True) as cursor:
+                # Exécute la requête sans filtre spécifique
+                cursor.execute(select_query)
+                # Convertit les lignes (sqlite3.Row) en une liste de dictionnaires/objets
+                return [dict(row) for row in cursor.fetchall()]
+
+        # Résultat mémorisé jusqu'à la prochaine écriture (voir cache_requetes)
+        documents = cache_requetes.obtenir(DB_NAME, ('recents',), lire)
 
     except sqlite3.Error as e:
-        print(f"🛑 Erreur lors de la récupération des 4 derniers documents : {e}")
-        
-    finally:
-        if conn:
-            conn.close()
+        log.error("Erreur lors de la récupération des 4 derniers documents : %s", e)
             
     return documents
 
 
-# --- NOUVELLE FONCTION DE DIAGNOSTIC ---
-def diagnostiquer_fichiers_locaux(data_folder_path):
+# --- LISTES DE PLUSIEURS CATÉGORIES EN UNE REQUÊTE ---
+@mesurer_requete(lignes=lambda resultat: sum(len(c['documents']) for c in resultat.values()))
+def recuperer_documents_par_categories(categories, limite=10, signe=None):
     """
-    Liste les fichiers présents dans le dossier de données local.
-    Ceci est utilisé pour vérifier la casse et l'existence des fichiers sur le serveur.
+    Pour chaque catégorie demandée : ses `limite` documents les plus récents et son
+    nombre total de documents, en une seule requête SQL (chaque catégorie est lue
+    directement dans l'index categorie/date, le total dans les compteurs tenus par
+    triggers, voir statistiques). `signe` (True/False) filtre sur is_signed.
+    Retourne {categorie: {"total": n, "documents": [dict, ...]}} dans l'ordre demandé.
     """
+    categories = list(dict.fromkeys(categories))
+    filtre_signe = "" if signe is None else "AND is_signed = :signe"
+    colonne_total = {None: "t.total", True: "t.signes", False: "t.total - t.signes"}[signe]
+    select_query = f"""
+    SELECT c.value AS cible, COALESCE({colonne_total}, 0) AS total, {COLONNES_DOCUMENT}
+    FROM json_each(:categories) c
+    LEFT JOIN statistiques_categories t ON t.categorie = c.value
+    LEFT JOIN documents d ON d.id IN (
+        SELECT id FROM documents
+        WHERE categorie = c.value {filtre_signe}
+        ORDER BY date_ajout DESC, id DESC
+        LIMIT :limite
+    )
+    ORDER BY c.key, d.date_ajout DESC, d.id DESC
+    """
+    parametres = {
+        "categories": json.dumps(categories),
+        "limite": limite,
+        "signe": 1 if signe else 0,
+    }
+
+    def lire():
+        resultat = {categorie: {"total": 0, "documents": []} for categorie in categories}
+        with lecture(DB_NAME, dictionnaire=True) as cursor:
+            cursor.execute(select_query, parametres)
+            for row in cursor:
+                entree = resultat[row['cible']]
+                entree['total'] = row['total']
+                if row['id'] is not None:
+                    document = dict(row)
+                    del document['cible'], document['total']
+                    entree['documents'].append(document)
+        return resultat
+
+    # Résultat mémorisé jusqu'à la prochaine écriture (voir cache_requetes)
+    return cache_requetes.obtenir(DB_NAME, ('categories', tuple(categories), limite, signe), lire)
+
+
+# --- SUPPRESSION EN MASSE ---
+@mesurer_requete
+def supprimer_documents_en_masse(ids=None, categorie=None, tous=False):
+    """
+    Supprime en une seule transaction une liste d'IDs, toute une catégorie ou tous les documents.
+    Les fichiers correspondants ne sont pas effacés ici : ils sont inscrits dans la table
+    'fichiers_a_supprimer', dans la même transaction, et effacés ensuite par ramasse_miettes
+    (directement pour les fichiers stockés sous leur nom, via le compteur de références
+    pour les blobs).
+    Retourne le nombre de documents supprimés, ou False en cas d'erreur.
+    """
+    if tous:
+        condition, parametres = "1", ()
+    elif categorie is not None:
+        condition, parametres = "categorie = ?", (categorie,)
+    elif ids:
+        # Liste passée en JSON : pas de limite sur le nombre de paramètres SQL
+        condition, parametres = "id IN (SELECT value FROM json_each(?))", (json.dumps([int(i) for i in ids]),)
+    else:
+        return 0
+
     try:
-        # Liste tous les fichiers et dossiers dans DATA_FOLDER_PATH
-        all_items = os.listdir(data_folder_path)
-        # Filtre pour ne garder que les fichiers (pas les dossiers) et les fichiers pertinents
-        local_files = [item for item in all_items if os.path.isfile(os.path.join(data_folder_path, item)) and not item.startswith('.')]
-        return {
-            "dossier_recherche": data_folder_path,
-            "fichiers_locaux": local_files,
-            "statut": "SUCCÈS"
-        }
-    except FileNotFoundError:
-        return {
-            "dossier_recherche": data_folder_path,
-            "fichiers_locaux": [],
-            "statut": "ERREUR: Dossier de données introuvable par le serveur Python."
-        }
-    except Exception as e:
-        return {
-            "dossier_recherche": data_folder_path,
-            "fichiers_locaux": [],
-            "statut": f"ERREUR INCONNUE: {str(e)}"
-        }
\ No newline at end of file
+        with transaction(DB_NAME) as cursor:
+            cursor.execute(f"""
+                INSERT INTO fichiers_a_supprimer (chemin, date_ajout)
+                SELECT DISTINCT nom_fichier, ? FROM documents
+                WHERE ({condition}) AND sha256 IS NULL
+            """, (int(time.time()),) + parametres)
+            cursor.execute(f"DELETE FROM documents WHERE {condition}", parametres)
+            nb_supprimes = cursor.rowcount
+        cache_requetes.invalider()
+        return nb_supprimes
+
+    except sqlite3.Error as e:
+        log.error("Erreur lors de la suppression en masse : %s", e)
+        return False
+
+@mesurer_requete
+def traiter_fichiers_a_supprimer(effacer, limite=500):
+    """
+    Traite un lot de la liste d'attente dans une transaction d'écriture : `effacer(chemin)`
+    est appelé pour chaque fichier qui n'est plus référencé, puis le lot est retiré de la liste.
+    Tenir le verrou d'écriture empêche un upload concurrent de référencer à nouveau un fichier
+    pendant son effacement. Retourne le nombre d'entrées traitées (0 quand la liste est vide).
+    """
+    with transaction(DB_NAME) as cursor:
+        cursor.execute("""
+            SELECT f.id, f.chemin,
+                   CASE WHEN f.sha256 IS NOT NULL
+                        THEN EXISTS (SELECT 1 FROM blobs b WHERE b.sha256 = f.sha256)
+                        ELSE EXISTS (SELECT 1 FROM documents d
+                                     WHERE d.nom_fichier = f.chemin AND d.sha256 IS NULL)
+                   END
+            FROM fichiers_a_supprimer f
+            ORDER BY f.id
+            LIMIT ?
+        """, (limite,))
+        lot = cursor.fetchall()
+
+        for _, chemin, encore_utilise in lot:
+            if not encore_utilise:
+                effacer(chemin)
+
+        if lot:
+            cursor.execute(
+                "DELETE FROM fichiers_a_supprimer WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps([ligne[0] for ligne in lot]),)
+            )
+    return len(lot)
+
+
+# --- PAGINATION PAR CLÉ (date_ajout, id) ---
+TAILLE_PAGE_MAX = 1000
+
+def encoder_curseur(date_tri, doc_id):
+    """Curseur opaque pour le client : '<date_ajout epoch>.<id>' du dernier document reçu."""
+    return f"{date_tri}.{doc_id}"
+
+def decoder_curseur(curseur):
+    """Inverse de encoder_curseur. Lève ValueError si le curseur est invalide."""
+    date_tri, doc_id = curseur.split('.')
+    return int(date_tri), int(doc_id)
+
+@mesurer_requete
+def recuperer_page_documents(categorie=None, limite=50, apres=None, dictionnaire=True):
+    """
+    Récupère une page de documents (plus récents d'abord), éventuellement filtrée par catégorie.
+    `apres` est le curseur renvoyé par la page précédente : la requête reprend directement
+    dans l'index au lieu de sauter des lignes (OFFSET), le coût ne dépend donc pas de la page.
+    Retourne (documents, curseur_suivant) ; curseur_suivant vaut None sur la dernière page.
+    Les documents sont des dictionnaires, ou des tuples si dictionnaire=False
+    (même format que recuperer_documents_par_categorie).
+    """
+    limite = max(1, min(int(limite), TAILLE_PAGE_MAX))
+    conditions = []
+    parametres = []
+    if categorie is not None:
+        conditions.append("d.categorie = ?")
+        parametres.append(categorie)
+    if apres:
+        conditions.append("(d.date_ajout, d.id) < (?, ?)")
+        parametres.extend(decoder_curseur(apres))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    select_query = f"""
+    SELECT {COLONNES_DOCUMENT}, d.date_ajout AS date_tri
+    FROM documents d
+    {where}
+    ORDER BY d.date_ajout DESC, d.id DESC
+    LIMIT ?
+    """
+    # Une ligne de plus que demandé pour savoir s'il reste une page
+    parametres.append(limite + 1)
+
+    with lecture(DB_NAME) as cursor:
+        cursor.execute(select_query, parametres)
+        lignes = cursor.fetchall()
+
+    curseur_suivant = None
+    if len(lignes) > limite:
+        lignes = lignes[:limite]
+        dernier = lignes[-1]
+        curseur_suivant = encoder_curseur(dernier[6], dernier[0])
+
+    if dictionnaire:
+        colonnes = ('id', 'nom_fichier', 'chemin_local', 'categorie', 'date_ajout', 'is_signed')
+        documents = [dict(zip(colonnes, ligne)) for ligne in lignes]
+    else:
+        documents = [ligne[:6] for ligne in lignes]
+    return documents, curseur_suivant
+
+def iterer_documents(categorie=None, dictionnaire=True, taille_lot=500):
+    """
+    Parcourt tous les documents (plus récents d'abord) lot par lot, sans jamais
+    les charger tous en mémoire. Chaque lot est une requête courte, ce qui évite
+    de garder une lecture ouverte pendant tout l'envoi de la réponse.
+    """
+    curseur = None
+    while True:
+        documents, curseur = recuperer_page_documents(categorie, taille_lot, curseur, dictionnaire)
+        yield from documents
+        if curseur is None:
+            return
+
+@mesurer_requete
+def recuperer_lot_export(apres_id=0, limite=500, categorie=None, ids=None):
+    """
+    Lot de documents à exporter (voir export_zip), par id croissant après `apres_id` :
+    tous, une catégorie et/ou une liste d'ids.
+    Retourne des tuples (id, nom_fichier, categorie, date_ajout epoch, sha256, is_signed,
+    signature_sha256).
+    """
+    conditions = ["d.id > ?"]
+    parametres = [apres_id]
+    if categorie is not None:
+        conditions.append("d.categorie = ?")
+        parametres.append(categorie)
+    if ids is not None:
+        conditions.append("d.id IN (SELECT value FROM json_each(?))")
+        parametres.append(json.dumps(ids))
+    parametres.append(limite)
+    with lecture(DB_NAME) as cursor:
+        cursor.execute(f"""
+            SELECT d.id, d.nom_fichier, d.categorie, d.date_ajout, d.sha256, d.is_signed, d.signature_sha256
+            FROM documents d
+            WHERE {' AND '.join(conditions)}
+            ORDER BY d.id
+            LIMIT ?
+        """, parametres)
+        return cursor.fetchall()
+
+
+# --- RECHERCHE PLEIN TEXTE (FTS5, voir schema_db) ---
+# Marqueurs de surlignage internes (caractères à usage privé), remplacés par <mark>
+# après échappement HTML du texte extrait
+_DEBUT_SURLIGNAGE = '\ue000'
+_FIN_SURLIGNAGE = '\ue001'
+
+def _requete_fts(recherche):
+    """
+    Transforme la saisie de l'utilisateur en requête FTS5 sûre : chaque mot devient
+    un terme entre guillemets, en recherche par préfixe, tous les mots étant requis.
+    """
+    mots = [mot.replace('"', '') for mot in recherche.split()]
+    return ' '.join(f'"{mot}"*' for mot in mots if mot)
+
+def _surligner(texte):
+    if texte is None:
+        return None
+    return (html.escape(texte)
+            .replace(_DEBUT_SURLIGNAGE, '<mark>')
+            .replace(_FIN_SURLIGNAGE, '</mark>'))
+
+@mesurer_requete
+def rechercher_documents(recherche, limite=20, decalage=0, categorie=None, signe=None):
+    """
+    Recherche dans le nom et le texte des documents, classée par pertinence (bm25,
+    le nom pèse plus que le texte). Retourne (documents, total) ; chaque document
+    contient en plus 'nom_surligne' et 'extrait' (HTML échappé, termes entre <mark>).
+    """
+    requete = _requete_fts(recherche)
+    if not requete:
+        return [], 0
+
+    conditions = ["documents_fts MATCH ?"]
+    parametres = [requete]
+    if categorie is not None:
+        conditions.append("d.categorie = ?")
+        parametres.append(categorie)
+    if signe is not None:
+        conditions.append("d.is_signed = ?")
+        parametres.append(1 if signe else 0)
+    where = ' AND '.join(conditions)
+
+    select_query = f"""
+    SELECT {COLONNES_DOCUMENT},
+           highlight(documents_fts, 0, '{_DEBUT_SURLIGNAGE}', '{_FIN_SURLIGNAGE}') AS nom_surligne,
+           snippet(documents_fts, 1, '{_DEBUT_SURLIGNAGE}', '{_FIN_SURLIGNAGE}', '…', 16) AS extrait
+    FROM documents_fts
+    JOIN documents d ON d.id = documents_fts.rowid
+    WHERE {where}
+    ORDER BY bm25(documents_fts, 10.0, 1.0)
+    LIMIT ? OFFSET ?
+    """
+    count_query = f"""
+    SELECT COUNT(*)
+    FROM documents_fts
+    JOIN documents d ON d.id = documents_fts.rowid
+    WHERE {where}
+    """
+
+    with lecture(DB_NAME, dictionnaire=True) as cursor:
+        cursor.execute(select_query, parametres + [limite, decalage])
+        documents = [dict(row) for row in cursor.fetchall()]
+        cursor.execute(count_query, parametres)
+        total = cursor.fetchone()[0]
+
+    for document in documents:
+        document['nom_surligne'] = _surligner(document['nom_surligne'])
+        document['extrait'] = _surligner(document['extrait'])
+    return documents, total
+
+@mesurer_requete(lignes=lambda _: 1)
+def enregistrer_texte_document(doc_id, texte):
+    """Indexe le texte extrait d'un document (sans effet si le document a été supprimé entre-temps)."""
+    with transaction(DB_NAME) as cursor:
+        cursor.execute("UPDATE documents_fts SET texte = ? WHERE rowid = ?", (texte, doc_id))
+        cursor.execute("UPDATE documents SET texte_extrait = 1 WHERE id = ?", (doc_id,))
+
+@mesurer_requete
+def recuperer_documents_sans_texte(limite=100, apres_id=0):
+    """Documents dont le texte n'a pas encore été extrait : liste de (id, nom_fichier, sha256)."""
+    with lecture(DB_NAME) as cursor:
+        cursor.execute("""
+            SELECT id, nom_fichier, sha256 FROM documents
+            WHERE texte_extrait = 0 AND id > ?
+            ORDER BY id
+            LIMIT ?
+        """, (apres_id, limite))
+        return cursor.fetchall()
+
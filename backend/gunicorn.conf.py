@@ -0,0 +1,89 @@
+"""
+Configuration gunicorn du serveur de production (voir serveur_production.py).
+
+    cd backend && gunicorn -c gunicorn.conf.py
+
+- L'application est chargée une seule fois dans le processus maître (preload_app),
+  puis partagée par fork avec les workers ;
+- la base est migrée une seule fois, au démarrage, avant la création des workers ;
+- chaque worker démarre ses propres threads de fond après le fork (les threads
+  ne survivent pas à un fork) ;
+- SIGTERM arrête les workers proprement : les requêtes en cours ont
+  FORMULAMA_ARRET_GRACIEUX secondes pour se terminer ;
+- les flux SSE sont servis par serveur_sse.py, lancé dans un processus à part
+  (FORMULAMA_SSE_BIND) : ils n'occupent pas les threads des workers.
+
+Variables d'environnement : FORMULAMA_BIND, FORMULAMA_WORKERS, FORMULAMA_THREADS,
+FORMULAMA_TIMEOUT, FORMULAMA_ARRET_GRACIEUX, FORMULAMA_MAX_REQUETES, FORMULAMA_SSE_BIND.
+"""
+
+import os
+import subprocess
+import sys
+
+wsgi_app = "app_server:app"
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.environ.get("FORMULAMA_BIND", "0.0.0.0:5001")
+
+# Un processus par cœur ; les threads couvrent les attentes disque et SQLite
+# (les lectures SQLite en WAL se font en parallèle, les écritures restent sérialisées)
+workers = int(os.environ.get("FORMULAMA_WORKERS", os.cpu_count() or 1))
+worker_class = "gthread"
+threads = int(os.environ.get("FORMULAMA_THREADS", "4"))
+preload_app = True
+
+# Délai par requête : large pour les uploads et téléchargements de gros fichiers
+timeout = int(os.environ.get("FORMULAMA_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("FORMULAMA_ARRET_GRACIEUX", "30"))
+keepalive = 5
+# Recyclage périodique des workers (0 = jamais), décalé pour ne pas les recycler tous ensemble
+max_requests = int(os.environ.get("FORMULAMA_MAX_REQUETES", "0"))
+max_requests_jitter = max_requests // 10
+
+# Le journal d'accès est produit par journal.py (JSON échantillonné)
+accesslog = None
+
+# Avant le chargement de l'application : la route du flux SSE redirige vers ce serveur
+os.environ.setdefault("FORMULAMA_SSE_BIND", "0.0.0.0:5002")
+_serveur_sse = None
+
+
+def on_starting(server):
+    """Processus maître, avant la création des workers : migrations une seule fois."""
+    from connexion_db import fermer_connexions
+    from gestion_db import initialiser_base_de_donnees
+    import metriques
+
+    initialiser_base_de_donnees()
+    metriques.reinitialiser_dossier()
+    # Les workers ouvrent leurs propres connexions
+    fermer_connexions()
+
+
+def when_ready(server):
+    """Processus maître, base migrée : lance le serveur SSE (FORMULAMA_SSE_BIND vide : flux servis par l'API)."""
+    global _serveur_sse
+    if os.environ.get("FORMULAMA_SSE_BIND"):
+        _serveur_sse = subprocess.Popen([sys.executable, os.path.join(chdir, "serveur_sse.py")], cwd=chdir)
+
+
+def on_exit(server):
+    if _serveur_sse is not None and _serveur_sse.poll() is None:
+        _serveur_sse.terminate()
+        try:
+            _serveur_sse.wait(graceful_timeout)
+        except subprocess.TimeoutExpired:
+            _serveur_sse.kill()
+
+
+def post_fork(server, worker):
+    """Dans chaque worker : threads de fond ; le rattrapage de l'extraction dans le premier seulement."""
+    import app_server
+
+    app_server.demarrer_services(rattrapage=worker.age == 1)
+
+
+def worker_exit(server, worker):
+    import app_server
+
+    app_server.arreter_services()
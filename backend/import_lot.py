@@ -0,0 +1,144 @@
+"""
+Import de nombreux fichiers en une seule requête (POST /api/documents/ajouter-lot).
+
+Les fichiers reçus (et les membres des archives ZIP envoyées) sont copiés en parallèle
+sur un pool de threads vers le stockage adressé par contenu (stockage_blobs.recevoir :
+empreinte calculée pendant l'écriture), puis tous les documents sont enregistrés en une
+seule transaction (gestion_db.ajouter_documents_en_lot).
+
+Échec partiel : un fichier illisible ou invalide est signalé dans le résultat et les
+autres sont importés ; seule une erreur de la base annule tout le lot.
+"""
+
+import os
+import posixpath
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+from gestion_db import ajouter_documents_en_lot
+import stockage_blobs
+import journal
+
+log = journal.obtenir(__name__)
+
+NB_THREADS = int(os.environ.get("FORMULAMA_LOT_THREADS", "4"))
+NB_FICHIERS_MAX = int(os.environ.get("FORMULAMA_LOT_FICHIERS_MAX", "1000"))
+# Taille décompressée maximale de toutes les archives d'une requête
+TAILLE_ARCHIVES_MAX = int(os.environ.get("FORMULAMA_LOT_TAILLE_MAX", str(4 * 1024 * 1024 * 1024)))
+
+_pool = None
+_pid = None
+
+
+class ErreurLot(Exception):
+    """Lot refusé en entier ; `statut` est le code HTTP à renvoyer."""
+
+    def __init__(self, message, statut=400):
+        super().__init__(message)
+        self.statut = statut
+
+
+def _obtenir_pool():
+    global _pool, _pid
+    # Un pool hérité d'un fork n'a plus de threads : en recréer un
+    if _pool is None or _pid != os.getpid():
+        _pool = ThreadPoolExecutor(max_workers=NB_THREADS, thread_name_prefix="import-lot")
+        _pid = os.getpid()
+    return _pool
+
+
+def arreter():
+    global _pool
+    if _pool is not None and _pid == os.getpid():
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
+def _membres_archive(archive):
+    """Fichiers d'une archive ZIP : [(nom, ouvrir)], sans dossiers ni fichiers cachés."""
+    try:
+        zip_archive = zipfile.ZipFile(archive.stream)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ValueError(f"archive ZIP illisible ({e})")
+    membres = []
+    taille = 0
+    for info in zip_archive.infolist():
+        nom = posixpath.basename(info.filename)
+        if info.is_dir() or not nom or nom.startswith('.') or '__MACOSX/' in info.filename:
+            continue
+        taille += info.file_size
+        # zipfile ne lit jamais plus que la taille déclarée d'un membre
+        membres.append((nom, lambda info=info: zip_archive.open(info)))
+    return membres, taille
+
+
+def importer(dossier_donnees, fichiers, archives, categorie):
+    """
+    Importe les fichiers (werkzeug FileStorage) et le contenu des archives ZIP dans `categorie`.
+    Retourne (resultats, ajoutes) : resultats = [{"nom", "id"} ou {"nom", "error"}] dans
+    l'ordre d'envoi, ajoutes = [(doc_id, blob, nom)] pour les traitements de fond.
+    Lève ErreurLot si le lot est refusé en entier.
+    """
+    sources = []
+    taille_archives = 0
+    for fichier in fichiers:
+        sources.append((fichier.filename, lambda fichier=fichier: fichier.stream))
+    for archive in archives:
+        try:
+            membres, taille = _membres_archive(archive)
+        except ValueError as e:
+            sources.append((archive.filename, e))
+            continue
+        sources.extend(membres)
+        taille_archives += taille
+
+    if len(sources) > NB_FICHIERS_MAX:
+        raise ErreurLot(f"{len(sources)} fichiers : {NB_FICHIERS_MAX} au maximum par lot.", 413)
+    if taille_archives > TAILLE_ARCHIVES_MAX:
+        raise ErreurLot(f"Archives trop volumineuses une fois décompressées ({taille_archives} octets).", 413)
+
+    def recevoir(ouvrir):
+        with ouvrir() as flux:
+            return stockage_blobs.recevoir(flux, dossier_donnees)
+
+    # Copie en parallèle : le débit est celui du disque, pas d'un fichier à la fois
+    taches = []
+    for nom_envoye, ouvrir in sources:
+        nom = secure_filename(nom_envoye or '')
+        if isinstance(ouvrir, Exception):
+            taches.append((nom_envoye, None, str(ouvrir)))
+        elif not nom:
+            taches.append((nom_envoye, None, "nom de fichier invalide"))
+        else:
+            taches.append((nom, _obtenir_pool().submit(recevoir, ouvrir), None))
+
+    resultats = []
+    recus = []
+    for nom, futur, erreur in taches:
+        if futur is not None:
+            try:
+                recus.append((len(resultats), nom, futur.result()))
+            except Exception as e:
+                log.warning("Import en lot : échec de réception de %s : %s", nom, e)
+                erreur = f"échec de la sauvegarde du fichier ({e})"
+        resultats.append({"nom": nom, "error": erreur} if erreur else {"nom": nom})
+
+    entrees = [
+        (nom, f"//localhost/data/{stockage_blobs.chemin_relatif_blob(blob.sha256)}", categorie, blob)
+        for _, nom, blob in recus
+    ]
+    ids = ajouter_documents_en_lot(entrees)
+    if ids is False:
+        for _, _, blob in recus:
+            stockage_blobs.abandonner(blob)
+        raise ErreurLot("Erreur lors de l'insertion dans la base de données", 500)
+
+    ajoutes = []
+    for (indice, nom, blob), doc_id in zip(recus, ids):
+        resultats[indice]["id"] = doc_id
+        ajoutes.append((doc_id, blob, nom))
+    log.info("Import en lot : %s document(s) ajouté(s), %s échec(s)",
+             len(ajoutes), len(resultats) - len(ajoutes), extra={"categorie": categorie})
+    return resultats, ajoutes
@@ -0,0 +1,187 @@
+"""
+Journalisation structurée (une ligne JSON par événement) sans bloquer les requêtes.
+
+Les modules obtiennent un logger avec journal.obtenir(__name__). L'appelant ne fait
+que déposer l'événement dans une file bornée (QueueHandler) ; l'écriture sur la
+sortie standard se fait dans un thread dédié (QueueListener). Si la file est pleine,
+l'événement est abandonné plutôt que de ralentir la requête.
+
+Chaque événement émis pendant une requête porte son identifiant (en-tête
+X-Request-Id reçu, sinon généré, et renvoyé dans la réponse).
+
+Configuration :
+- FORMULAMA_LOG_NIVEAU : DEBUG, INFO (défaut), WARNING, ERROR ;
+- FORMULAMA_LOG_ECHANTILLON : proportion conservée des événements fréquents
+  (journal d'accès, marqués extra={"echantillon": True}), 0.01 par défaut.
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+NIVEAU = os.environ.get("FORMULAMA_LOG_NIVEAU", "INFO").upper()
+TAUX_ECHANTILLONNAGE = float(os.environ.get("FORMULAMA_LOG_ECHANTILLON", "0.01"))
+TAILLE_FILE = 10000
+ENTETE_ID_REQUETE = "X-Request-Id"
+
+# Attributs standard d'un LogRecord : tout le reste vient de extra={...} et est sérialisé
+_ATTRIBUTS_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_verrou = threading.Lock()
+_file = None
+_ecouteur = None
+_abandonnes = 0
+
+
+class _FormatJSON(logging.Formatter):
+    def format(self, record):
+        evenement = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                          .isoformat(timespec="milliseconds"),
+            "niveau": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+        }
+        for cle, valeur in vars(record).items():
+            if cle not in _ATTRIBUTS_STANDARD and cle != "echantillon":
+                evenement[cle] = valeur
+        if record.exc_text:
+            evenement["exception"] = record.exc_text
+        return json.dumps(evenement, ensure_ascii=False, default=str)
+
+
+class _FiltreContexte(logging.Filter):
+    """Exécuté dans le thread appelant : identifiant de requête et échantillonnage."""
+
+    def filter(self, record):
+        if getattr(record, "echantillon", False) and random.random() >= TAUX_ECHANTILLONNAGE:
+            return False
+        if not hasattr(record, "request_id"):
+            request_id = _id_requete_courante()
+            if request_id:
+                record.request_id = request_id
+        return True
+
+
+class _FileNonBloquante(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Le message et la trace sont figés ici (les arguments peuvent changer ensuite) ;
+        # la sérialisation JSON est laissée au thread d'écriture
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        global _abandonnes
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _abandonnes += 1
+
+
+def _id_requete_courante():
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    return g.get("request_id")
+
+
+def _demarrer():
+    """(Re)crée la file et le thread d'écriture ; aussi appelé dans un processus enfant après fork."""
+    global _file, _ecouteur
+    with _verrou:
+        racine = logging.getLogger("formulama")
+        for gestionnaire in list(racine.handlers):
+            racine.removeHandler(gestionnaire)
+
+        sortie = logging.StreamHandler(sys.stdout)
+        sortie.setFormatter(_FormatJSON())
+        _file = queue.Queue(TAILLE_FILE)
+        gestionnaire = _FileNonBloquante(_file)
+        gestionnaire.addFilter(_FiltreContexte())
+        racine.addHandler(gestionnaire)
+        racine.setLevel(NIVEAU)
+        racine.propagate = False
+
+        _ecouteur = logging.handlers.QueueListener(_file, sortie, respect_handler_level=False)
+        _ecouteur.start()
+
+
+def arreter():
+    """Vide la file puis arrête le thread d'écriture (à l'arrêt du serveur)."""
+    global _ecouteur
+    with _verrou:
+        if _ecouteur is not None:
+            _ecouteur.stop()
+            _ecouteur = None
+
+
+def obtenir(nom):
+    """Logger d'un module : journal.obtenir(__name__)."""
+    if _ecouteur is None:
+        _demarrer()
+    return logging.getLogger(f"formulama.{nom}")
+
+
+def nb_abandonnes():
+    """Nombre d'événements abandonnés parce que la file était pleine."""
+    return _abandonnes
+
+
+def instrumenter(app):
+    """Identifiant de requête (X-Request-Id) et journal d'accès échantillonné."""
+    from flask import g, request
+
+    journal_acces = obtenir("acces")
+
+    @app.before_request
+    def _identifier_requete():
+        # Identifiant fourni par un proxy en amont, borné pour ne pas gonfler chaque ligne
+        g.request_id = request.headers.get(ENTETE_ID_REQUETE, "")[:64] or uuid.uuid4().hex
+        g.debut_journal = time.perf_counter()
+
+    @app.after_request
+    def _journaliser_requete(response):
+        request_id = g.get("request_id")
+        if request_id:
+            response.headers[ENTETE_ID_REQUETE] = request_id
+        if journal_acces.isEnabledFor(logging.INFO):
+            journal_acces.info(
+                "%s %s %s", request.method, request.path, response.status_code,
+                extra={
+                    "echantillon": response.status_code < 500,
+                    "statut": response.status_code,
+                    "duree_ms": round((time.perf_counter() - g.get("debut_journal", time.perf_counter())) * 1000, 2),
+                },
+            )
+        return response
+
+
+def _apres_fork():
+    global _verrou
+    # Le verrou a pu être copié alors qu'un autre thread le tenait
+    _verrou = threading.Lock()
+    _demarrer()
+
+
+_demarrer()
+os.register_at_fork(after_in_child=_apres_fork)
+# Enregistré avant les autres modules : la file est vidée après leurs derniers messages
+atexit.register(arreter)
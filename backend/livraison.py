@@ -0,0 +1,237 @@
+"""
+Envoi des fichiers de documents : requêtes conditionnelles et plages d'octets.
+
+- ETag fort dérivé de l'empreinte SHA-256 pour les blobs (stockage_blobs), ETag faible
+  (date de modification + taille) pour les anciens fichiers stockés sous leur nom ;
+- 304 Not Modified sur If-None-Match / If-Modified-Since ;
+- 206 Partial Content sur Range (une ou plusieurs plages, multipart/byteranges), If-Range ;
+- Cache-Control longue durée pour un contenu immuable (un blob ne change jamais).
+
+Les octets du fichier sont envoyés selon FORMULAMA_LIVRAISON (la recherche du document,
+le type MIME, les en-têtes CORS et de cache restent calculés ici) :
+- « sendfile » (défaut) : le fichier est confié au serveur WSGI (wsgi.file_wrapper),
+  y compris pour une plage unique. gunicorn le copie vers la socket par sendfile() sans
+  passer par Python ; waitress le lit encore en Python, dans ses propres threads
+  d'envoi (sous Windows ou waitress, préférer x-accel-redirect derrière nginx) ; lecture
+  par morceaux dans le worker si le serveur ne propose pas de file_wrapper ;
+- « python » : lecture par morceaux de 64 Ko dans le worker ;
+- « x-accel-redirect » (nginx) ou « x-sendfile » (Apache mod_xsendfile, lighttpd) :
+  réponse sans corps, le serveur frontal envoie lui-même le fichier et traite Range.
+  X-Accel-Redirect vaut FORMULAMA_LIVRAISON_PREFIXE suivi du chemin relatif au dossier
+  de données (voir configurer()) ; X-Sendfile contient le chemin absolu.
+"""
+
+import os
+import uuid
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.http import http_date, parse_date, parse_range_header, quote_etag
+from werkzeug.wsgi import wrap_file
+
+import metriques
+import journal
+
+log = journal.obtenir(__name__)
+
+TAILLE_MORCEAU = 64 * 1024
+# Au-delà, la requête Range est ignorée et le fichier complet est envoyé
+NB_PLAGES_MAX = 16
+CACHE_IMMUABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATION = "no-cache"
+
+MODES = ("sendfile", "python", "x-accel-redirect", "x-sendfile")
+MODE = os.environ.get("FORMULAMA_LIVRAISON", "sendfile").strip().lower()
+if MODE not in MODES:
+    log.warning("FORMULAMA_LIVRAISON=%r inconnu (%s) : mode sendfile utilisé", MODE, ", ".join(MODES))
+    MODE = "sendfile"
+PREFIXE_INTERNE = os.environ.get("FORMULAMA_LIVRAISON_PREFIXE", "/fichiers-internes/")
+# Serveurs dont le wsgi.file_wrapper part de la position courante du fichier et s'arrête
+# à Content-Length : une plage unique peut alors aussi lui être confiée (sendfile() sous
+# gunicorn ; waitress lit le fichier en Python mais libère le thread de l'application)
+SERVEURS_PLAGE_FILE_WRAPPER = ("gunicorn", "waitress")
+
+# Dossier servi par le frontal sous PREFIXE_INTERNE (X-Accel-Redirect)
+_racine = None
+
+
+def configurer(racine):
+    """Déclare le dossier de données, base des chemins envoyés dans X-Accel-Redirect."""
+    global _racine
+    _racine = os.path.realpath(racine)
+
+
+def _plages_demandees(taille):
+    """
+    Retourne None si la réponse doit être complète, une liste (éventuellement vide
+    = non satisfaisable) de plages (debut, fin_exclue) triées et fusionnées sinon.
+    """
+    plage = parse_range_header(request.headers.get('Range'))
+    if plage is None or plage.units != 'bytes' or len(plage.ranges) > NB_PLAGES_MAX:
+        return None
+
+    plages = []
+    for debut, fin in plage.ranges:
+        if debut < 0:
+            # Suffixe : les N derniers octets
+            debut, fin = max(0, taille + debut), taille
+        else:
+            fin = taille if fin is None else min(fin, taille)
+        if debut < fin:
+            plages.append((debut, fin))
+
+    plages.sort()
+    fusionnees = []
+    for debut, fin in plages:
+        if fusionnees and debut <= fusionnees[-1][1]:
+            fusionnees[-1] = (fusionnees[-1][0], max(fin, fusionnees[-1][1]))
+        else:
+            fusionnees.append((debut, fin))
+    return fusionnees
+
+
+def _if_range_valide(etag_fort, mtime):
+    """If-Range : n'honorer Range que si la représentation du client est toujours à jour."""
+    valeur = request.headers.get('If-Range')
+    if not valeur:
+        return True
+    if valeur.startswith('"'):
+        # Comparaison forte : un ETag faible ne valide jamais une plage
+        return etag_fort is not None and valeur == quote_etag(etag_fort)
+    date = parse_date(valeur)
+    return date is not None and int(mtime) <= date.timestamp()
+
+
+def _non_modifie(etag, mtime):
+    """Évalue If-None-Match (comparaison faible) puis, à défaut, If-Modified-Since."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return int(mtime) <= request.if_modified_since.timestamp()
+    return False
+
+
+def _lire_plages(chemin, plages, entetes_parties=None, fin_multipart=None):
+    """Générateur qui lit les plages demandées par morceaux de 64 Ko."""
+    with open(chemin, 'rb') as fichier:
+        for index, (debut, fin) in enumerate(plages):
+            if entetes_parties:
+                yield entetes_parties[index]
+            fichier.seek(debut)
+            restant = fin - debut
+            while restant > 0:
+                morceau = fichier.read(min(TAILLE_MORCEAU, restant))
+                if not morceau:
+                    break
+                restant -= len(morceau)
+                yield morceau
+            if entetes_parties:
+                yield b"\r\n"
+        if fin_multipart:
+            yield fin_multipart
+
+
+def _deleguer(chemin):
+    """
+    En-tête confiant l'envoi du fichier au serveur frontal : (nom, valeur), ou None si le
+    fichier est hors du dossier servi par le frontal (il est alors envoyé par le worker).
+    """
+    reel = os.path.realpath(chemin)
+    if MODE == "x-sendfile":
+        return 'X-Sendfile', reel
+    if _racine is None or os.path.commonpath([_racine, reel]) != _racine:
+        return None
+    relatif = os.path.relpath(reel, _racine).replace(os.sep, '/')
+    return 'X-Accel-Redirect', PREFIXE_INTERNE.rstrip('/') + '/' + quote(relatif)
+
+
+def _file_wrapper_plage():
+    """Le serveur sait envoyer une plage unique par wsgi.file_wrapper (voir SERVEURS_PLAGE_FILE_WRAPPER)."""
+    logiciel = request.environ.get('SERVER_SOFTWARE', '').lower()
+    return ('wsgi.file_wrapper' in request.environ
+            and any(logiciel.startswith(serveur) for serveur in SERVEURS_PLAGE_FILE_WRAPPER))
+
+
+def servir_fichier(chemin, mimetype, sha256=None, immuable=False):
+    """
+    Construit la réponse pour le fichier `chemin`.
+    `sha256` fournit un ETag fort ; `immuable=True` autorise la mise en cache longue durée
+    (uniquement si l'URL désigne toujours le même contenu, ex. un document par ID).
+    Lève FileNotFoundError si le fichier n'existe pas.
+    """
+    stat = os.stat(chemin)
+    taille = stat.st_size
+    mtime = stat.st_mtime
+
+    if sha256:
+        etag, faible = sha256, False
+    else:
+        etag, faible = f"{stat.st_mtime_ns:x}-{taille:x}", True
+
+    entetes = {
+        'ETag': quote_etag(etag, faible),
+        'Last-Modified': http_date(mtime),
+        'Cache-Control': CACHE_IMMUABLE if immuable and sha256 else CACHE_REVALIDATION,
+        'Accept-Ranges': 'bytes',
+    }
+
+    if request.method in ('GET', 'HEAD') and _non_modifie(etag, mtime):
+        return Response(status=304, headers=entetes)
+
+    plages = None
+    if _if_range_valide(None if faible else etag, mtime):
+        plages = _plages_demandees(taille)
+
+    if MODE in ("x-accel-redirect", "x-sendfile") and request.method == 'GET':
+        # Le frontal vérifie lui-même Range / If-Range sur le fichier
+        delegation = _deleguer(chemin)
+        if delegation is not None:
+            nom, valeur = delegation
+            entetes[nom] = valeur
+            metriques.incrementer("formulama_livraison_total", mode=MODE)
+            return Response(status=200, mimetype=mimetype, headers=entetes)
+
+    if plages is None:
+        entetes['Content-Length'] = str(taille)
+        if MODE != "python" and 'wsgi.file_wrapper' in request.environ:
+            corps = wrap_file(request.environ, open(chemin, 'rb'), TAILLE_MORCEAU)
+            mode = "sendfile"
+        else:
+            corps = _lire_plages(chemin, [(0, taille)])
+            mode = "python"
+        metriques.incrementer("formulama_livraison_total", mode=mode)
+        return Response(corps, 200, mimetype=mimetype, headers=entetes, direct_passthrough=True)
+
+    if not plages:
+        entetes['Content-Range'] = f"bytes */{taille}"
+        return Response(status=416, headers=entetes)
+
+    if len(plages) == 1:
+        debut, fin = plages[0]
+        entetes['Content-Range'] = f"bytes {debut}-{fin - 1}/{taille}"
+        entetes['Content-Length'] = str(fin - debut)
+        if MODE != "python" and _file_wrapper_plage():
+            fichier = open(chemin, 'rb')
+            fichier.seek(debut)
+            corps = wrap_file(request.environ, fichier, TAILLE_MORCEAU)
+            mode = "sendfile"
+        else:
+            corps = _lire_plages(chemin, plages)
+            mode = "python"
+        metriques.incrementer("formulama_livraison_total", mode=mode)
+        return Response(corps, 206, mimetype=mimetype, headers=entetes, direct_passthrough=True)
+
+    # Plusieurs plages : multipart/byteranges (RFC 9110, section 14.6)
+    separateur = uuid.uuid4().hex
+    entetes_parties = [
+        (f"--{separateur}\r\nContent-Type: {mimetype}\r\n"
+         f"Content-Range: bytes {debut}-{fin - 1}/{taille}\r\n\r\n").encode('latin-1')
+        for debut, fin in plages
+    ]
+    fin_multipart = f"--{separateur}--\r\n".encode('latin-1')
+    longueur = sum(len(e) + (fin - debut) + 2 for e, (debut, fin) in zip(entetes_parties, plages))
+    entetes['Content-Length'] = str(longueur + len(fin_multipart))
+    metriques.incrementer("formulama_livraison_total", mode="python")
+    return Response(_lire_plages(chemin, plages, entetes_parties, fin_multipart), 206,
+                    content_type=f"multipart/byteranges; boundary={separateur}",
+                    headers=entetes, direct_passthrough=True)
@@ -0,0 +1,267 @@
+"""
+Métriques au format texte Prometheus (exposées par GET /metrics).
+
+Chaque processus compte en mémoire (compteurs et histogrammes, sous un verrou) ;
+aucune écriture disque sur le chemin des requêtes. Avec plusieurs processus
+(workers gunicorn), définir FORMULAMA_METRIQUES_DOSSIER : chaque processus y
+publie périodiquement un instantané JSON de ses valeurs, et /metrics additionne
+les instantanés de tous les processus. Le dossier est vidé au démarrage du serveur
+(voir reinitialiser_dossier) ; les instantanés des workers arrêtés sont conservés
+jusque-là pour que les compteurs ne diminuent pas.
+
+Les valeurs sont des totaux depuis le démarrage : le débit (octets/s, requêtes/s)
+se calcule côté Prometheus avec rate().
+"""
+
+import atexit
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import journal
+
+DOSSIER = os.environ.get("FORMULAMA_METRIQUES_DOSSIER")
+INTERVALLE_PUBLICATION_S = float(os.environ.get("FORMULAMA_METRIQUES_INTERVALLE", "5"))
+
+# Bornes des histogrammes de durée, en secondes
+BORNES_DUREE = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# nom -> (type, aide) ; seules les métriques déclarées ici peuvent être mises à jour
+DEFINITIONS = {
+    "formulama_http_requetes_duree_secondes": (
+        "histogram", "Durée de traitement des requêtes HTTP (jusqu'à l'envoi des en-têtes)."),
+    "formulama_http_requetes_total": (
+        "counter", "Requêtes HTTP traitées, par route, méthode et statut."),
+    "formulama_http_octets_recus_total": (
+        "counter", "Octets reçus dans le corps des requêtes (uploads), par route."),
+    "formulama_http_octets_envoyes_total": (
+        "counter", "Octets annoncés dans les réponses (téléchargements), par route."),
+    "formulama_db_duree_secondes": (
+        "histogram", "Durée des fonctions de gestion_db (cache compris)."),
+    "formulama_db_lignes_total": (
+        "counter", "Lignes retournées ou modifiées par les fonctions de gestion_db."),
+    "formulama_db_erreurs_total": (
+        "counter", "Exceptions levées par les fonctions de gestion_db."),
+    "formulama_cache_total": (
+        "counter", "Consultations des caches, par cache et résultat (succes/echec)."),
+    "formulama_livraison_total": (
+        "counter", "Fichiers envoyés, par mode (python, sendfile, x-accel-redirect, x-sendfile)."),
+}
+
+_verrou = threading.Lock()
+# (nom, labels triés) -> valeur (compteur) ou [compte par borne..., somme, nombre] (histogramme)
+_valeurs = {}
+_pid = None
+_fichier = None
+_thread = None
+
+
+def incrementer(nom, valeur=1, **labels):
+    """Ajoute `valeur` au compteur `nom`."""
+    cle = (nom, tuple(sorted(labels.items())))
+    with _verrou:
+        _valeurs[cle] = _valeurs.get(cle, 0) + valeur
+    _demarrer_publication()
+
+
+def observer(nom, valeur, **labels):
+    """Ajoute une observation (en secondes) à l'histogramme `nom`."""
+    cle = (nom, tuple(sorted(labels.items())))
+    with _verrou:
+        seaux = _valeurs.get(cle)
+        if seaux is None:
+            seaux = _valeurs[cle] = [0] * (len(BORNES_DUREE) + 2)
+        for index, borne in enumerate(BORNES_DUREE):
+            if valeur <= borne:
+                seaux[index] += 1
+                break
+        seaux[-2] += valeur
+        seaux[-1] += 1
+    _demarrer_publication()
+
+
+def _nb_lignes(resultat):
+    """Nombre de lignes d'un résultat de gestion_db : liste, (liste, ...), dict d'un document, rowcount."""
+    if resultat is None:
+        return 0
+    if isinstance(resultat, (bool, int)):
+        return resultat
+    if isinstance(resultat, tuple) and resultat and isinstance(resultat[0], list):
+        return len(resultat[0])
+    if isinstance(resultat, list):
+        return len(resultat)
+    return 1
+
+
+def mesurer_requete(fonction=None, lignes=_nb_lignes):
+    """
+    Décorateur des fonctions de gestion_db : durée, lignes (calculées par `lignes(resultat)`)
+    et exceptions, étiquetées par le nom de la fonction.
+    """
+    if fonction is None:
+        return functools.partial(mesurer_requete, lignes=lignes)
+    nom = fonction.__name__
+
+    @functools.wraps(fonction)
+    def enveloppe(*args, **kwargs):
+        debut = time.perf_counter()
+        try:
+            resultat = fonction(*args, **kwargs)
+        except Exception:
+            incrementer("formulama_db_erreurs_total", fonction=nom)
+            raise
+        finally:
+            observer("formulama_db_duree_secondes", time.perf_counter() - debut, fonction=nom)
+        incrementer("formulama_db_lignes_total", lignes(resultat), fonction=nom)
+        return resultat
+    return enveloppe
+
+
+def instrumenter(app):
+    """Mesure toutes les requêtes de l'application Flask et ajoute la route GET /metrics."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _debut_requete():
+        g.debut_requete = time.perf_counter()
+
+    @app.after_request
+    def _fin_requete(response):
+        debut = g.pop('debut_requete', None)
+        if debut is None:
+            return response
+        # Le motif de la route (ex. /api/documents/<int:doc_id>) et non l'URL : cardinalité bornée
+        route = request.url_rule.rule if request.url_rule else "inconnue"
+        observer("formulama_http_requetes_duree_secondes", time.perf_counter() - debut,
+                 route=route, methode=request.method)
+        incrementer("formulama_http_requetes_total", route=route, methode=request.method,
+                    statut=str(response.status_code))
+        if request.content_length:
+            incrementer("formulama_http_octets_recus_total", request.content_length, route=route)
+        if response.content_length:
+            incrementer("formulama_http_octets_envoyes_total", response.content_length, route=route)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def api_metriques():
+        return Response(exposer(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# --- PUBLICATION ET AGRÉGATION ENTRE PROCESSUS ---
+
+def _instantane():
+    with _verrou:
+        return [[nom, list(labels), valeur if isinstance(valeur, (int, float)) else list(valeur)]
+                for (nom, labels), valeur in _valeurs.items()]
+
+
+def publier():
+    """Écrit l'instantané de ce processus dans FORMULAMA_METRIQUES_DOSSIER (remplacement atomique)."""
+    if not DOSSIER or _fichier is None:
+        return
+    os.makedirs(DOSSIER, exist_ok=True)
+    descripteur, chemin_temp = tempfile.mkstemp(dir=DOSSIER, suffix='.part')
+    with os.fdopen(descripteur, 'w') as destination:
+        json.dump(_instantane(), destination)
+    os.replace(chemin_temp, _fichier)
+
+
+def _boucle_publication():
+    while True:
+        time.sleep(INTERVALLE_PUBLICATION_S)
+        try:
+            publier()
+        except OSError as e:
+            journal.obtenir(__name__).error("Publication des métriques impossible : %s", e)
+
+
+def _demarrer_publication():
+    global _pid, _fichier, _thread
+    if not DOSSIER or _pid == os.getpid():
+        return
+    with _verrou:
+        if _pid == os.getpid():
+            return
+        # Après un fork, le processus enfant repart de zéro sous son propre fichier
+        if _pid is not None:
+            _valeurs.clear()
+        _pid = os.getpid()
+        # pid + identifiant unique : un pid réutilisé n'écrase pas les totaux d'un ancien worker
+        _fichier = os.path.join(DOSSIER, f"{_pid}-{uuid.uuid4().hex[:8]}.json")
+        _thread = threading.Thread(target=_boucle_publication, name="metriques", daemon=True)
+        _thread.start()
+    atexit.register(publier)
+
+
+def reinitialiser_dossier():
+    """Vide le dossier des instantanés ; à appeler une fois au démarrage du serveur, avant les workers."""
+    if not DOSSIER or not os.path.isdir(DOSSIER):
+        return
+    for entree in os.scandir(DOSSIER):
+        if entree.name.endswith(('.json', '.part')):
+            os.remove(entree.path)
+
+
+def _agreger():
+    """Additionne les instantanés de tous les processus (ou les seules valeurs locales)."""
+    if not DOSSIER:
+        instantanes = [_instantane()]
+    else:
+        publier()
+        instantanes = []
+        for entree in os.scandir(DOSSIER):
+            if not entree.name.endswith('.json'):
+                continue
+            try:
+                with open(entree.path) as source:
+                    instantanes.append(json.load(source))
+            except (OSError, ValueError):
+                continue
+
+    total = {}
+    for instantane in instantanes:
+        for nom, labels, valeur in instantane:
+            cle = (nom, tuple(tuple(label) for label in labels))
+            if isinstance(valeur, list):
+                cumul = total.setdefault(cle, [0] * len(valeur))
+                for index, v in enumerate(valeur):
+                    cumul[index] += v
+            else:
+                total[cle] = total.get(cle, 0) + valeur
+    return total
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parties = []
+    for cle, valeur in labels:
+        valeur = str(valeur).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parties.append(f'{cle}="{valeur}"')
+    return "{" + ",".join(parties) + "}"
+
+
+def exposer():
+    """Retourne toutes les métriques au format texte Prometheus."""
+    total = _agreger()
+    lignes = []
+    for nom, (type_metrique, aide) in DEFINITIONS.items():
+        series = sorted((labels, valeur) for (n, labels), valeur in total.items() if n == nom)
+        lignes.append(f"# HELP {nom} {aide}")
+        lignes.append(f"# TYPE {nom} {type_metrique}")
+        for labels, valeur in series:
+            if type_metrique != "histogram":
+                lignes.append(f"{nom}{_format_labels(labels)} {valeur}")
+                continue
+            cumul = 0
+            for borne, compte in zip(BORNES_DUREE, valeur):
+                cumul += compte
+                lignes.append(f"{nom}_bucket{_format_labels(labels + (('le', repr(borne)),))} {cumul}")
+            lignes.append(f"{nom}_bucket{_format_labels(labels + (('le', '+Inf'),))} {valeur[-1]}")
+            lignes.append(f"{nom}_sum{_format_labels(labels)} {valeur[-2]}")
+            lignes.append(f"{nom}_count{_format_labels(labels)} {valeur[-1]}")
+    return "\n".join(lignes) + "\n"
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Migrations de données (réécriture de lignes existantes), applicables sur une base en service.
+
+Contrairement aux migrations de schéma (schema_db), une migration de données peut toucher
+toute la table : elle est appliquée par lots d'ids consécutifs, chacun dans une transaction
+courte, avec une pause entre deux lots pour laisser passer les écritures de l'API.
+Le dernier id traité est enregistré dans la transaction du lot (table migrations_donnees) :
+une exécution interrompue reprend exactement où elle s'est arrêtée.
+
+Seuls les documents existant au lancement sont concernés (id ≤ id_max, mémorisé au
+premier lot) ; la condition de chaque migration la rend rejouable sans effet.
+
+    python migrations_donnees.py --liste
+    python migrations_donnees.py categories_non_signe --essai
+    python migrations_donnees.py categories_non_signe [--taille-lot 1000] [--pause 0.05]
+"""
+
+import argparse
+import sqlite3
+import sys
+import time
+from collections import namedtuple
+
+import gestion_db
+import cache_requetes
+from connexion_db import lecture, transaction
+import journal
+
+log = journal.obtenir(__name__)
+
+TAILLE_LOT = 1000
+# Pause entre deux lots (secondes) : le verrou d'écriture est libéré pendant ce temps
+PAUSE_S = 0.05
+INTERVALLE_PROGRESSION_S = 2.0
+
+# `affectation` et `condition` sont des fragments SQL sur la table documents (jamais
+# issus d'une saisie) : UPDATE documents SET <affectation> WHERE <condition>
+MigrationDonnees = namedtuple('MigrationDonnees', ['description', 'affectation', 'condition'])
+
+MIGRATIONS = {
+    "categories_non_signe": MigrationDonnees(
+        "Tous les documents dans la catégorie « Non signé » (ancien migrate_categories.py)",
+        "categorie = 'Non signé'",
+        "categorie IS NOT 'Non signé'",
+    ),
+}
+
+
+def _point_de_reprise(nom):
+    with lecture(gestion_db.DB_NAME, dictionnaire=True) as cursor:
+        cursor.execute("SELECT * FROM migrations_donnees WHERE nom = ?", (nom,))
+        ligne = cursor.fetchone()
+    return dict(ligne) if ligne else None
+
+
+def _id_max():
+    with lecture(gestion_db.DB_NAME) as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM documents")
+        return cursor.fetchone()[0]
+
+
+def estimer(nom, taille_lot=TAILLE_LOT):
+    """
+    Essai à blanc : nombre de documents à modifier et de lots restants, sans rien écrire.
+    Tient compte d'une exécution interrompue.
+    """
+    migration = MIGRATIONS[nom]
+    reprise = _point_de_reprise(nom)
+    if reprise and reprise["statut"] == "terminee":
+        return {"migration": nom, "statut": "terminee", "a_modifier": 0, "lots": 0}
+    dernier_id = reprise["dernier_id"] if reprise else 0
+    id_max = reprise["id_max"] if reprise else _id_max()
+    with lecture(gestion_db.DB_NAME) as cursor:
+        cursor.execute(f"""
+            SELECT COUNT(*), SUM({migration.condition})
+            FROM documents
+            WHERE id > ? AND id <= ?
+        """, (dernier_id, id_max))
+        nb_lignes, a_modifier = cursor.fetchone()
+    return {
+        "migration": nom,
+        "statut": reprise["statut"] if reprise else "nouvelle",
+        "dernier_id": dernier_id,
+        "id_max": id_max,
+        "a_modifier": a_modifier or 0,
+        "lots": -(-nb_lignes // taille_lot),
+    }
+
+
+def _appliquer_lot(nom, migration, dernier_id, id_max, taille_lot):
+    """Un lot dans sa propre transaction. Retourne (nouveau dernier id, lignes modifiées)."""
+    with transaction(gestion_db.DB_NAME) as cursor:
+        # Borne du lot : le taille_lot-ième id suivant (les ids peuvent avoir des trous)
+        cursor.execute(
+            "SELECT id FROM documents WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?",
+            (dernier_id, id_max, taille_lot - 1)
+        )
+        ligne = cursor.fetchone()
+        borne = ligne[0] if ligne else id_max
+        cursor.execute(f"""
+            UPDATE documents SET {migration.affectation}
+            WHERE id > ? AND id <= ? AND ({migration.condition})
+        """, (dernier_id, borne))
+        modifies = cursor.rowcount
+        cursor.execute("""
+            UPDATE migrations_donnees
+            SET dernier_id = ?, nb_modifies = nb_modifies + ?, date_maj = ?,
+                statut = CASE WHEN ? >= id_max THEN 'terminee' ELSE 'en_cours' END
+            WHERE nom = ?
+        """, (borne, modifies, int(time.time()), borne, nom))
+    return borne, modifies
+
+
+def executer(nom, taille_lot=TAILLE_LOT, pause_s=PAUSE_S, recommencer=False, progression=None):
+    """
+    Applique la migration `nom` par lots, en reprenant après le dernier lot validé.
+    `progression(etat)` est appelée régulièrement (dict : dernier_id, id_max, modifies,
+    lots, debit, pourcentage). Retourne le bilan de l'exécution.
+    """
+    migration = MIGRATIONS[nom]
+    maintenant = int(time.time())
+    with transaction(gestion_db.DB_NAME) as cursor:
+        if recommencer:
+            cursor.execute("DELETE FROM migrations_donnees WHERE nom = ?", (nom,))
+        cursor.execute("""
+            INSERT OR IGNORE INTO migrations_donnees (nom, dernier_id, id_max, statut, date_debut, date_maj)
+            SELECT ?, 0, COALESCE(MAX(id), 0), 'en_cours', ?, ? FROM documents
+        """, (nom, maintenant, maintenant))
+    reprise = _point_de_reprise(nom)
+    if reprise["statut"] == "terminee":
+        return {"migration": nom, "statut": "deja_terminee", "modifies": 0, "lots": 0, "duree_s": 0.0}
+
+    dernier_id, id_max = reprise["dernier_id"], reprise["id_max"]
+    premier_id = dernier_id
+    modifies = lots = 0
+    debut = time.perf_counter()
+    prochaine_progression = debut
+
+    while dernier_id < id_max:
+        dernier_id, modifies_lot = _appliquer_lot(nom, migration, dernier_id, id_max, taille_lot)
+        modifies += modifies_lot
+        lots += 1
+        if modifies_lot:
+            cache_requetes.invalider()
+
+        maintenant = time.perf_counter()
+        if progression and (maintenant >= prochaine_progression or dernier_id >= id_max):
+            duree = maintenant - debut
+            progression({
+                "dernier_id": dernier_id,
+                "id_max": id_max,
+                "modifies": modifies,
+                "lots": lots,
+                "debit": round(modifies / duree, 1) if duree else None,
+                "pourcentage": round(100 * (dernier_id - premier_id) / max(1, id_max - premier_id), 1),
+            })
+            prochaine_progression = maintenant + INTERVALLE_PROGRESSION_S
+        if pause_s and dernier_id < id_max:
+            time.sleep(pause_s)
+
+    if id_max == 0:
+        # Base vide : rien à parcourir
+        with transaction(gestion_db.DB_NAME) as cursor:
+            cursor.execute("UPDATE migrations_donnees SET statut = 'terminee' WHERE nom = ?", (nom,))
+
+    bilan = {
+        "migration": nom,
+        "statut": "terminee",
+        "reprise_apres_id": premier_id,
+        "modifies": modifies,
+        "lots": lots,
+        "duree_s": round(time.perf_counter() - debut, 3),
+    }
+    log.info("Migration de données %s terminée : %s document(s) modifié(s) en %s lot(s)",
+             nom, modifies, lots, extra=bilan)
+    return bilan
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Migrations de données par lots, avec reprise.")
+    parser.add_argument("migration", nargs="?", choices=sorted(MIGRATIONS), help="migration à appliquer")
+    parser.add_argument("--liste", action="store_true", help="lister les migrations et leur état")
+    parser.add_argument("--essai", action="store_true", help="compter les documents concernés sans rien modifier")
+    parser.add_argument("--taille-lot", type=int, default=TAILLE_LOT, help=f"documents par transaction ({TAILLE_LOT})")
+    parser.add_argument("--pause", type=float, default=PAUSE_S, help=f"pause entre deux lots en secondes ({PAUSE_S})")
+    parser.add_argument("--recommencer", action="store_true", help="ignorer le point de reprise et tout reparcourir")
+    args = parser.parse_args(arguments)
+    if args.taille_lot < 1:
+        parser.error("--taille-lot doit être positif")
+
+    print(f"📂 Base de données: {gestion_db.DB_NAME}", file=sys.stderr)
+    gestion_db.initialiser_base_de_donnees()
+
+    if args.liste or not args.migration:
+        for nom, migration in sorted(MIGRATIONS.items()):
+            reprise = _point_de_reprise(nom)
+            etat = f"{reprise['statut']}, id {reprise['dernier_id']}/{reprise['id_max']}" if reprise else "jamais lancée"
+            print(f"  - {nom} ({etat}) : {migration.description}")
+        return True
+
+    if args.essai:
+        estimation = estimer(args.migration, args.taille_lot)
+        print(f"🔎 Essai : {estimation['a_modifier']} document(s) à modifier en {estimation['lots']} lot(s) "
+              f"(état : {estimation['statut']})")
+        return True
+
+    def afficher(etat):
+        print(f"  … id {etat['dernier_id']}/{etat['id_max']} ({etat['pourcentage']} %), "
+              f"{etat['modifies']} modifié(s), {etat['lots']} lot(s), {etat['debit']} doc/s", file=sys.stderr)
+
+    try:
+        bilan = executer(args.migration, args.taille_lot, args.pause, args.recommencer, afficher)
+    except KeyboardInterrupt:
+        print("⏸️  Migration interrompue : relancer la même commande pour reprendre.", file=sys.stderr)
+        return False
+    except sqlite3.Error as e:
+        print(f"❌ Erreur lors de la migration (reprise possible au dernier lot validé): {e}", file=sys.stderr)
+        return False
+    if bilan["statut"] == "deja_terminee":
+        print(f"✅ Migration {bilan['migration']} déjà appliquée (--recommencer pour la rejouer)")
+        return True
+    print(f"✅ Migration {bilan['migration']} : {bilan['modifies']} document(s) modifié(s) "
+          f"en {bilan['lots']} lot(s), {bilan['duree_s']} s")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,212 @@
+"""
+Miniatures des documents (première page des PDF, images réduites).
+
+Les miniatures sont générées en arrière-plan sur un pool de threads, dès l'upload,
+et conservées dans data/miniatures avec un budget disque : au-delà, les moins
+récemment consultées sont supprimées (LRU, la date de modification du fichier
+servant de date de dernier accès).
+
+Dépendances optionnelles : Pillow (images et encodage JPEG) et PyMuPDF (rendu PDF).
+Sans elles, aucune miniature n'est produite et l'API répond 404.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+
+import metriques
+import journal
+
+log = journal.obtenir(__name__)
+
+DOSSIER_MINIATURES = 'miniatures'
+TAILLE_MAX_PIXELS = int(os.environ.get("FORMULAMA_MINIATURES_PIXELS", "320"))
+BUDGET_OCTETS = int(os.environ.get("FORMULAMA_MINIATURES_BUDGET", str(200 * 1024 * 1024)))
+NB_THREADS = int(os.environ.get("FORMULAMA_MINIATURES_THREADS", "2"))
+QUALITE_JPEG = 80
+
+_verrou = threading.Lock()
+_pool = None
+_pid = None
+# Miniatures en cours de génération : cle -> Future
+_en_cours = {}
+# Taille totale du cache, estimée au premier passage puis tenue à jour (None = inconnue)
+_taille_totale = None
+# Échecs récents : cle -> instant (monotonic) ; pas de nouvel essai avant DELAI_NOUVEL_ESSAI_S
+_echecs = OrderedDict()
+NB_ECHECS_MAX = 1000
+DELAI_NOUVEL_ESSAI_S = 600
+
+
+def est_disponible(mimetype):
+    """Indique si une miniature peut être produite pour ce type de fichier."""
+    if Image is None:
+        return False
+    if mimetype == 'application/pdf':
+        return fitz is not None
+    return mimetype in ('image/png', 'image/jpg', 'image/jpeg', 'image/gif')
+
+
+def cle_miniature(chemin_source, sha256=None):
+    """Clé de cache : l'empreinte du contenu, ou date/taille pour les anciens fichiers nommés."""
+    if sha256:
+        return sha256
+    stat = os.stat(chemin_source)
+    return f"fichier-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def _chemin_miniature(dossier_donnees, cle):
+    return os.path.join(dossier_donnees, DOSSIER_MINIATURES, cle[:2], f"{cle}-{TAILLE_MAX_PIXELS}.jpg")
+
+
+def obtenir(dossier_donnees, cle):
+    """Retourne le chemin de la miniature si elle est en cache (et la marque comme utilisée)."""
+    chemin = _chemin_miniature(dossier_donnees, cle)
+    try:
+        os.utime(chemin)
+    except FileNotFoundError:
+        metriques.incrementer("formulama_cache_total", cache="miniatures", resultat="echec")
+        return None
+    metriques.incrementer("formulama_cache_total", cache="miniatures", resultat="succes")
+    return chemin
+
+
+def _rendre(chemin_source, mimetype):
+    """Produit l'image PIL réduite à TAILLE_MAX_PIXELS de côté."""
+    if mimetype == 'application/pdf':
+        with fitz.open(chemin_source) as pdf:
+            page = pdf[0]
+            # Rendu directement à la bonne échelle : pas de page pleine résolution en mémoire
+            echelle = TAILLE_MAX_PIXELS / max(page.rect.width, page.rect.height)
+            pixmap = page.get_pixmap(matrix=fitz.Matrix(echelle, echelle), alpha=False)
+            image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+    else:
+        image = Image.open(chemin_source)
+        # draft() permet au décodeur JPEG de ne lire qu'une version réduite
+        image.draft("RGB", (TAILLE_MAX_PIXELS, TAILLE_MAX_PIXELS))
+        image.thumbnail((TAILLE_MAX_PIXELS, TAILLE_MAX_PIXELS))
+    return image.convert("RGB")
+
+
+def _generer(dossier_donnees, chemin_source, mimetype, cle):
+    global _taille_totale
+    try:
+        chemin = _chemin_miniature(dossier_donnees, cle)
+        if os.path.exists(chemin):
+            return chemin
+        image = _rendre(chemin_source, mimetype)
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+        descripteur, chemin_temp = tempfile.mkstemp(dir=os.path.dirname(chemin), suffix='.part')
+        try:
+            with os.fdopen(descripteur, 'wb') as destination:
+                image.save(destination, "JPEG", quality=QUALITE_JPEG, optimize=True)
+            os.replace(chemin_temp, chemin)
+        except BaseException:
+            # Le .part ne doit pas rester hors budget dans le dossier des miniatures
+            try:
+                os.unlink(chemin_temp)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with _verrou:
+            if _taille_totale is not None:
+                _taille_totale += os.path.getsize(chemin)
+        _respecter_budget(dossier_donnees)
+        return chemin
+    except Exception as e:
+        log.warning("Miniature impossible pour %s : %s", chemin_source, e)
+        with _verrou:
+            _echecs[cle] = time.monotonic()
+            while len(_echecs) > NB_ECHECS_MAX:
+                _echecs.popitem(last=False)
+        return None
+    finally:
+        with _verrou:
+            _en_cours.pop(cle, None)
+
+
+def _respecter_budget(dossier_donnees):
+    """Supprime les miniatures les moins récemment utilisées au-delà du budget disque."""
+    global _taille_totale
+    with _verrou:
+        if _taille_totale is not None and _taille_totale <= BUDGET_OCTETS:
+            return
+
+    racine = os.path.join(dossier_donnees, DOSSIER_MINIATURES)
+    fichiers = []
+    for sous_dossier in os.scandir(racine):
+        if not sous_dossier.is_dir():
+            continue
+        for entree in os.scandir(sous_dossier.path):
+            if entree.is_file() and entree.name.endswith('.jpg'):
+                stat = entree.stat()
+                fichiers.append((stat.st_mtime, stat.st_size, entree.path))
+
+    total = sum(taille for _, taille, _ in fichiers)
+    if total > BUDGET_OCTETS:
+        # Descendre à 90 % du budget pour ne pas évincer à chaque nouvelle miniature
+        cible = BUDGET_OCTETS * 0.9
+        for _, taille, chemin in sorted(fichiers):
+            if total <= cible:
+                break
+            try:
+                os.remove(chemin)
+                total -= taille
+            except FileNotFoundError:
+                pass
+    with _verrou:
+        _taille_totale = total
+
+
+def _obtenir_pool():
+    global _pool, _pid
+    # Un pool hérité d'un fork n'a plus de threads : en recréer un
+    if _pool is None or _pid != os.getpid():
+        _pool = ThreadPoolExecutor(max_workers=NB_THREADS, thread_name_prefix="miniatures")
+        _pid = os.getpid()
+        _en_cours.clear()
+        _echecs.clear()
+    return _pool
+
+
+def planifier(dossier_donnees, chemin_source, mimetype, cle):
+    """
+    Demande la génération de la miniature en arrière-plan (sans effet si elle existe
+    déjà ou est en cours). Retourne le Future correspondant, ou None si aucune miniature
+    ne peut être produite (type non pris en charge, échec récent pour ce contenu).
+    """
+    if not est_disponible(mimetype):
+        return None
+    with _verrou:
+        echec = _echecs.get(cle)
+        if echec is not None:
+            if time.monotonic() - echec < DELAI_NOUVEL_ESSAI_S:
+                return None
+            del _echecs[cle]
+        futur = _en_cours.get(cle)
+        if futur is None or futur.done():
+            futur = _obtenir_pool().submit(_generer, dossier_donnees, chemin_source, mimetype, cle)
+            _en_cours[cle] = futur
+    return futur
+
+
+def arreter():
+    """Arrête le pool (les miniatures manquantes seront regénérées à la demande)."""
+    global _pool
+    if _pool is not None and _pid == os.getpid():
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
@@ -0,0 +1,278 @@
+"""
+Flux des modifications des documents (ajouts, suppressions, modifications).
+
+Le journal est écrit par triggers dans la transaction de chaque écriture (voir
+schema_db) ; chaque entrée porte un numéro de séquence croissant. Un client :
+- lit GET /api/documents/modifications?depuis=N pour obtenir les changements après N ;
+- ou s'abonne au flux SSE GET /api/documents/modifications/flux (reprise par Last-Event-ID).
+
+Un seul thread par processus (le notificateur) surveille la base : PRAGMA data_version
+ne change qu'après une écriture validée par une autre connexion, le journal n'est donc
+relu qu'après une écriture. Les nouvelles entrées sont lues une fois, gardées dans un
+tampon commun, et tous les abonnés sont réveillés ensemble. Un abonné inactif ne fait
+qu'attendre sur une condition (ni requête SQL ni calcul), hormis un commentaire toutes
+les BATTEMENT_S secondes pour garder la connexion ouverte.
+
+En production, les flux sont servis par serveur_sse (boucle asyncio dans un processus
+à part, sans thread par abonné) ; la route de l'API y redirige les clients. Sans ce
+serveur (serveur de développement, FORMULAMA_SSE_BIND vide), chaque flux occupe un
+thread de requête : le nombre d'abonnés par processus est alors borné (FORMULAMA_SSE_MAX,
+la moitié des threads par défaut). Un flux est fermé après FORMULAMA_SSE_DUREE secondes
+(le navigateur se reconnecte seul).
+
+Le journal est purgé par le ramasse-miettes au-delà de FORMULAMA_MODIFICATIONS_RETENTION
+secondes (7 jours par défaut) ; un client plus en retard reçoit « reinitialiser » et
+relit les listes complètes.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import gestion_db
+from connexion_db import lecture, obtenir_connexion, transaction
+import journal
+
+log = journal.obtenir(__name__)
+
+INTERVALLE_S = float(os.environ.get("FORMULAMA_MODIFICATIONS_INTERVALLE", "0.25"))
+RETENTION_S = int(os.environ.get("FORMULAMA_MODIFICATIONS_RETENTION", str(7 * 24 * 3600)))
+NB_ABONNES_MAX = int(os.environ.get("FORMULAMA_SSE_MAX",
+                                    str(max(1, int(os.environ.get("FORMULAMA_THREADS", "4")) // 2))))
+DUREE_FLUX_S = float(os.environ.get("FORMULAMA_SSE_DUREE", "300"))
+BATTEMENT_S = 15
+RECONNEXION_MS = 2000
+TAILLE_LOT = 500
+TAILLE_TAMPON = 1000
+
+_condition = threading.Condition()
+_tampon = deque(maxlen=TAILLE_TAMPON)
+# Dernière séquence lue par le notificateur
+_derniere = 0
+_abonnes = 0
+# Rappels appelés par le notificateur après chaque réveil des abonnés (voir serveur_sse)
+_observateurs = []
+_arret = threading.Event()
+_thread = None
+_pid = None
+
+
+class ErreurAbonnement(Exception):
+    """Plus de place pour un nouvel abonné dans ce processus."""
+
+
+# --- LECTURE DU JOURNAL ---
+
+def _en_dict(ligne):
+    seq, doc_id, operation, categorie, categorie_precedente = ligne[:5]
+    modification = {"seq": seq, "operation": operation, "id": doc_id, "categorie": categorie}
+    if categorie_precedente is not None:
+        modification["categorie_precedente"] = categorie_precedente
+    # État actuel du document (None s'il a été supprimé depuis)
+    document = ligne[5:]
+    modification["document"] = None if document[0] is None else dict(
+        zip(('id', 'nom_fichier', 'chemin_local', 'categorie', 'date_ajout', 'is_signed'), document)
+    )
+    return modification
+
+
+def _derniere_sequence(cursor):
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'journal_modifications'")
+    ligne = cursor.fetchone()
+    return ligne[0] if ligne else 0
+
+
+def derniere_sequence():
+    """Numéro de la dernière modification (0 si aucune)."""
+    with lecture(gestion_db.DB_NAME) as cursor:
+        return _derniere_sequence(cursor)
+
+
+def lire(depuis, limite=TAILLE_LOT):
+    """
+    Modifications de numéro supérieur à `depuis`, dans l'ordre. Retourne (modifications,
+    dernière séquence) ; modifications vaut None si le journal ne remonte plus jusqu'à
+    `depuis` (purgé) ou si `depuis` est inconnu (base recréée) : le client doit tout relire.
+    """
+    with lecture(gestion_db.DB_NAME) as cursor:
+        derniere = _derniere_sequence(cursor)
+        cursor.execute("SELECT MIN(seq) FROM journal_modifications")
+        premiere = cursor.fetchone()[0]
+        if depuis > derniere or (depuis < derniere and (premiere is None or depuis < premiere - 1)):
+            return None, derniere
+        cursor.execute(f"""
+            SELECT m.seq, m.doc_id, m.operation, m.categorie, m.categorie_precedente,
+                   {gestion_db.COLONNES_DOCUMENT}
+            FROM journal_modifications m
+            LEFT JOIN documents d ON d.id = m.doc_id AND m.operation != 'suppression'
+            WHERE m.seq > ?
+            ORDER BY m.seq
+            LIMIT ?
+        """, (depuis, limite))
+        return [_en_dict(ligne) for ligne in cursor.fetchall()], derniere
+
+
+def purger(limite=5000):
+    """Supprime les entrées plus anciennes que RETENTION_S. Retourne le nombre supprimé."""
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute("""
+            DELETE FROM journal_modifications
+            WHERE seq IN (SELECT seq FROM journal_modifications WHERE date < ? ORDER BY seq LIMIT ?)
+        """, (int(time.time()) - RETENTION_S, limite))
+        return cursor.rowcount
+
+
+# --- NOTIFICATEUR PARTAGÉ ---
+
+def _rattraper():
+    """Lit les entrées nouvelles une seule fois pour tous les abonnés, puis les réveille."""
+    global _derniere
+    while True:
+        with _condition:
+            depuis = _derniere
+        modifications, derniere = lire(depuis, TAILLE_LOT)
+        with _condition:
+            if modifications is None:
+                # Base recréée ou journal purgé : les abonnés en retard relisent tout
+                _tampon.clear()
+                _derniere = derniere
+                _condition.notify_all()
+            elif modifications:
+                _tampon.extend(modifications)
+                _derniere = modifications[-1]["seq"]
+                _condition.notify_all()
+        if modifications is None or modifications:
+            for rappel in _observateurs:
+                rappel()
+        if modifications is None or len(modifications) < TAILLE_LOT:
+            return
+
+
+def _boucle():
+    connexion = obtenir_connexion(gestion_db.DB_NAME)
+    version = None
+    while not _arret.is_set():
+        try:
+            nouvelle_version = connexion.execute("PRAGMA data_version").fetchone()[0]
+            if nouvelle_version != version:
+                version = nouvelle_version
+                _rattraper()
+        except sqlite3.Error as e:
+            log.error("Notificateur des modifications : erreur de base de données : %s", e)
+        _arret.wait(INTERVALLE_S)
+
+
+def demarrer():
+    """Démarre le notificateur s'il ne tourne pas déjà dans ce processus."""
+    global _thread, _pid, _derniere
+    with _condition:
+        # Après un fork, le thread du processus parent n'existe plus dans l'enfant
+        if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+            return
+        _arret.clear()
+        _tampon.clear()
+        _derniere = derniere_sequence()
+        _pid = os.getpid()
+        _thread = threading.Thread(target=_boucle, name="notificateur-modifications", daemon=True)
+        _thread.start()
+
+
+def observer(rappel):
+    """Enregistre `rappel()`, appelé dans le thread du notificateur à chaque nouvelle modification."""
+    _observateurs.append(rappel)
+
+
+def derniere_lue():
+    """Dernière séquence lue par le notificateur (point de départ d'un nouvel abonné)."""
+    with _condition:
+        return _derniere
+
+
+def arreter(delai=5):
+    """Arrête le notificateur et termine les flux ouverts."""
+    _arret.set()
+    with _condition:
+        _condition.notify_all()
+    if _thread is not None and _thread.is_alive():
+        _thread.join(delai)
+
+
+# --- ABONNÉS (SSE) ---
+
+def en_tampon(curseur):
+    """Modifications après `curseur` prises dans le tampon commun, ou None s'il ne remonte pas jusque-là."""
+    with _condition:
+        if curseur >= _derniere:
+            return []
+        if _tampon and _tampon[0]["seq"] <= curseur + 1:
+            return [m for m in _tampon if m["seq"] > curseur]
+    return None
+
+
+def _suivantes(curseur):
+    """Modifications après `curseur` : depuis le tampon commun, ou la base pour un abonné en retard."""
+    modifications = en_tampon(curseur)
+    if modifications is None:
+        return lire(curseur, TAILLE_LOT)[0]
+    return modifications
+
+
+def evenement(modification):
+    donnees = json.dumps(modification, ensure_ascii=False, separators=(',', ':'))
+    return f"id: {modification['seq']}\nevent: modification\ndata: {donnees}\n\n"
+
+
+def reserver_abonnement():
+    """Réserve une place d'abonné ; lève ErreurAbonnement si le processus est complet."""
+    global _abonnes
+    demarrer()
+    with _condition:
+        if _abonnes >= NB_ABONNES_MAX:
+            raise ErreurAbonnement(f"{NB_ABONNES_MAX} abonné(s) au maximum par processus.")
+        _abonnes += 1
+
+
+def liberer_abonnement():
+    global _abonnes
+    with _condition:
+        _abonnes -= 1
+
+
+def flux(depuis=None):
+    """
+    Générateur du flux SSE à partir de la modification `depuis` (exclue), ou des
+    prochaines modifications si `depuis` est None. Appeler reserver_abonnement() avant.
+    """
+    fin = time.monotonic() + DUREE_FLUX_S
+    yield f"retry: {RECONNEXION_MS}\n\n"
+
+    if depuis is None:
+        with _condition:
+            curseur = _derniere
+    elif lire(depuis, 0)[0] is None:
+        yield "event: reinitialiser\ndata: {}\n\n"
+        return
+    else:
+        curseur = depuis
+    prochain_battement = time.monotonic() + BATTEMENT_S
+
+    while not _arret.is_set() and time.monotonic() < fin:
+        modifications = _suivantes(curseur)
+        if modifications is None:
+            yield "event: reinitialiser\ndata: {}\n\n"
+            return
+        if modifications:
+            yield ''.join(evenement(m) for m in modifications)
+            curseur = modifications[-1]["seq"]
+            prochain_battement = time.monotonic() + BATTEMENT_S
+            continue
+
+        with _condition:
+            _condition.wait_for(lambda: _derniere > curseur or _arret.is_set(),
+                                timeout=max(0, min(prochain_battement, fin) - time.monotonic()))
+        if time.monotonic() >= prochain_battement:
+            yield ": battement\n\n"
+            prochain_battement = time.monotonic() + BATTEMENT_S
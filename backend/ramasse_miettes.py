@@ -0,0 +1,102 @@
+"""
+Ramasse-miettes des fichiers de documents supprimés.
+
+Les suppressions en base inscrivent les fichiers à effacer dans la table
+'fichiers_a_supprimer' (voir gestion_db.supprimer_documents_en_masse). Un thread
+de fond efface ensuite ces fichiers du disque par lots. La liste étant persistée,
+le travail reprend simplement au redémarrage après un arrêt brutal.
+"""
+
+import os
+import sqlite3
+import threading
+
+import gestion_db
+import sessions_upload
+import modifications
+import journal
+
+log = journal.obtenir(__name__)
+
+# Délai entre deux passages lorsqu'aucun réveil n'a été demandé (secondes)
+INTERVALLE_SECONDES = float(os.environ.get("FORMULAMA_GC_INTERVALLE", "60"))
+TAILLE_LOT = 500
+
+_verrou = threading.Lock()
+_reveil = threading.Event()
+_arret = threading.Event()
+_thread = None
+_pid = None
+_dossier_donnees = None
+
+
+def collecter(dossier_donnees):
+    """
+    Traite toute la liste d'attente et retourne le nombre de fichiers effacés.
+    Un fichier de nouveau référencé par un document (ré-upload) est conservé.
+    """
+    racine = os.path.realpath(dossier_donnees)
+    effaces = 0
+
+    def effacer(chemin):
+        nonlocal effaces
+        chemin_absolu = os.path.realpath(os.path.join(racine, *chemin.split('/')))
+        # Ne jamais sortir du dossier de données
+        if os.path.commonpath([racine, chemin_absolu]) != racine:
+            return
+        try:
+            os.remove(chemin_absolu)
+            effaces += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.error("Ramasse-miettes : impossible d'effacer %s : %s", chemin_absolu, e)
+
+    while not _arret.is_set():
+        if not gestion_db.traiter_fichiers_a_supprimer(effacer, TAILLE_LOT):
+            break
+    return effaces
+
+
+def _boucle():
+    while not _arret.is_set():
+        try:
+            effaces = collecter(_dossier_donnees)
+            if effaces:
+                log.info("Ramasse-miettes : %s fichier(s) effacé(s)", effaces)
+            expirees = sessions_upload.purger_expirees(_dossier_donnees)
+            if expirees:
+                log.info("Ramasse-miettes : %s session(s) d'upload expirée(s) supprimée(s)", expirees)
+            modifications.purger()
+        except sqlite3.Error as e:
+            log.error("Ramasse-miettes : erreur de base de données : %s", e)
+        _reveil.wait(INTERVALLE_SECONDES)
+        _reveil.clear()
+
+
+def demarrer(dossier_donnees):
+    """Démarre le thread du ramasse-miettes s'il ne tourne pas déjà dans ce processus."""
+    global _thread, _pid, _dossier_donnees
+    with _verrou:
+        _dossier_donnees = dossier_donnees
+        # Après un fork, le thread du processus parent n'existe plus dans l'enfant
+        if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+            return
+        _arret.clear()
+        _pid = os.getpid()
+        _thread = threading.Thread(target=_boucle, name="ramasse-miettes", daemon=True)
+        _thread.start()
+
+
+def reveiller(dossier_donnees):
+    """Demande un passage immédiat (après une suppression), en démarrant le thread au besoin."""
+    demarrer(dossier_donnees)
+    _reveil.set()
+
+
+def arreter(delai=5):
+    """Arrête le thread ; le travail restant sera repris au prochain démarrage."""
+    _arret.set()
+    _reveil.set()
+    if _thread is not None and _thread.is_alive():
+        _thread.join(delai)
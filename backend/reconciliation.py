@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Réconciliation entre le dossier de données et la base (remplace diagnostiquer_fichiers_locaux).
+
+Le dossier est parcouru avec os.scandir et chaque fichier est comparé au manifeste
+persistant (table manifeste_fichiers : dossier, nom, taille, mtime, inode). Seuls les
+fichiers nouveaux, modifiés ou disparus sont réécrits dans le manifeste ; la
+comparaison avec les tables 'documents' et 'blobs' se fait ensuite en SQL, sur des
+index, ce qui reste rapide avec des millions de fichiers.
+
+Le rapport liste :
+- les fichiers orphelins (sur le disque mais référencés par aucun document) ;
+- les fichiers manquants (document en base dont le fichier n'existe plus) ;
+- les blobs dont la taille ne correspond pas à celle enregistrée.
+
+Par défaut le parcours est incrémental : un fichier déjà présent dans le manifeste
+avec le même inode n'est pas relu (aucun stat, seul scandir est appelé). Sa taille
+n'est alors pas revérifiée ; le parcours complet (--complet, ?complet=1) refait un
+stat de chaque fichier, soit un appel système par fichier, long sur de gros volumes
+ou un stockage réseau : à réserver à une vérification ponctuelle des tailles.
+
+Les fichiers des uploads reprenables en cours (blobs/tmp/session-<id>.part, voir
+sessions_upload) ne sont jamais des orphelins : ils sont supprimés avec leur session.
+
+En mode réparation, les orphelins sont confiés au ramasse-miettes et, sur demande
+explicite, les documents dont le fichier manque sont supprimés de la base.
+
+Utilisation : python reconciliation.py [--reparer] [--supprimer-manquants] [--complet]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import gestion_db
+from connexion_db import lecture, transaction
+from stockage_blobs import DOSSIER_BLOBS
+
+# Fichiers du dossier de données qui ne sont pas des documents
+FICHIERS_IGNORES = {'documents.db', 'documents.db-wal', 'documents.db-shm', 'documents.db-journal'}
+# Un fichier temporaire d'upload plus ancien est considéré comme abandonné
+AGE_TEMPORAIRE_ABANDONNE_S = 24 * 3600
+# Nombre maximal d'éléments détaillés par catégorie du rapport (les totaux sont exacts)
+LIMITE_RAPPORT = 1000
+# Modifications du manifeste regroupées par transaction
+TAILLE_LOT_ECRITURE = 5000
+
+
+def _fichiers_du_dossier(chemin_absolu, rapide, connus_dossier):
+    """
+    Retourne ({nom: (taille, mtime_ns, inode)}, sous_dossiers) pour un dossier.
+    En mode rapide, un fichier déjà connu avec le même inode n'est pas relu (pas de stat).
+    """
+    fichiers = {}
+    sous_dossiers = []
+    with os.scandir(chemin_absolu) as entrees:
+        for entree in entrees:
+            if entree.name.startswith('.'):
+                continue
+            if entree.is_dir(follow_symlinks=False):
+                sous_dossiers.append(entree.name)
+            elif entree.is_file(follow_symlinks=False):
+                connu = connus_dossier.get(entree.name)
+                # inode() est fourni par scandir sans appel système supplémentaire
+                if rapide and connu is not None and connu[2] == entree.inode():
+                    fichiers[entree.name] = connu
+                    continue
+                stat = entree.stat(follow_symlinks=False)
+                fichiers[entree.name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    return fichiers, sous_dossiers
+
+
+def _connus(dossier):
+    with lecture(gestion_db.DB_NAME) as cursor:
+        cursor.execute(
+            "SELECT nom, taille, mtime_ns, inode FROM manifeste_fichiers WHERE dossier = ?",
+            (dossier,)
+        )
+        return {nom: (taille, mtime_ns, inode) for nom, taille, mtime_ns, inode in cursor}
+
+
+def _ecrire(modifications, suppressions):
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.executemany("""
+            INSERT INTO manifeste_fichiers (dossier, nom, taille, mtime_ns, inode)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (dossier, nom) DO UPDATE SET
+                taille = excluded.taille, mtime_ns = excluded.mtime_ns, inode = excluded.inode
+        """, modifications)
+        cursor.executemany(
+            "DELETE FROM manifeste_fichiers WHERE dossier = ? AND nom = ?", suppressions
+        )
+
+
+def mettre_a_jour_manifeste(dossier_donnees, rapide=True):
+    """
+    Parcourt le dossier de données (fichiers à la racine et arborescence des blobs)
+    et met le manifeste à jour. Retourne les statistiques du parcours.
+    """
+    statistiques = {"fichiers": 0, "modifies": 0, "disparus": 0}
+    modifications = []
+    suppressions = []
+    dossiers_vus = []
+
+    def vider():
+        if modifications or suppressions:
+            _ecrire(modifications, suppressions)
+            modifications.clear()
+            suppressions.clear()
+
+    # (chemin relatif, ignorer les sous-dossiers) ; à la racine seuls les blobs sont parcourus
+    a_parcourir = [('', True)]
+    while a_parcourir:
+        dossier, racine = a_parcourir.pop()
+        chemin_absolu = os.path.join(dossier_donnees, *dossier.split('/')) if dossier else dossier_donnees
+        connus = _connus(dossier)
+        try:
+            fichiers, sous_dossiers = _fichiers_du_dossier(chemin_absolu, rapide, connus)
+        except FileNotFoundError:
+            fichiers, sous_dossiers = {}, []
+        dossiers_vus.append(dossier)
+
+        if racine:
+            for nom in FICHIERS_IGNORES:
+                fichiers.pop(nom, None)
+            if DOSSIER_BLOBS in sous_dossiers:
+                a_parcourir.append((DOSSIER_BLOBS, False))
+        else:
+            a_parcourir.extend((f"{dossier}/{nom}", False) for nom in sous_dossiers)
+
+        statistiques["fichiers"] += len(fichiers)
+        modifies = [(dossier, nom) + valeurs for nom, valeurs in fichiers.items() if connus.get(nom) != valeurs]
+        disparus = [(dossier, nom) for nom in connus.keys() - fichiers.keys()]
+        modifications.extend(modifies)
+        suppressions.extend(disparus)
+        statistiques["modifies"] += len(modifies)
+        statistiques["disparus"] += len(disparus)
+        if len(modifications) + len(suppressions) >= TAILLE_LOT_ECRITURE:
+            vider()
+
+    vider()
+    # Dossiers entiers qui ont disparu depuis le dernier parcours
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute(
+            "DELETE FROM manifeste_fichiers WHERE dossier NOT IN (SELECT value FROM json_each(?))",
+            (json.dumps(dossiers_vus),)
+        )
+        statistiques["disparus"] += cursor.rowcount
+    return statistiques
+
+
+# Dossier d'un blob dans le manifeste, même arborescence que stockage_blobs.chemin_relatif_blob
+_DOSSIER_BLOB_SQL = "'blobs/' || substr({sha}, 1, 2) || '/' || substr({sha}, 3, 2)"
+
+_REQUETES_RAPPORT = {
+    "orphelins": f"""
+        SELECT CASE WHEN m.dossier = '' THEN m.nom ELSE m.dossier || '/' || m.nom END, m.nom
+        FROM manifeste_fichiers m
+        WHERE (m.dossier = ''
+               AND NOT EXISTS (SELECT 1 FROM documents d WHERE d.nom_fichier = m.nom AND d.sha256 IS NULL))
+           OR (m.dossier LIKE 'blobs/%' AND m.dossier != 'blobs/tmp'
+               AND NOT EXISTS (SELECT 1 FROM blobs b WHERE b.sha256 = m.nom))
+           OR (m.dossier = 'blobs/tmp' AND m.mtime_ns < :limite_temporaires
+               AND NOT EXISTS (SELECT 1 FROM sessions_upload s WHERE m.nom = 'session-' || s.id || '.part'))
+    """,
+    # Les documents ajoutés après le début du parcours sont ignorés (fichier pas encore vu)
+    "manquants": f"""
+        SELECT d.id, d.nom_fichier
+        FROM documents d
+        WHERE d.date_ajout < :debut
+          AND CASE WHEN d.sha256 IS NULL
+                   THEN NOT EXISTS (SELECT 1 FROM manifeste_fichiers m
+                                    WHERE m.dossier = '' AND m.nom = d.nom_fichier)
+                   ELSE NOT EXISTS (SELECT 1 FROM manifeste_fichiers m
+                                    WHERE m.dossier = {_DOSSIER_BLOB_SQL.format(sha='d.sha256')}
+                                      AND m.nom = d.sha256)
+              END
+    """,
+    "tailles_incorrectes": f"""
+        SELECT b.sha256, b.taille, m.taille
+        FROM blobs b
+        JOIN manifeste_fichiers m
+          ON m.dossier = {_DOSSIER_BLOB_SQL.format(sha='b.sha256')} AND m.nom = b.sha256
+        WHERE m.taille != b.taille
+    """,
+}
+
+
+def reconcilier(dossier_donnees, reparer=False, supprimer_manquants=False, rapide=True):
+    """
+    Met à jour le manifeste puis compare le disque et la base. Retourne le rapport (dict).
+    `reparer` confie les orphelins au ramasse-miettes (qui revérifie sous verrou qu'ils ne sont
+    pas référencés) ; `supprimer_manquants` supprime les documents dont le fichier n'existe plus.
+    `rapide=False` refait un stat de tous les fichiers (voir le parcours complet plus haut).
+    """
+    if not os.path.isdir(dossier_donnees):
+        # Sans dossier, tous les documents paraîtraient manquants : ne rien comparer
+        return {"dossier_recherche": dossier_donnees,
+                "statut": "ERREUR: Dossier de données introuvable par le serveur Python."}
+
+    debut = time.time()
+    parcours = mettre_a_jour_manifeste(dossier_donnees, rapide)
+    parametres = {
+        "debut": int(debut),
+        "limite_temporaires": int((debut - AGE_TEMPORAIRE_ABANDONNE_S) * 1e9),
+    }
+
+    rapport = {"dossier_recherche": dossier_donnees, "parcours": parcours}
+    resultats = {}
+    with lecture(gestion_db.DB_NAME) as cursor:
+        for nom, requete in _REQUETES_RAPPORT.items():
+            cursor.execute(requete, parametres)
+            lignes = cursor.fetchall()
+            resultats[nom] = lignes
+            rapport[nom] = {"total": len(lignes), "elements": [list(ligne) for ligne in lignes[:LIMITE_RAPPORT]]}
+    # Pour les orphelins, le chemin relatif suffit
+    rapport["orphelins"]["elements"] = [chemin for chemin, _ in resultats["orphelins"][:LIMITE_RAPPORT]]
+    orphelins = resultats["orphelins"]
+    manquants = resultats["manquants"]
+
+    rapport["reparation"] = None
+    if reparer:
+        rapport["reparation"] = {"orphelins_a_effacer": 0, "documents_supprimes": 0}
+        with transaction(gestion_db.DB_NAME) as cursor:
+            cursor.executemany(
+                "INSERT INTO fichiers_a_supprimer (chemin, date_ajout, sha256) VALUES (?, ?, ?)",
+                [(chemin, int(debut), nom if '/' in chemin and not chemin.startswith('blobs/tmp/') else None)
+                 for chemin, nom in orphelins]
+            )
+        rapport["reparation"]["orphelins_a_effacer"] = len(orphelins)
+        if supprimer_manquants and manquants:
+            supprimes = gestion_db.supprimer_documents_en_masse(ids=[doc_id for doc_id, _ in manquants])
+            rapport["reparation"]["documents_supprimes"] = supprimes or 0
+
+    rapport["duree_s"] = round(time.time() - debut, 3)
+    rapport["statut"] = "SUCCÈS"
+    return rapport
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Réconciliation du dossier de données et de la base.")
+    parser.add_argument("--reparer", action="store_true",
+                        help="confier les fichiers orphelins au ramasse-miettes")
+    parser.add_argument("--supprimer-manquants", action="store_true",
+                        help="avec --reparer : supprimer les documents dont le fichier manque")
+    parser.add_argument("--complet", action="store_true",
+                        help="relire la taille de tous les fichiers, même déjà connus (un stat par fichier)")
+    args = parser.parse_args()
+
+    dossier = os.path.dirname(gestion_db.DB_NAME)
+    print(f"📂 Dossier de données : {dossier}", file=sys.stderr)
+    gestion_db.initialiser_base_de_donnees()
+    resultat = reconcilier(dossier, args.reparer, args.supprimer_manquants, not args.complet)
+    if args.reparer:
+        import ramasse_miettes
+        ramasse_miettes.collecter(dossier)
+    print(json.dumps(resultat, ensure_ascii=False, indent=2))
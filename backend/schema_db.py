@@ -0,0 +1,517 @@
+"""
+Migrations versionnées du schéma de la base de documents.
+
+Chaque migration est appliquée une seule fois, dans sa propre transaction, et son
+numéro est enregistré dans la table 'schema_version'. Ajouter une évolution du
+schéma = ajouter une fonction à la liste MIGRATIONS (ne jamais modifier une
+migration déjà livrée).
+
+Une migration qui réécrit des lignes existantes peut déclarer sa réécriture dans
+REECRITURES_PAR_LOTS : elle est alors appliquée avant la transaction de la migration,
+par lots d'ids consécutifs dans des transactions courtes (le verrou d'écriture est
+relâché entre deux lots), et la migration ne traite plus que les lignes restantes.
+Le démarrage attend toujours la fin de la réécriture.
+"""
+
+import time
+
+from connexion_db import lecture, transaction
+import journal
+
+log = journal.obtenir(__name__)
+
+TAILLE_LOT_REECRITURE = 5000
+
+
+def _creer_table_documents(cursor):
+    """Table initiale (reprend l'ancien initialiser_base_de_donnees)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nom_fichier TEXT NOT NULL,
+            chemin_local TEXT NOT NULL,
+            categorie TEXT NOT NULL,
+            date_ajout DATETIME,
+            is_signed BOOLEAN DEFAULT 0
+        )
+    """)
+    # Bases antérieures à la colonne is_signed
+    cursor.execute("PRAGMA table_info(documents)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'is_signed' not in columns:
+        cursor.execute("ALTER TABLE documents ADD COLUMN is_signed BOOLEAN DEFAULT 0")
+
+
+# Réécriture de la migration 2 : (affectation, condition) sur la table documents
+_DATES_EN_EPOCH = (
+    "date_ajout = CAST(strftime('%s', date_ajout, 'utc') AS INTEGER)",
+    "typeof(date_ajout) = 'text' AND strftime('%s', date_ajout, 'utc') IS NOT NULL",
+)
+
+
+def _dates_en_epoch(cursor):
+    """
+    Convertit date_ajout ("AAAA-MM-JJ HH:MM:SS", heure locale) en secondes epoch UTC.
+    Un entier se trie et se compare directement dans les index, sans conversion.
+    Le gros de la conversion est fait par lots avant cette étape (REECRITURES_PAR_LOTS).
+    """
+    affectation, condition = _DATES_EN_EPOCH
+    cursor.execute(f"UPDATE documents SET {affectation} WHERE {condition}")
+
+
+def _index_acces(cursor):
+    """Index composites pour les listes par catégorie, les récents et le statut de signature."""
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_categorie_date
+        ON documents (categorie, date_ajout DESC, id DESC)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_date
+        ON documents (date_ajout DESC, id DESC)
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_signe_date
+        ON documents (is_signed, date_ajout DESC, id DESC)
+    """)
+
+
+def _fichiers_a_supprimer(cursor):
+    """
+    Liste persistante des fichiers à effacer du disque (traitée par ramasse_miettes),
+    et index sur nom_fichier pour vérifier qu'un fichier n'est plus référencé.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fichiers_a_supprimer (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chemin TEXT NOT NULL,
+            date_ajout INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_nom_fichier
+        ON documents (nom_fichier)
+    """)
+
+
+def _blobs(cursor):
+    """
+    Stockage adressé par contenu (voir stockage_blobs) : table des blobs et compteur de
+    références tenu à jour par triggers. Quand un blob n'est plus référencé, son fichier
+    est inscrit dans fichiers_a_supprimer dans la même transaction.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            taille INTEGER NOT NULL,
+            nb_references INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("ALTER TABLE documents ADD COLUMN sha256 TEXT")
+    cursor.execute("ALTER TABLE fichiers_a_supprimer ADD COLUMN sha256 TEXT")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_blob_ajout
+        AFTER INSERT ON documents WHEN new.sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET nb_references = nb_references + 1 WHERE sha256 = new.sha256;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_blob_suppression
+        AFTER DELETE ON documents WHEN old.sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET nb_references = nb_references - 1 WHERE sha256 = old.sha256;
+        END
+    """)
+    # Même arborescence que stockage_blobs.chemin_relatif_blob
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_blobs_liberation
+        AFTER UPDATE OF nb_references ON blobs WHEN new.nb_references <= 0
+        BEGIN
+            INSERT INTO fichiers_a_supprimer (chemin, date_ajout, sha256)
+            VALUES (
+                'blobs/' || substr(new.sha256, 1, 2) || '/' || substr(new.sha256, 3, 2) || '/' || new.sha256,
+                CAST(strftime('%s', 'now') AS INTEGER),
+                new.sha256
+            );
+            DELETE FROM blobs WHERE sha256 = new.sha256;
+        END
+    """)
+
+
+def _recherche_plein_texte(cursor):
+    """
+    Index FTS5 sur le nom et le texte des documents (rowid = documents.id).
+    Le nom est synchronisé par triggers ; le texte est rempli en arrière-plan par
+    extraction_texte, qui positionne documents.texte_extrait une fois le document traité.
+    """
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+            nom_fichier, texte, tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    cursor.execute("ALTER TABLE documents ADD COLUMN texte_extrait INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        INSERT INTO documents_fts (rowid, nom_fichier, texte)
+        SELECT id, nom_fichier, '' FROM documents
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_fts_ajout
+        AFTER INSERT ON documents
+        BEGIN
+            INSERT INTO documents_fts (rowid, nom_fichier, texte) VALUES (new.id, new.nom_fichier, '');
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_fts_suppression
+        AFTER DELETE ON documents
+        BEGIN
+            DELETE FROM documents_fts WHERE rowid = old.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_fts_renommage
+        AFTER UPDATE OF nom_fichier ON documents
+        BEGIN
+            UPDATE documents_fts SET nom_fichier = new.nom_fichier WHERE rowid = new.id;
+        END
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_documents_texte_a_extraire
+        ON documents (id) WHERE texte_extrait = 0
+    """)
+
+
+def _generation_cache(cursor):
+    """
+    Compteur incrémenté à chaque écriture visible dans les listes de documents,
+    dans la même transaction (voir cache_requetes). L'extraction du texte
+    (texte_extrait) ne l'incrémente pas.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS generation_cache (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            valeur INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO generation_cache (id, valeur) VALUES (1, 0)")
+    for nom, evenement in (
+        ("ajout", "AFTER INSERT ON documents"),
+        ("suppression", "AFTER DELETE ON documents"),
+        ("modification", "AFTER UPDATE OF nom_fichier, chemin_local, categorie, date_ajout, is_signed ON documents"),
+    ):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_generation_cache_{nom}
+            {evenement}
+            BEGIN
+                UPDATE generation_cache SET valeur = valeur + 1 WHERE id = 1;
+            END
+        """)
+
+
+def _manifeste_fichiers(cursor):
+    """
+    Dernier état connu des fichiers du dossier de données (voir reconciliation) :
+    un parcours ne réécrit que les fichiers nouveaux, modifiés ou disparus.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS manifeste_fichiers (
+            dossier TEXT NOT NULL,
+            nom TEXT NOT NULL,
+            taille INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            PRIMARY KEY (dossier, nom)
+        ) WITHOUT ROWID
+    """)
+
+
+def _sessions_upload(cursor):
+    """
+    Uploads reprenables (voir sessions_upload) : une session par fichier en cours
+    d'envoi, et les morceaux déjà reçus et vérifiés.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions_upload (
+            id TEXT PRIMARY KEY,
+            nom_fichier TEXT NOT NULL,
+            categorie TEXT NOT NULL,
+            taille INTEGER NOT NULL,
+            taille_morceau INTEGER NOT NULL,
+            sha256 TEXT,
+            statut TEXT NOT NULL DEFAULT 'ouverte',
+            date_creation INTEGER NOT NULL,
+            expiration INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_sessions_upload_expiration
+        ON sessions_upload (expiration)
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions_upload_morceaux (
+            session_id TEXT NOT NULL REFERENCES sessions_upload (id) ON DELETE CASCADE,
+            indice INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,
+            PRIMARY KEY (session_id, indice)
+        ) WITHOUT ROWID
+    """)
+
+
+
+def _signatures_partagees(cursor):
+    """
+    Image de signature stockée une seule fois comme blob (voir signatures) et référencée
+    par documents.signature_sha256 ; le compteur de références de 'blobs' compte aussi
+    ces références, pour que le ramasse-miettes libère une image qui n'est plus utilisée.
+    """
+    cursor.execute("ALTER TABLE documents ADD COLUMN signature_sha256 TEXT")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_signature_ajout
+        AFTER INSERT ON documents WHEN new.signature_sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET nb_references = nb_references + 1 WHERE sha256 = new.signature_sha256;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_signature_modification
+        AFTER UPDATE OF signature_sha256 ON documents
+        WHEN new.signature_sha256 IS NOT old.signature_sha256
+        BEGIN
+            UPDATE blobs SET nb_references = nb_references + 1 WHERE sha256 = new.signature_sha256;
+            UPDATE blobs SET nb_references = nb_references - 1 WHERE sha256 = old.signature_sha256;
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_documents_signature_suppression
+        AFTER DELETE ON documents WHEN old.signature_sha256 IS NOT NULL
+        BEGIN
+            UPDATE blobs SET nb_references = nb_references - 1 WHERE sha256 = old.signature_sha256;
+        END
+    """)
+
+
+def _journal_modifications(cursor):
+    """
+    Journal des modifications de 'documents', écrit par triggers dans la transaction même
+    de chaque écriture (voir modifications) : les clients appliquent les changements
+    depuis leur dernier numéro de séquence au lieu de relire les listes.
+    AUTOINCREMENT : un numéro n'est jamais réutilisé, même après la purge du journal.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS journal_modifications (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            doc_id INTEGER NOT NULL,
+            operation TEXT NOT NULL,
+            categorie TEXT,
+            categorie_precedente TEXT,
+            date INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS idx_journal_modifications_date
+        ON journal_modifications (date)
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_journal_modifications_ajout
+        AFTER INSERT ON documents
+        BEGIN
+            INSERT INTO journal_modifications (doc_id, operation, categorie, date)
+            VALUES (new.id, 'ajout', new.categorie, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_journal_modifications_suppression
+        AFTER DELETE ON documents
+        BEGIN
+            INSERT INTO journal_modifications (doc_id, operation, categorie, date)
+            VALUES (old.id, 'suppression', old.categorie, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    """)
+    # Mêmes colonnes que le compteur de génération, plus l'image de signature
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_journal_modifications_modification
+        AFTER UPDATE OF nom_fichier, chemin_local, categorie, date_ajout, is_signed, signature_sha256 ON documents
+        BEGIN
+            INSERT INTO journal_modifications (doc_id, operation, categorie, categorie_precedente, date)
+            VALUES (new.id, 'modification', new.categorie,
+                    CASE WHEN old.categorie IS NOT new.categorie THEN old.categorie END,
+                    CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    """)
+
+
+def _statistiques_categories(cursor):
+    """
+    Nombre de documents et de documents signés par catégorie, tenus exacts par triggers
+    dans la transaction de chaque écriture (voir statistiques) : les compteurs se lisent
+    sans parcourir 'documents'. Une catégorie vide disparaît de la table.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS statistiques_categories (
+            categorie TEXT PRIMARY KEY,
+            total INTEGER NOT NULL,
+            signes INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        INSERT INTO statistiques_categories (categorie, total, signes)
+        SELECT categorie, COUNT(*), SUM(COALESCE(is_signed, 0) != 0)
+        FROM documents
+        GROUP BY categorie
+    """)
+    # Ajout et retrait d'un document dans les compteurs de sa catégorie
+    ajouter = """
+        INSERT INTO statistiques_categories (categorie, total, signes)
+        VALUES (new.categorie, 1, COALESCE(new.is_signed, 0) != 0)
+        ON CONFLICT (categorie) DO UPDATE SET
+            total = total + 1,
+            signes = signes + excluded.signes;
+    """
+    retirer = """
+        UPDATE statistiques_categories SET
+            total = total - 1,
+            signes = signes - (COALESCE(old.is_signed, 0) != 0)
+        WHERE categorie = old.categorie;
+        DELETE FROM statistiques_categories WHERE categorie = old.categorie AND total <= 0;
+    """
+    for nom, evenement, corps in (
+        ("ajout", "AFTER INSERT ON documents", ajouter),
+        ("suppression", "AFTER DELETE ON documents", retirer),
+        ("modification", "AFTER UPDATE OF categorie, is_signed ON documents", retirer + ajouter),
+    ):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_statistiques_{nom}
+            {evenement}
+            BEGIN
+                {corps}
+            END
+        """)
+
+
+def _reprise_migrations_donnees(cursor):
+    """
+    Point de reprise des migrations de données (voir migrations_donnees) : dernier id
+    traité, mis à jour dans la transaction de chaque lot.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS migrations_donnees (
+            nom TEXT PRIMARY KEY,
+            dernier_id INTEGER NOT NULL,
+            id_max INTEGER NOT NULL,
+            nb_modifies INTEGER NOT NULL DEFAULT 0,
+            statut TEXT NOT NULL,
+            date_debut INTEGER NOT NULL,
+            date_maj INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+
+
+def _ecritures_morceaux(cursor):
+    """
+    Morceaux d'upload en cours d'écriture dans le fichier de leur session (voir
+    sessions_upload.ecrire_morceau) : un seul envoi à la fois par morceau.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS sessions_upload_ecritures (
+            session_id TEXT NOT NULL REFERENCES sessions_upload (id) ON DELETE CASCADE,
+            indice INTEGER NOT NULL,
+            jeton TEXT NOT NULL,
+            debut INTEGER NOT NULL,
+            PRIMARY KEY (session_id, indice)
+        ) WITHOUT ROWID
+    """)
+
+# (version, description, fonction) — dans l'ordre d'application
+MIGRATIONS = [
+    (1, "Table documents", _creer_table_documents),
+    (2, "date_ajout en secondes epoch", _dates_en_epoch),
+    (3, "Index categorie/date, date et signature/date", _index_acces),
+    (4, "Table fichiers_a_supprimer", _fichiers_a_supprimer),
+    (5, "Blobs adressés par contenu et compteur de références", _blobs),
+    (6, "Index plein texte FTS5 (nom et texte des documents)", _recherche_plein_texte),
+    (7, "Compteur de génération pour le cache des listes", _generation_cache),
+    (8, "Manifeste des fichiers pour la réconciliation disque/base", _manifeste_fichiers),
+    (9, "Sessions d'upload reprenables", _sessions_upload),
+    (10, "Images de signature partagées (blobs référencés par les documents)", _signatures_partagees),
+    (11, "Journal des modifications des documents", _journal_modifications),
+    (12, "Compteurs de documents par catégorie et signature", _statistiques_categories),
+    (13, "Points de reprise des migrations de données", _reprise_migrations_donnees),
+    (14, "Morceaux d'upload en cours d'écriture", _ecritures_morceaux),
+]
+
+
+# version -> (affectation, condition) appliquée par lots avant la migration (voir _reecrire_par_lots)
+REECRITURES_PAR_LOTS = {
+    2: _DATES_EN_EPOCH,
+}
+
+
+def _reecrire_par_lots(chemin_db, version, affectation, condition):
+    """
+    UPDATE documents SET <affectation> WHERE <condition>, par lots d'ids consécutifs,
+    chacun dans sa propre transaction. La condition rend la réécriture rejouable :
+    une exécution interrompue reprend simplement au redémarrage suivant.
+    """
+    with lecture(chemin_db) as cursor:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM documents")
+        id_max = cursor.fetchone()[0]
+    dernier_id = modifies = 0
+    while dernier_id < id_max:
+        with transaction(chemin_db) as cursor:
+            # Borne du lot : le n-ième id suivant (les ids peuvent avoir des trous)
+            cursor.execute(
+                "SELECT id FROM documents WHERE id > ? AND id <= ? ORDER BY id LIMIT 1 OFFSET ?",
+                (dernier_id, id_max, TAILLE_LOT_REECRITURE - 1)
+            )
+            ligne = cursor.fetchone()
+            borne = ligne[0] if ligne else id_max
+            cursor.execute(
+                f"UPDATE documents SET {affectation} WHERE id > ? AND id <= ? AND ({condition})",
+                (dernier_id, borne)
+            )
+            modifies += cursor.rowcount
+        dernier_id = borne
+    if modifies:
+        log.info("Migration %s : %s ligne(s) réécrite(s) par lots", version, modifies)
+
+
+def version_actuelle(chemin_db):
+    """Retourne la dernière version de schéma appliquée (0 pour une base vide)."""
+    with lecture(chemin_db) as cursor:
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return cursor.fetchone()[0]
+
+
+def appliquer_migrations(chemin_db):
+    """
+    Applique les migrations manquantes et retourne la liste des versions appliquées.
+    Plusieurs processus peuvent l'appeler en même temps : la version est revérifiée
+    sous le verrou d'écriture avant chaque étape.
+    """
+    with transaction(chemin_db) as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                date_application INTEGER NOT NULL
+            )
+        """)
+
+    appliquees = []
+    for version, description, etape in MIGRATIONS:
+        if version <= version_actuelle(chemin_db):
+            continue
+        if version in REECRITURES_PAR_LOTS:
+            _reecrire_par_lots(chemin_db, version, *REECRITURES_PAR_LOTS[version])
+        with transaction(chemin_db) as cursor:
+            cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cursor.fetchone():
+                continue
+            etape(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description, date_application) VALUES (?, ?, ?)",
+                (version, description, int(time.time()))
+            )
+        appliquees.append(version)
+        log.info("Migration %s appliquée : %s", version, description)
+    return appliquees
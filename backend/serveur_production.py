@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Point d'entrée de production.
+
+- gunicorn (Linux, macOS) : plusieurs processus × threads, configuration dans gunicorn.conf.py ;
+- waitress (Windows, ou si gunicorn n'est pas installé) : un seul processus multi-thread ;
+- dans les deux cas, les flux SSE sont servis à part par serveur_sse.py (FORMULAMA_SSE_BIND).
+
+Utilisation : python serveur_production.py
+(python app_server.py reste le serveur de développement)
+"""
+
+import os
+import signal
+import sys
+
+DOSSIER_BACKEND = os.path.dirname(os.path.abspath(__file__))
+
+
+def lancer_gunicorn():
+    from gunicorn.app.wsgiapp import run
+
+    sys.argv = ["gunicorn", "-c", os.path.join(DOSSIER_BACKEND, "gunicorn.conf.py")]
+    run()
+
+
+def lancer_waitress():
+    from waitress import serve
+
+    # Avant l'import de l'application : la route du flux SSE redirige vers ce serveur
+    os.environ.setdefault("FORMULAMA_SSE_BIND", "0.0.0.0:5002")
+    import app_server
+    import metriques
+    import serveur_sse
+
+    app_server.initialiser_base_de_donnees()
+    metriques.reinitialiser_dossier()
+    app_server.demarrer_services()
+    if serveur_sse.ADRESSE:
+        # Flux SSE dans une boucle asyncio : aucun thread de waitress par abonné
+        serveur_sse.demarrer()
+
+    # SIGTERM (arrêt du service) : sortie normale, pour que les services s'arrêtent proprement
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    threads = int(os.environ.get("FORMULAMA_THREADS", "4")) * (os.cpu_count() or 1)
+    try:
+        serve(app_server.app, listen=os.environ.get("FORMULAMA_BIND", "0.0.0.0:5001"), threads=threads)
+    finally:
+        serveur_sse.arreter()
+        app_server.arreter_services()
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, DOSSIER_BACKEND)
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        gunicorn = None
+
+    if gunicorn is not None and os.name != "nt":
+        lancer_gunicorn()
+    else:
+        lancer_waitress()
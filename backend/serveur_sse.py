@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Serveur du flux SSE des modifications, séparé des threads de requêtes de l'API.
+
+Servi par l'API sous gunicorn, chaque flux ouvert occuperait un thread de worker pendant
+toute sa durée : quelques tableaux de bord ouverts suffiraient à bloquer les autres
+requêtes. Ce serveur garde tous les abonnés dans une seule boucle asyncio (un thread,
+un processus) : un abonné inactif ne coûte qu'une socket. Il s'appuie sur le
+notificateur de modifications (une seule lecture de la base par écriture, tampon commun
+à tous les abonnés) et ne sert que GET /api/documents/modifications/flux.
+
+- gunicorn.conf.py le lance dans un processus à part, serveur_production.py dans un
+  thread sous waitress ; adresse d'écoute FORMULAMA_SSE_BIND (0.0.0.0:5002 par défaut,
+  vide pour laisser l'API servir les flux elle-même) ;
+- la route de l'API redirige (307) les clients vers ce serveur : même hôte, port de
+  FORMULAMA_SSE_BIND, ou FORMULAMA_SSE_URL (ex. derrière un proxy) ;
+- au plus FORMULAMA_SSE_SERVEUR_MAX abonnés (1000 par défaut), 503 au-delà.
+
+    python serveur_sse.py
+"""
+
+import asyncio
+import os
+import signal
+import sys
+import threading
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import gestion_db
+import modifications
+import journal
+
+log = journal.obtenir(__name__)
+
+ADRESSE_DEFAUT = "0.0.0.0:5002"
+ADRESSE = os.environ.get("FORMULAMA_SSE_BIND", "")
+URL_PUBLIQUE = os.environ.get("FORMULAMA_SSE_URL", "")
+NB_ABONNES_MAX = int(os.environ.get("FORMULAMA_SSE_SERVEUR_MAX", "1000"))
+CHEMIN = "/api/documents/modifications/flux"
+DELAI_REQUETE_S = 10
+# Un client qui ne lit plus son flux est déconnecté au-delà de ce délai
+DELAI_ECRITURE_S = 30
+TAILLE_ENTETES_MAX = 16 * 1024
+
+_boucle = None
+_arret = None
+# Remplacé à chaque notification : les abonnés en attente sur l'ancien sont réveillés
+_reveil = None
+_abonnes = 0
+_thread = None
+
+
+def url_redirection(schema, hote, depuis):
+    """URL du flux sur ce serveur pour un client de l'API, ou None si l'API sert les flux."""
+    if URL_PUBLIQUE:
+        base = URL_PUBLIQUE
+    elif ADRESSE:
+        nom_hote = urlsplit(f"//{hote}").hostname or "localhost"
+        if ':' in nom_hote:
+            nom_hote = f"[{nom_hote}]"
+        base = f"{schema}://{nom_hote}:{ADRESSE.rpartition(':')[2]}{CHEMIN}"
+    else:
+        return None
+    return base if depuis is None else f"{base}?{urlencode({'depuis': depuis})}"
+
+
+# --- NOTIFICATION ---
+
+def _reveiller():
+    global _reveil
+    ancien, _reveil = _reveil, asyncio.Event()
+    ancien.set()
+
+
+def _notifier():
+    """Appelé dans le thread du notificateur de modifications."""
+    if _boucle is not None and not _boucle.is_closed():
+        _boucle.call_soon_threadsafe(_reveiller)
+
+
+# --- HTTP ---
+
+def _ecrire_reponse(writer, statut, entetes=(), corps=b''):
+    lignes = [f"HTTP/1.1 {statut}", "Access-Control-Allow-Origin: *", "Connection: close",
+              f"Content-Length: {len(corps)}", *entetes]
+    writer.write(("\r\n".join(lignes) + "\r\n\r\n").encode('latin-1') + corps)
+
+
+async def _lire_requete(reader):
+    """Retourne (méthode, cible, en-têtes en minuscules) ; lève ValueError si la requête est invalide."""
+    ligne = await reader.readline()
+    taille = len(ligne)
+    morceaux = ligne.decode('latin-1').split()
+    if len(morceaux) != 3:
+        raise ValueError("ligne de requête invalide")
+    entetes = {}
+    while True:
+        ligne = await reader.readline()
+        taille += len(ligne)
+        if taille > TAILLE_ENTETES_MAX:
+            raise ValueError("en-têtes trop volumineux")
+        if ligne in (b'\r\n', b'\n', b''):
+            break
+        nom, _, valeur = ligne.decode('latin-1').partition(':')
+        entetes[nom.strip().lower()] = valeur.strip()
+    return morceaux[0], morceaux[1], entetes
+
+
+async def _envoyer(writer, texte):
+    writer.write(texte.encode('utf-8'))
+    await asyncio.wait_for(writer.drain(), DELAI_ECRITURE_S)
+
+
+async def _servir_abonne(writer, depuis):
+    """Même protocole que modifications.flux, sans thread : l'attente est un asyncio.Event."""
+    boucle = asyncio.get_running_loop()
+    fin = boucle.time() + modifications.DUREE_FLUX_S
+    writer.write(("HTTP/1.1 200 OK\r\nContent-Type: text/event-stream; charset=utf-8\r\n"
+                  "Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\n"
+                  "Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n").encode('latin-1'))
+    await _envoyer(writer, f"retry: {modifications.RECONNEXION_MS}\n\n")
+
+    if depuis is None:
+        curseur = modifications.derniere_lue()
+    elif (await boucle.run_in_executor(None, modifications.lire, depuis, 0))[0] is None:
+        await _envoyer(writer, "event: reinitialiser\ndata: {}\n\n")
+        return
+    else:
+        curseur = depuis
+    prochain_battement = boucle.time() + modifications.BATTEMENT_S
+
+    while not _arret.is_set() and boucle.time() < fin:
+        # Capturé avant la lecture du tampon : une notification arrivée entre-temps n'est pas perdue
+        reveil = _reveil
+        elements = modifications.en_tampon(curseur)
+        if elements is None:
+            # Abonné en retard sur le tampon : lecture de la base hors de la boucle
+            elements = (await boucle.run_in_executor(None, modifications.lire, curseur,
+                                                     modifications.TAILLE_LOT))[0]
+            if elements is None:
+                await _envoyer(writer, "event: reinitialiser\ndata: {}\n\n")
+                return
+        if elements:
+            await _envoyer(writer, ''.join(modifications.evenement(m) for m in elements))
+            curseur = elements[-1]["seq"]
+            prochain_battement = boucle.time() + modifications.BATTEMENT_S
+            continue
+
+        try:
+            await asyncio.wait_for(reveil.wait(), max(0, min(prochain_battement, fin) - boucle.time()))
+        except asyncio.TimeoutError:
+            pass
+        if boucle.time() >= prochain_battement:
+            await _envoyer(writer, ": battement\n\n")
+            prochain_battement = boucle.time() + modifications.BATTEMENT_S
+
+
+async def _traiter(reader, writer):
+    global _abonnes
+    try:
+        try:
+            methode, cible, entetes = await asyncio.wait_for(_lire_requete(reader), DELAI_REQUETE_S)
+        except (ValueError, asyncio.LimitOverrunError, asyncio.IncompleteReadError):
+            _ecrire_reponse(writer, "400 Bad Request")
+            return
+        url = urlsplit(cible)
+        if url.path != CHEMIN:
+            _ecrire_reponse(writer, "404 Not Found")
+            return
+        if methode == 'OPTIONS':
+            _ecrire_reponse(writer, "204 No Content", ("Access-Control-Allow-Methods: GET",
+                                                       "Access-Control-Allow-Headers: Last-Event-ID, Cache-Control"))
+            return
+        if methode != 'GET':
+            _ecrire_reponse(writer, "405 Method Not Allowed", ("Allow: GET, OPTIONS",))
+            return
+        depuis = entetes.get('last-event-id') or parse_qs(url.query).get('depuis', [None])[0]
+        try:
+            depuis = int(depuis) if depuis else None
+        except ValueError:
+            _ecrire_reponse(writer, "400 Bad Request")
+            return
+        if _abonnes >= NB_ABONNES_MAX:
+            # Le client peut se rabattre sur /api/documents/modifications
+            _ecrire_reponse(writer, "503 Service Unavailable", ("Retry-After: 30",))
+            return
+
+        _abonnes += 1
+        try:
+            await _servir_abonne(writer, depuis)
+        finally:
+            _abonnes -= 1
+    except (ConnectionError, asyncio.TimeoutError):
+        # Client parti ou qui ne lit plus
+        pass
+    except Exception as e:
+        log.exception("Serveur SSE : erreur sur une connexion : %s", e)
+    finally:
+        writer.close()
+
+
+async def _servir(adresse):
+    global _boucle, _arret, _reveil
+    _boucle = asyncio.get_running_loop()
+    _arret = asyncio.Event()
+    _reveil = asyncio.Event()
+    hote, _, port = adresse.rpartition(':')
+    serveur = await asyncio.start_server(_traiter, hote.strip('[]') or None, int(port))
+    modifications.observer(_notifier)
+    modifications.demarrer()
+    log.info("Serveur SSE à l'écoute sur %s (%s abonnés au maximum)", adresse, NB_ABONNES_MAX)
+    async with serveur:
+        await _arret.wait()
+        _reveiller()
+    modifications.arreter()
+
+
+def demarrer(adresse=None):
+    """Lance le serveur dans un thread de ce processus (waitress)."""
+    global _thread
+    _thread = threading.Thread(target=asyncio.run, args=(_servir(adresse or ADRESSE or ADRESSE_DEFAUT),),
+                               name="serveur-sse", daemon=True)
+    _thread.start()
+
+
+def arreter():
+    if _boucle is not None and not _boucle.is_closed():
+        _boucle.call_soon_threadsafe(_arret.set)
+
+
+def main():
+    gestion_db.initialiser_base_de_donnees()
+
+    async def lancer():
+        # SIGTERM / SIGINT (arrêt de gunicorn ou du service) : arrêt propre de la boucle
+        for signal_arret in (signal.SIGTERM, signal.SIGINT):
+            asyncio.get_running_loop().add_signal_handler(signal_arret, arreter)
+        await _servir(ADRESSE or ADRESSE_DEFAUT)
+
+    asyncio.run(lancer())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+"""
+Uploads reprenables par morceaux, pour les gros fichiers et les connexions instables.
+
+1. POST /api/uploads : création de la session (nom, catégorie, taille, empreinte
+   SHA-256 facultative du fichier complet). Le fichier de destination est réservé
+   sur le disque à sa taille finale (data/blobs/tmp/session-<id>.part).
+2. PUT /api/uploads/<id>?offset=N : un morceau de `taille_morceau` octets (le dernier
+   peut être plus court), avec son empreinte dans l'en-tête X-Chunk-Sha256. Il est
+   écrit directement à sa position par blocs de 1 Mo (la mémoire utilisée ne dépend
+   pas de la taille du fichier), empreinte calculée au passage, puis enregistré
+   comme reçu s'il est complet et correct. Pendant l'écriture, le morceau n'est plus
+   compté comme reçu (table sessions_upload_ecritures) : un envoi refusé ou
+   interrompu doit être refait avant que la validation soit possible. Les morceaux
+   peuvent arriver dans le désordre ou être renvoyés ; GET /api/uploads/<id> liste
+   ceux déjà reçus.
+3. POST /api/uploads/<id>/valider : vérification de l'empreinte du fichier complet
+   puis enregistrement par gestion_db.ajouter_document, comme un upload classique.
+
+Une session sans activité expire (FORMULAMA_UPLOAD_EXPIRATION, 24 h par défaut) :
+elle est supprimée avec son fichier par le ramasse-miettes (purger_expirees).
+
+L'espace réservé est borné : au plus FORMULAMA_UPLOAD_SESSIONS_MAX sessions ouvertes
+(429 au-delà) et FORMULAMA_UPLOAD_RESERVE_MAX octets réservés au total (507 au-delà).
+"""
+
+import hashlib
+import os
+import secrets
+import time
+
+import gestion_db
+import stockage_blobs
+from connexion_db import lecture, transaction
+
+TAILLE_MORCEAU = int(os.environ.get("FORMULAMA_UPLOAD_MORCEAU", str(8 * 1024 * 1024)))
+TAILLE_MAX = int(os.environ.get("FORMULAMA_UPLOAD_TAILLE_MAX", str(4 * 1024 * 1024 * 1024)))
+DUREE_EXPIRATION_S = int(os.environ.get("FORMULAMA_UPLOAD_EXPIRATION", str(24 * 3600)))
+SESSIONS_MAX = int(os.environ.get("FORMULAMA_UPLOAD_SESSIONS_MAX", "64"))
+RESERVE_MAX = int(os.environ.get("FORMULAMA_UPLOAD_RESERVE_MAX", str(16 * 1024 * 1024 * 1024)))
+TAILLE_BLOC_ECRITURE = 1024 * 1024
+# Au-delà, une écriture de morceau non terminée est considérée comme interrompue
+DELAI_ECRITURE_S = 600
+
+
+class ErreurSession(Exception):
+    """Requête refusée ; `statut` est le code HTTP à renvoyer."""
+
+    def __init__(self, message, statut=400):
+        super().__init__(message)
+        self.statut = statut
+
+
+def _chemin_fichier(dossier_donnees, session_id):
+    return os.path.join(stockage_blobs.dossier_temporaire(dossier_donnees), f"session-{session_id}.part")
+
+
+def _nb_morceaux(taille, taille_morceau):
+    return max(1, -(-taille // taille_morceau))
+
+
+def _reserver(chemin, taille):
+    """Crée le fichier à sa taille finale (blocs réellement alloués quand le système le permet)."""
+    descripteur = os.open(chemin, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        try:
+            os.posix_fallocate(descripteur, 0, taille)
+        except (AttributeError, OSError):
+            # Windows, macOS ou système de fichiers sans fallocate : fichier creux
+            os.ftruncate(descripteur, taille)
+    finally:
+        os.close(descripteur)
+
+
+def creer(dossier_donnees, nom_fichier, categorie, taille, sha256=None):
+    """Ouvre une session et réserve le fichier. Retourne l'état de la session (voir etat)."""
+    if not isinstance(taille, int) or taille < 0 or taille > TAILLE_MAX:
+        raise ErreurSession(f"'taille' doit être un entier entre 0 et {TAILLE_MAX}.")
+    if sha256 is not None and (len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256)):
+        raise ErreurSession("'sha256' doit être une empreinte hexadécimale en minuscules.")
+
+    session_id = secrets.token_hex(16)
+    maintenant = int(time.time())
+    # Quotas vérifiés et session enregistrée sous le même verrou d'écriture : deux
+    # créations simultanées ne peuvent pas dépasser les limites ensemble
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute(
+            "SELECT COUNT(*), COALESCE(SUM(taille), 0) FROM sessions_upload WHERE expiration >= ?",
+            (maintenant,)
+        )
+        nb_sessions, reserve = cursor.fetchone()
+        if nb_sessions >= SESSIONS_MAX:
+            raise ErreurSession(f"Trop d'uploads en cours ({SESSIONS_MAX} au maximum), réessayer plus tard.", 429)
+        if reserve + taille > RESERVE_MAX:
+            raise ErreurSession(f"Espace réservé aux uploads épuisé ({reserve} octets sur {RESERVE_MAX}), "
+                                "réessayer plus tard.", 507)
+        cursor.execute("""
+            INSERT INTO sessions_upload
+                (id, nom_fichier, categorie, taille, taille_morceau, sha256, date_creation, expiration)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (session_id, nom_fichier, categorie, taille, TAILLE_MORCEAU, sha256,
+              maintenant, maintenant + DUREE_EXPIRATION_S))
+
+    os.makedirs(stockage_blobs.dossier_temporaire(dossier_donnees), exist_ok=True)
+    chemin = _chemin_fichier(dossier_donnees, session_id)
+    try:
+        _reserver(chemin, taille)
+    except BaseException as e:
+        stockage_blobs.abandonner_fichier(chemin)
+        with transaction(gestion_db.DB_NAME) as cursor:
+            cursor.execute("DELETE FROM sessions_upload WHERE id = ?", (session_id,))
+        if isinstance(e, OSError):
+            raise ErreurSession(f"Espace disque insuffisant pour ce fichier : {e}", 507)
+        raise
+    return etat(session_id)
+
+
+def etat(session_id):
+    """État de la session (morceaux reçus compris), ou None si elle n'existe pas ou a expiré."""
+    with lecture(gestion_db.DB_NAME, dictionnaire=True) as cursor:
+        cursor.execute("""
+            SELECT id, nom_fichier, categorie, taille, taille_morceau, sha256, statut, expiration
+            FROM sessions_upload WHERE id = ? AND expiration >= ?
+        """, (session_id, int(time.time())))
+        session = cursor.fetchone()
+        if session is None:
+            return None
+        cursor.execute(
+            "SELECT indice FROM sessions_upload_morceaux WHERE session_id = ? ORDER BY indice",
+            (session_id,)
+        )
+        recus = [ligne[0] for ligne in cursor]
+    resultat = dict(session)
+    resultat["nb_morceaux"] = _nb_morceaux(session["taille"], session["taille_morceau"])
+    resultat["morceaux_recus"] = recus
+    return resultat
+
+
+def _ecrire_a(descripteur, donnees, position):
+    vue = memoryview(donnees)
+    while vue:
+        if hasattr(os, 'pwrite'):
+            ecrits = os.pwrite(descripteur, vue, position)
+        else:
+            # Windows : descripteur propre à la requête, le déplacement ne gêne personne
+            os.lseek(descripteur, position, os.SEEK_SET)
+            ecrits = os.write(descripteur, vue)
+        vue = vue[ecrits:]
+        position += ecrits
+
+
+def _debuter_ecriture(session_id, indice):
+    """
+    Réserve le morceau `indice` pour une écriture, si la session est toujours ouverte.
+    Le morceau n'est plus compté comme reçu jusqu'à la fin de l'écriture : une
+    validation ne peut pas aboutir pendant qu'il change. Retourne le jeton de l'écriture.
+    """
+    maintenant = int(time.time())
+    jeton = secrets.token_hex(8)
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute(
+            "UPDATE sessions_upload SET expiration = ? WHERE id = ? AND statut = 'ouverte' AND expiration >= ?",
+            (maintenant + DUREE_EXPIRATION_S, session_id, maintenant)
+        )
+        # Session purgée, expirée ou validée depuis la lecture de son état
+        if cursor.rowcount == 0:
+            raise ErreurSession("Session d'upload inconnue, expirée ou en cours de validation.", 409)
+        cursor.execute(
+            "SELECT 1 FROM sessions_upload_ecritures WHERE session_id = ? AND indice = ? AND debut >= ?",
+            (session_id, indice, maintenant - DELAI_ECRITURE_S)
+        )
+        if cursor.fetchone():
+            raise ErreurSession("Ce morceau est déjà en cours d'envoi.", 409)
+        # Une écriture plus ancienne que DELAI_ECRITURE_S a été interrompue (worker arrêté)
+        cursor.execute(
+            "INSERT OR REPLACE INTO sessions_upload_ecritures (session_id, indice, jeton, debut) VALUES (?, ?, ?, ?)",
+            (session_id, indice, jeton, maintenant)
+        )
+        cursor.execute("DELETE FROM sessions_upload_morceaux WHERE session_id = ? AND indice = ?",
+                       (session_id, indice))
+    return jeton
+
+
+def _terminer_ecriture(session_id, indice, jeton, sha256):
+    """Libère le morceau ; il est enregistré comme reçu si `sha256` (empreinte vérifiée) est donné."""
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute(
+            "DELETE FROM sessions_upload_ecritures WHERE session_id = ? AND indice = ? AND jeton = ?",
+            (session_id, indice, jeton)
+        )
+        # Ligne absente : session supprimée entre-temps, rien à enregistrer
+        if cursor.rowcount and sha256:
+            cursor.execute(
+                "INSERT INTO sessions_upload_morceaux (session_id, indice, sha256) VALUES (?, ?, ?)",
+                (session_id, indice, sha256)
+            )
+
+
+def _recevoir_morceau(chemin, flux, offset, longueur):
+    """
+    Écrit `longueur` octets de `flux` à partir de `offset` dans le fichier de la
+    session, par blocs de 1 Mo, en calculant leur empreinte au passage.
+    Retourne (octets écrits, empreinte SHA-256).
+    """
+    empreinte = hashlib.sha256()
+    ecrits = 0
+    descripteur = os.open(chemin, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        while ecrits < longueur:
+            bloc = flux.read(min(TAILLE_BLOC_ECRITURE, longueur - ecrits))
+            if not bloc:
+                break
+            empreinte.update(bloc)
+            _ecrire_a(descripteur, bloc, offset + ecrits)
+            ecrits += len(bloc)
+    finally:
+        os.close(descripteur)
+    return ecrits, empreinte.hexdigest()
+
+
+def ecrire_morceau(dossier_donnees, session_id, offset, longueur, flux, sha256_attendu):
+    """
+    Écrit un morceau lu depuis `flux` directement à la position `offset` du fichier de
+    la session, puis l'enregistre si son empreinte est correcte. Un morceau incomplet
+    ou dont l'empreinte ne correspond pas n'est pas enregistré : il devra être renvoyé
+    avant la validation. Retourne l'état de la session.
+    """
+    session = etat(session_id)
+    if session is None:
+        raise ErreurSession("Session d'upload inconnue ou expirée.", 404)
+    if session["statut"] != 'ouverte':
+        raise ErreurSession("Session d'upload en cours de validation.", 409)
+
+    taille_morceau = session["taille_morceau"]
+    if offset < 0 or offset % taille_morceau or offset >= max(session["taille"], 1):
+        raise ErreurSession(f"'offset' doit être un multiple de {taille_morceau} inférieur à la taille du fichier.")
+    attendu = min(taille_morceau, session["taille"] - offset)
+    if longueur != attendu:
+        raise ErreurSession(f"Ce morceau doit faire {attendu} octets (Content-Length).", 400)
+    if not sha256_attendu:
+        raise ErreurSession("En-tête X-Chunk-Sha256 manquant.")
+
+    indice = offset // taille_morceau
+    jeton = _debuter_ecriture(session_id, indice)
+    sha256 = None
+    try:
+        # Hors de toute transaction : les autres morceaux s'écrivent en parallèle
+        ecrits, empreinte = _recevoir_morceau(_chemin_fichier(dossier_donnees, session_id), flux, offset, longueur)
+        if ecrits != longueur:
+            raise ErreurSession("Morceau incomplet (connexion interrompue).", 400)
+        if empreinte != sha256_attendu.lower():
+            raise ErreurSession("L'empreinte du morceau ne correspond pas à X-Chunk-Sha256.", 422)
+        sha256 = empreinte
+    except FileNotFoundError:
+        raise ErreurSession("Session d'upload inconnue ou expirée.", 404)
+    except OSError as e:
+        raise ErreurSession(f"Échec de l'écriture du morceau : {e}", 500)
+    finally:
+        _terminer_ecriture(session_id, indice, jeton, sha256)
+    return etat(session_id)
+
+
+def _empreinte_fichier(chemin):
+    empreinte = hashlib.sha256()
+    with open(chemin, 'rb') as fichier:
+        while True:
+            bloc = fichier.read(stockage_blobs.TAILLE_MORCEAU)
+            if not bloc:
+                return empreinte.hexdigest()
+            empreinte.update(bloc)
+
+
+def _rouvrir(session_id):
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute("UPDATE sessions_upload SET statut = 'ouverte' WHERE id = ?", (session_id,))
+
+
+def valider(dossier_donnees, session_id):
+    """
+    Termine la session : tous les morceaux doivent être reçus. Le fichier est enregistré
+    sous son empreinte par gestion_db.ajouter_document (une seule insertion en base).
+    Retourne (doc_id, blob, nom_fichier).
+    """
+    with transaction(gestion_db.DB_NAME, dictionnaire=True) as cursor:
+        cursor.execute("""
+            SELECT s.nom_fichier, s.categorie, s.taille, s.taille_morceau, s.sha256, s.statut,
+                   (SELECT COUNT(*) FROM sessions_upload_morceaux m WHERE m.session_id = s.id) AS recus
+            FROM sessions_upload s WHERE s.id = ? AND s.expiration >= ?
+        """, (session_id, int(time.time())))
+        session = cursor.fetchone()
+        if session is None:
+            raise ErreurSession("Session d'upload inconnue ou expirée.", 404)
+        if session["statut"] != 'ouverte':
+            raise ErreurSession("Session d'upload déjà en cours de validation.", 409)
+        manquants = _nb_morceaux(session["taille"], session["taille_morceau"]) - session["recus"]
+        if session["taille"] and manquants:
+            raise ErreurSession(f"{manquants} morceau(x) manquant(s).", 409)
+        # Une seule validation à la fois ; l'expiration laisse le temps de relire le fichier
+        cursor.execute(
+            "UPDATE sessions_upload SET statut = 'validation', expiration = ? WHERE id = ?",
+            (int(time.time()) + DUREE_EXPIRATION_S, session_id)
+        )
+
+    chemin = _chemin_fichier(dossier_donnees, session_id)
+    try:
+        sha256 = _empreinte_fichier(chemin)
+    except OSError:
+        _rouvrir(session_id)
+        raise
+    if session["sha256"] and session["sha256"] != sha256:
+        _rouvrir(session_id)
+        raise ErreurSession("L'empreinte du fichier complet ne correspond pas à celle annoncée.", 422)
+
+    blob = stockage_blobs.BlobRecu(sha256, session["taille"], chemin,
+                                   stockage_blobs.chemin_absolu_blob(dossier_donnees, sha256))
+    chemin_simule = f"//localhost/data/{stockage_blobs.chemin_relatif_blob(sha256)}"
+    doc_id = gestion_db.ajouter_document(session["nom_fichier"], chemin_simule, session["categorie"], blob=blob)
+    if not doc_id:
+        _rouvrir(session_id)
+        raise ErreurSession("Erreur lors de l'insertion dans la base de données", 500)
+
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute("DELETE FROM sessions_upload WHERE id = ?", (session_id,))
+    return doc_id, blob, session["nom_fichier"]
+
+
+def abandonner(dossier_donnees, session_id):
+    """Supprime une session et son fichier. Retourne False si elle n'existait pas."""
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute("DELETE FROM sessions_upload WHERE id = ? AND statut = 'ouverte'", (session_id,))
+        supprimee = cursor.rowcount > 0
+    if supprimee:
+        stockage_blobs.abandonner_fichier(_chemin_fichier(dossier_donnees, session_id))
+    return supprimee
+
+
+def purger_expirees(dossier_donnees, limite=500):
+    """Supprime les sessions expirées et leurs fichiers. Retourne le nombre de sessions supprimées."""
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute(
+            "SELECT id FROM sessions_upload WHERE expiration < ? LIMIT ?",
+            (int(time.time()), limite)
+        )
+        expirees = [ligne[0] for ligne in cursor.fetchall()]
+        cursor.executemany("DELETE FROM sessions_upload WHERE id = ?", [(i,) for i in expirees])
+        # Sous le verrou d'écriture : un morceau en cours d'enregistrement ne peut pas recréer la session
+        for session_id in expirees:
+            stockage_blobs.abandonner_fichier(_chemin_fichier(dossier_donnees, session_id))
+    return len(expirees)
@@ -0,0 +1,97 @@
+"""
+Images de signature (PNG) des documents.
+
+Une image est stockée une seule fois, comme un blob adressé par contenu (stockage_blobs) :
+les documents signés avec la même image la référencent par documents.signature_sha256,
+et le compteur de références de la table 'blobs' la libère quand plus aucun document ne
+l'utilise (voir schema_db). L'écriture est atomique : fichier temporaire puis renommage.
+
+La signature reçue en base64 (data URL du canevas) est décodée par morceaux en même temps
+qu'elle est écrite et hachée, sans copie décodée complète en mémoire.
+
+Les anciennes signatures (data/signatures/<id>.png) restent servies tant que le
+document n'a pas été signé à nouveau.
+"""
+
+import base64
+import binascii
+import os
+
+import stockage_blobs
+
+DOSSIER_ANCIENNES_SIGNATURES = 'signatures'
+ENTETE_PNG = b'\x89PNG\r\n\x1a\n'
+TAILLE_MAX = int(os.environ.get("FORMULAMA_SIGNATURE_TAILLE_MAX", str(2 * 1024 * 1024)))
+
+
+class ErreurSignature(ValueError):
+    """Signature refusée (base64 invalide, pas un PNG, trop volumineuse)."""
+
+
+class _DecodeurBase64:
+    """Flux binaire (read) sur une chaîne base64, décodée morceau par morceau."""
+
+    def __init__(self, texte):
+        self._texte = texte
+        # Préfixe éventuel 'data:image/png;base64,'
+        prefixe = texte.find('base64,', 0, 100)
+        self._position = prefixe + len('base64,') if prefixe >= 0 else 0
+        self._reste = ''
+
+    def read(self, taille=-1):
+        while self._position < len(self._texte) or self._reste:
+            nb_caracteres = len(self._texte) if taille < 0 else max(4, taille // 3 * 4)
+            morceau = self._reste + self._texte[self._position:self._position + nb_caracteres]
+            self._position += nb_caracteres
+            morceau = ''.join(morceau.split())
+            if self._position < len(self._texte):
+                # Ne décoder que des groupes complets de 4 caractères
+                coupure = len(morceau) - len(morceau) % 4
+                morceau, self._reste = morceau[:coupure], morceau[coupure:]
+            else:
+                self._reste = ''
+            if morceau:
+                try:
+                    return base64.b64decode(morceau, validate=True)
+                except binascii.Error as e:
+                    raise ErreurSignature(f"Signature base64 invalide : {e}") from e
+        return b''
+
+
+def recevoir(source, dossier_donnees):
+    """
+    Écrit la signature dans un fichier temporaire et retourne le stockage_blobs.BlobRecu
+    à enregistrer (gestion_db.signer_documents). `source` est une chaîne base64 (ou data
+    URL) ou un flux binaire (fichier PNG d'un formulaire multipart).
+    Lève ErreurSignature si le contenu n'est pas un PNG acceptable.
+    """
+    flux = _DecodeurBase64(source) if isinstance(source, str) else source
+    blob = stockage_blobs.recevoir(flux, dossier_donnees)
+    try:
+        if blob.taille > TAILLE_MAX:
+            raise ErreurSignature(f"Signature trop volumineuse ({blob.taille} octets, maximum {TAILLE_MAX}).")
+        with open(blob.chemin_temp, 'rb') as fichier:
+            if fichier.read(len(ENTETE_PNG)) != ENTETE_PNG:
+                raise ErreurSignature("La signature doit être une image PNG.")
+    except BaseException:
+        stockage_blobs.abandonner(blob)
+        raise
+    return blob
+
+
+def chemin_ancienne_signature(doc_id):
+    """Chemin relatif au dossier de données d'une signature antérieure aux blobs."""
+    return f"{DOSSIER_ANCIENNES_SIGNATURES}/{doc_id}.png"
+
+
+def emplacement(dossier_donnees, doc_id, signature_sha256):
+    """
+    Retourne (chemin, sha256) de la signature d'un document : le blob référencé s'il y en
+    a un, sinon l'ancien fichier <id>.png (sha256=None), ou (None, None) sans signature.
+    """
+    if signature_sha256:
+        return stockage_blobs.chemin_absolu_blob(dossier_donnees, signature_sha256), signature_sha256
+    chemin = os.path.join(dossier_donnees, *chemin_ancienne_signature(doc_id).split('/'))
+    if os.path.exists(chemin):
+        return chemin, None
+    return None, None
@@ -0,0 +1,101 @@
+"""
+Statistiques des documents : nombre total et signés, par catégorie.
+
+Les compteurs sont stockés dans 'statistiques_categories' et tenus exacts par triggers
+(voir schema_db) : les lire coûte une ligne par catégorie, quelle que soit la taille de
+la table 'documents'.
+
+Reconstruction (base restaurée, triggers contournés) et vérification :
+
+    python statistiques.py --verifier
+    python statistiques.py --reconstruire
+"""
+
+import argparse
+import json
+import sys
+
+import gestion_db
+import cache_requetes
+from connexion_db import lecture, transaction
+from metriques import mesurer_requete
+
+# Compteurs recalculés depuis la table des documents (parcours complet)
+_REQUETE_CALCUL = """
+    SELECT categorie, COUNT(*), SUM(COALESCE(is_signed, 0) != 0)
+    FROM documents
+    GROUP BY categorie
+"""
+
+
+def _resume(lignes):
+    categories = {
+        categorie: {"total": total, "signes": signes, "non_signes": total - signes}
+        for categorie, total, signes in lignes
+    }
+    total = sum(c["total"] for c in categories.values())
+    signes = sum(c["signes"] for c in categories.values())
+    return {"total": total, "signes": signes, "non_signes": total - signes, "categories": categories}
+
+
+@mesurer_requete
+def lire():
+    """
+    Retourne {"total", "signes", "non_signes", "categories": {categorie: {...}}}.
+    Les valeurs retournées sont partagées (cache_requetes) : ne pas les modifier.
+    """
+    def calculer():
+        with lecture(gestion_db.DB_NAME) as cursor:
+            cursor.execute("""
+                SELECT categorie, total, signes
+                FROM statistiques_categories
+                ORDER BY categorie
+            """)
+            return _resume(cursor.fetchall())
+
+    return cache_requetes.obtenir(gestion_db.DB_NAME, ('statistiques',), calculer)
+
+
+def verifier():
+    """Compare les compteurs au recalcul complet. Retourne la liste des catégories divergentes."""
+    with lecture(gestion_db.DB_NAME) as cursor:
+        cursor.execute(_REQUETE_CALCUL)
+        attendus = {categorie: (total, signes) for categorie, total, signes in cursor.fetchall()}
+        cursor.execute("SELECT categorie, total, signes FROM statistiques_categories")
+        stockes = {categorie: (total, signes) for categorie, total, signes in cursor.fetchall()}
+    return [
+        {"categorie": categorie, "attendu": attendus.get(categorie), "stocke": stockes.get(categorie)}
+        for categorie in sorted(attendus.keys() | stockes.keys())
+        if attendus.get(categorie) != stockes.get(categorie)
+    ]
+
+
+def reconstruire():
+    """Recalcule tous les compteurs depuis 'documents', en une transaction. Retourne le nombre de catégories."""
+    with transaction(gestion_db.DB_NAME) as cursor:
+        cursor.execute("DELETE FROM statistiques_categories")
+        cursor.execute(f"INSERT INTO statistiques_categories (categorie, total, signes) {_REQUETE_CALCUL}")
+        nb_categories = cursor.rowcount
+        # Les résultats mis en cache dans les autres processus deviennent périmés
+        cursor.execute("UPDATE generation_cache SET valeur = valeur + 1 WHERE id = 1")
+    cache_requetes.invalider()
+    return nb_categories
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compteurs de documents par catégorie.")
+    groupe = parser.add_mutually_exclusive_group()
+    groupe.add_argument("--verifier", action="store_true",
+                        help="comparer les compteurs au recalcul complet (code de sortie 1 si différents)")
+    groupe.add_argument("--reconstruire", action="store_true",
+                        help="recalculer tous les compteurs depuis la table des documents")
+    args = parser.parse_args()
+
+    gestion_db.initialiser_base_de_donnees()
+    if args.reconstruire:
+        print(f"✅ {reconstruire()} catégorie(s) recalculée(s).", file=sys.stderr)
+    elif args.verifier:
+        ecarts = verifier()
+        print(json.dumps(ecarts, ensure_ascii=False, indent=2))
+        sys.exit(1 if ecarts else 0)
+    print(json.dumps(lire(), ensure_ascii=False, indent=2))
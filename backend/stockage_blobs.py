@@ -0,0 +1,85 @@
+"""
+Stockage des fichiers uploadés adressé par contenu.
+
+Chaque fichier est enregistré sous son empreinte SHA-256, dans une arborescence
+répartie (data/blobs/ab/cd/abcd...) pour garder des dossiers de taille raisonnable.
+Un contenu déjà présent n'est jamais écrit une seconde fois : le même blob est
+référencé par plusieurs documents (compteur nb_references de la table 'blobs').
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import namedtuple
+
+DOSSIER_BLOBS = 'blobs'
+TAILLE_MORCEAU = 1024 * 1024
+
+# Fichier reçu dans le dossier temporaire, pas encore publié sous son empreinte
+BlobRecu = namedtuple('BlobRecu', ['sha256', 'taille', 'chemin_temp', 'chemin_final'])
+
+
+def chemin_relatif_blob(sha256):
+    """Chemin du blob relatif au dossier de données, ex. 'blobs/ab/cd/abcd...'."""
+    return '/'.join((DOSSIER_BLOBS, sha256[:2], sha256[2:4], sha256))
+
+
+def chemin_absolu_blob(dossier_donnees, sha256):
+    return os.path.join(dossier_donnees, *chemin_relatif_blob(sha256).split('/'))
+
+
+def dossier_temporaire(dossier_donnees):
+    return os.path.join(dossier_donnees, DOSSIER_BLOBS, 'tmp')
+
+
+def recevoir(flux, dossier_donnees):
+    """
+    Copie `flux` dans un fichier temporaire en calculant son SHA-256 au passage
+    (une seule lecture, mémoire bornée à un morceau de 1 Mo).
+    Retourne un BlobRecu à publier (publier) ou abandonner (abandonner).
+    """
+    dossier_tmp = dossier_temporaire(dossier_donnees)
+    os.makedirs(dossier_tmp, exist_ok=True)
+    empreinte = hashlib.sha256()
+    taille = 0
+    descripteur, chemin_temp = tempfile.mkstemp(dir=dossier_tmp, suffix='.part')
+    try:
+        with os.fdopen(descripteur, 'wb') as destination:
+            while True:
+                morceau = flux.read(TAILLE_MORCEAU)
+                if not morceau:
+                    break
+                empreinte.update(morceau)
+                destination.write(morceau)
+                taille += len(morceau)
+    except BaseException:
+        abandonner_fichier(chemin_temp)
+        raise
+
+    sha256 = empreinte.hexdigest()
+    return BlobRecu(sha256, taille, chemin_temp, chemin_absolu_blob(dossier_donnees, sha256))
+
+
+def publier(blob):
+    """
+    Place le fichier reçu à son emplacement définitif. Si ce contenu existe déjà,
+    le fichier temporaire est simplement supprimé (déduplication).
+    À appeler dans la transaction qui enregistre la référence au blob (voir gestion_db).
+    """
+    if os.path.exists(blob.chemin_final):
+        abandonner_fichier(blob.chemin_temp)
+        return
+    os.makedirs(os.path.dirname(blob.chemin_final), exist_ok=True)
+    os.replace(blob.chemin_temp, blob.chemin_final)
+
+
+def abandonner(blob):
+    """Supprime le fichier temporaire d'un blob qui ne sera pas enregistré."""
+    abandonner_fichier(blob.chemin_temp)
+
+
+def abandonner_fichier(chemin):
+    try:
+        os.remove(chemin)
+    except FileNotFoundError:
+        pass
@@ -308,12 +308,14 @@ const SidebarContent = () => {
         const categories = ["Documents archivés", "Documents supportés"];
         const counts: { [key: string]: number } = { "Documents archivés": 0, "Documents supportés": 0 };
         
-        for (const category of categories) {
-          const url = `${API_BASE_URL}/api/documents/${encodeURIComponent(category)}`;
-          const response = await fetch(url);
-          if (response.ok) {
-            const data = await response.json();
-            counts[category] = Array.isArray(data) ? data.length : 0;
+        // Une seule requête pour toutes les catégories (limit=0 : uniquement les totaux)
+        const params = new URLSearchParams({ limit: "0" });
+        categories.forEach((category) => params.append("categorie", category));
+        const response = await fetch(`${API_BASE_URL}/api/documents/categories?${params.toString()}`);
+        if (response.ok) {
+          const data = await response.json();
+          for (const category of categories) {
+            counts[category] = data.categories?.[category]?.total ?? 0;
           }
         }
         